@@ -12,8 +12,7 @@ from pysam.libcalignmentfile cimport *
 from pysam.libcalignedsegment cimport pysam_bam_get_cigar, \
     pysam_bam_get_qname, pysam_get_n_cigar
 from pysam.libcfaidx cimport *
-from libc.string cimport strchr
-from libc.stdint cimport int8_t
+from libc.stdint cimport int8_t, uint64_t, uintptr_t
 from libc.stdio cimport puts, printf
 from libc.stdlib cimport abs
 from cpython cimport PyErr_SetString, PyBytes_FromStringAndSize
@@ -21,16 +20,17 @@ from cpython cimport array as c_array
 from sortedcontainers import SortedList
 
 import array
-import base64
 import collections
 import copy
 import struct
-import hashlib
 import itertools
 import numpy
+import os
 import pandas
 import pysam
 import sys
+# gzip is also the name of a htslib constant
+from gzip import GzipFile
 
 cimport numpy
 
@@ -122,6 +122,241 @@ cdef get_cigar_stats(AlignedSegment read, uint32_t[:] base_counts, uint32_t[:] b
     return base_counts, block_counts
 
 
+# Read name index used by bam2stats_count. Read names are reduced to
+# 64-bit keys with a non-cryptographic hash (FNV-1a followed by the
+# murmur3 finalizer) and stored in an open-addressing table with linear
+# probing. The key 0 marks an empty slot.
+#
+# A saved index starts with a header (magic, capacity, number of reads,
+# size and modification time of the file the read names were taken
+# from and the length of its path) followed by the path, padded to
+# 8 bytes, and the key and index arrays.
+READ_INDEX_MAGIC = b"CGATRNI2"
+READ_INDEX_HEADER = struct.Struct("<8sqqqqq")
+cdef double READ_INDEX_MAX_LOAD = 0.7
+
+
+def read_index_header(filename):
+    '''return the header of the read name index in *filename*.
+
+    Returns a tuple of capacity, number of reads, source filename,
+    source size, source modification time and the offset of the
+    arrays.
+    '''
+    with open(filename, "rb") as inf:
+        header = inf.read(READ_INDEX_HEADER.size)
+        if len(header) != READ_INDEX_HEADER.size or \
+           header[:8] != READ_INDEX_MAGIC:
+            raise ValueError("%s is not a read name index" % filename)
+        (magic, capacity, nreads, source_size, source_mtime,
+         lpath) = READ_INDEX_HEADER.unpack(header)
+        source = inf.read(lpath).decode("utf-8")
+    offset = READ_INDEX_HEADER.size + lpath + (-lpath % 8)
+    return capacity, nreads, source, source_size, source_mtime, offset
+
+
+def estimate_fastq_reads(filename, nsample=10000):
+    '''estimate the number of reads in fastq file *filename*.
+
+    The estimate is based on the number of bytes taken up by the first
+    *nsample* reads. gzip compressed files are supported.
+    '''
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as raw:
+        is_gzip = raw.read(2) == b"\x1f\x8b"
+        raw.seek(0)
+        if is_gzip:
+            inf = GzipFile(fileobj=raw)
+        else:
+            inf = raw
+        nlines = 0
+        while nlines < 4 * nsample and inf.readline():
+            nlines += 1
+        if nlines < 4 * nsample:
+            # complete file has been read
+            return nlines // 4
+        return int(size * nsample / max(1, raw.tell()))
+
+
+cdef inline uint64_t hash_read_name(const char * s, int length) nogil:
+    '''hash the first *length* characters of *s*.
+
+    Hashing stops at the first space, so that read names containing
+    more than just the identifier hash identically.
+    '''
+    cdef uint64_t h = 14695981039346656037ULL
+    cdef int x
+    for x from 0 <= x < length:
+        if s[x] == b' ' or s[x] == 0:
+            break
+        h ^= <uint8_t>s[x]
+        h *= 1099511628211ULL
+    h ^= h >> 33
+    h *= 0xff51afd7ed558ccdULL
+    h ^= h >> 33
+    h *= 0xc4ceb9fe1a85ec53ULL
+    h ^= h >> 33
+    if h == 0:
+        h = 1
+    return h
+
+
+cdef class ReadNameIndex:
+    '''map read names to consecutive indices.
+
+    The table is sized for *expected_reads* at a load factor of at
+    most 0.7 and doubles in size if more reads are added. An index can
+    be saved to disk with :meth:`save` and opened memory-mapped with
+    :meth:`load` for re-use across runs.
+    '''
+
+    cdef keys
+    cdef indices
+    cdef uint64_t * _keys
+    cdef uint32_t * _indices
+    cdef uint64_t mask
+    cdef readonly int64_t capacity
+    cdef readonly int64_t nreads
+    cdef readonly bint is_readonly
+
+    def __init__(self, expected_reads=0):
+        cdef int64_t capacity = 16
+        while capacity * READ_INDEX_MAX_LOAD < expected_reads:
+            capacity *= 2
+        self._allocate(capacity)
+        self.nreads = 0
+        self.is_readonly = False
+
+    def _allocate(self, int64_t capacity):
+        self._setArrays(numpy.zeros(capacity, dtype=numpy.uint64),
+                        numpy.zeros(capacity, dtype=numpy.uint32))
+
+    def _setArrays(self, keys, indices):
+        self.keys = keys
+        self.indices = indices
+        self._keys = <uint64_t *><uintptr_t>keys.ctypes.data
+        self._indices = <uint32_t *><uintptr_t>indices.ctypes.data
+        self.capacity = len(keys)
+        self.mask = self.capacity - 1
+
+    cdef int64_t _find(self, uint64_t key) nogil:
+        '''return slot of *key* or of the empty slot it would occupy.'''
+        cdef uint64_t slot = key & self.mask
+        while self._keys[slot] != 0 and self._keys[slot] != key:
+            slot = (slot + 1) & self.mask
+        return slot
+
+    cdef int64_t lookup(self, uint64_t key) nogil:
+        '''return index of *key* or -1 if not present.'''
+        cdef int64_t slot = self._find(key)
+        if self._keys[slot] == 0:
+            return -1
+        return self._indices[slot]
+
+    cdef int64_t add(self, uint64_t key) except -1:
+        '''add *key* and return its index. If *key* is already
+        present, the existing index is returned.'''
+        cdef int64_t slot = self._find(key)
+        if self._keys[slot] != 0:
+            return self._indices[slot]
+        if self.is_readonly:
+            raise ValueError("can not add reads to a read-only index")
+        if self.nreads + 1 > self.capacity * READ_INDEX_MAX_LOAD:
+            self._grow()
+            slot = self._find(key)
+        self._keys[slot] = key
+        self._indices[slot] = self.nreads
+        self.nreads += 1
+        return self.nreads - 1
+
+    def _grow(self):
+        cdef int64_t x, slot
+        keys, indices = self.keys, self.indices
+        occupied = numpy.nonzero(keys)[0]
+        self._allocate(self.capacity * 2)
+        for x in occupied:
+            slot = self._find(keys[x])
+            self._keys[slot] = keys[x]
+            self._indices[slot] = indices[x]
+
+    def addName(self, name):
+        '''add read *name* and return its index.'''
+        if isinstance(name, str):
+            name = name.encode("ascii")
+        return self.add(hash_read_name(name, len(name)))
+
+    def getIndex(self, name):
+        '''return index of read *name* or -1 if not present.'''
+        if isinstance(name, str):
+            name = name.encode("ascii")
+        return self.lookup(hash_read_name(name, len(name)))
+
+    def getKeys(self):
+        '''return array of hash keys ordered by read index.'''
+        occupied = self.keys != 0
+        result = numpy.zeros(self.nreads, dtype=numpy.uint64)
+        result[self.indices[occupied]] = self.keys[occupied]
+        return result
+
+    def __len__(self):
+        return self.nreads
+
+    def save(self, filename, source):
+        '''save index to *filename*.
+
+        The path, size and modification time of *source*, the file
+        the read names were taken from, are saved with the index.
+        '''
+        path = os.path.abspath(source).encode("utf-8")
+        st = os.stat(source)
+        with open(filename, "wb") as outf:
+            outf.write(READ_INDEX_HEADER.pack(
+                READ_INDEX_MAGIC, self.capacity, self.nreads,
+                st.st_size, st.st_mtime_ns, len(path)))
+            outf.write(path)
+            outf.write(b"\0" * (-len(path) % 8))
+            self.keys.astype("<u8").tofile(outf)
+            self.indices.astype("<u4").tofile(outf)
+
+    @staticmethod
+    def isCurrent(filename, source=None):
+        '''return True if the index in *filename* can be used.
+
+        The file the read names were taken from must be unchanged since
+        the index was saved. If *source* is given, the index must have
+        been built from it.
+        '''
+        try:
+            (capacity, nreads, path, size, mtime,
+             offset) = read_index_header(filename)
+        except ValueError:
+            return False
+        if source is not None and os.path.abspath(source) != path:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_size == size and st.st_mtime_ns == mtime
+
+    @classmethod
+    def load(cls, filename):
+        '''open a saved index memory-mapped and read-only.'''
+        (capacity, nreads, path, size, mtime,
+         offset) = read_index_header(filename)
+        cdef ReadNameIndex index = cls()
+        index._setArrays(
+            numpy.memmap(filename, dtype="<u8", mode="r",
+                         offset=offset,
+                         shape=(capacity,)),
+            numpy.memmap(filename, dtype="<u4", mode="r",
+                         offset=offset + 8 * capacity,
+                         shape=(capacity,)))
+        index.nreads = nreads
+        index.is_readonly = True
+        return index
+
+
 def bam2stats_count(AlignmentFile samfile,
                     bed_mask=None,
                     ignore_masked_reads=False,
@@ -130,8 +365,18 @@ def bam2stats_count(AlignmentFile samfile,
                     outfile_details=None,
                     add_alignment_details=False,
                     outfile_readmap=None,
-                    detailed_count=None):
-    '''
+                    detailed_count=None,
+                    filename_read_index=None):
+    '''count alignment statistics in *samfile*.
+
+    Per-read statistics are collected if read names are available,
+    either from *filename_fastq* or from a first pass through
+    *samfile*. Read names are stored in a :class:`ReadNameIndex`.
+
+    If *filename_read_index* is given and the file exists, read names
+    are taken from the saved index instead, provided that the file
+    it has been built from is unchanged. Otherwise the index that has
+    been built is saved to *filename_read_index*.
     '''
     cdef AlignedSegment read
     cdef bint _add_alignment_details = add_alignment_details
@@ -187,12 +432,12 @@ def bam2stats_count(AlignmentFile samfile,
     cdef int64_t index, fastq_nreads
     cdef CountsType * fastq_counts
     cdef CountsType * fastq_count
-    cdef char * read_name
-    cdef char * position
     cdef bint count_fastq = False
     cdef int fastq_notfound = 0
     cdef int chop = 0
-    cdef int hash_size = 5
+    cdef ReadNameIndex reads = None
+    cdef uint64_t key
+    cdef uint64_t [:] keys_view
 
     # number of alignment pairs that are nucleotide mismatches
     cdef long mismatch_counts = 0
@@ -218,74 +463,84 @@ def bam2stats_count(AlignmentFile samfile,
     cdef uint32_t [:] base_counts_view = base_counts
     cdef uint32_t [:] block_counts_view = block_counts
 
-    if filename_fastq != None:
+    # file read names are taken from
+    if filename_fastq is not None:
+        read_source = filename_fastq
+    elif not is_stdin:
+        read_source = os.fsdecode(samfile.filename)
+    else:
+        read_source = None
+
+    if filename_read_index is not None and \
+       os.path.exists(filename_read_index):
+        if ReadNameIndex.isCurrent(filename_read_index, read_source):
+            E.info("loading read names from %s" % filename_read_index)
+            reads = ReadNameIndex.load(filename_read_index)
+        else:
+            E.warn("read name index %s is out of date and will "
+                   "be ignored" % filename_read_index)
+
+    if reads is not None:
+        count_fastq = True
+
+    elif filename_fastq != None:
         count_fastq = True
         E.info("reading fastq file")
-        # Using a python dictionary here is due
-        # for a large amount of memory usage.
-        # Alternatives to dictionary
-        # 1. POSIX hash tables (hsearch,...) or trees: very slow
-        # 2. custom hash implementation: worth the effort?
-        # 3. Sorted list and binary search: too slow for many lookups
-        reads = {}
+        reads = ReadNameIndex(estimate_fastq_reads(filename_fastq))
         fastqfile = FastxFile(filename_fastq)
-        fastq_nreads = 0
         for fq in fastqfile:
-            if fastq_nreads == 0:
+            name = fq.name.encode("ascii")
+            if len(reads) == 0:
                 # chop off /1 or /2 as mappers usually remove these
                 # suffices. Test only the first.
-                name = fq.name
-                if name.endswith("/1") or name.endswith("/2"):
-                    chop = -2
+                if name.endswith(b"/1") or name.endswith(b"/2"):
+                    chop = 2
 
-            if chop != 0:
-                name = hashlib.md5(fq.name[:chop].encode("ascii")).digest()[:hash_size]
-            else:
-                name = hashlib.md5(fq.name.encode("ascii")).digest()[:hash_size]
-
-            reads[name] = fastq_nreads
-
-            fastq_nreads += 1
+            reads.add(hash_read_name(name, len(name) - chop))
 
     elif not is_stdin and detailed_count:
         count_fastq = True
         old_pos = samfile.tell()
         E.info("two-pass processing to collect read names")
-        reads = {}
-        fastq_nreads = 0
+
+        # size the index from the number of alignments, which is
+        # an upper bound for the number of reads
+        try:
+            expected_reads = samfile.mapped + samfile.unmapped
+        except ValueError:
+            expected_reads = 0
+        reads = ReadNameIndex(expected_reads)
+
         for iteration, read in enumerate(samfile):
 
             if iteration % report_step == 0:
                 E.info("pre-pass: read {} alignments: {} reads".format(
                     iteration, len(reads)))
 
-            read_name = pysam_bam_get_qname(read._delegate)
-
-            # terminate string at first space to
-            # truncate read names containing more than
-            # just the id
-            position = strchr(read_name, ' ')
-            if position != NULL:
-                position[0] = '\0'
-
-            # compute hash, truncate to half the md5 digest which
-            # should be 64 bits and provides 36,893,488,147,419,103,232
-            # hashes.
-            md5 = hashlib.md5(read_name).digest()[:hash_size]
-            if md5 not in reads:
-                reads[md5] = fastq_nreads
-                fastq_nreads += 1
-                if outfile_readmap:
-                    outfile_readmap.write("{}\t{}\n".format(
-                        read_name,
-                        base64.encodestring(md5)[:-1]))
+            key = hash_read_name(pysam_bam_get_qname(read._delegate),
+                                 read._delegate.core.l_qname)
+            index = reads.nreads
+            if reads.add(key) == index and outfile_readmap:
+                outfile_readmap.write("{}\t{:016x}\n".format(
+                    read.query_name.split(" ")[0], key))
 
         samfile.seek(old_pos)
         nalignments = iteration
+    elif filename_read_index is not None:
+        raise ValueError(
+            "read name index %s can not be built without read names, "
+            "supply a fastq file or a bam file that is not read "
+            "from stdin" % filename_read_index)
     else:
         count_fastq = False
         E.info("simple counting only")
 
+    if reads is not None:
+        fastq_nreads = reads.nreads
+        if filename_read_index is not None and not reads.is_readonly:
+            E.info("saving read names to %s" % filename_read_index)
+            reads.save(filename_read_index, read_source)
+
     if count_fastq:
         E.info("read names of %i reads or read pairs" % fastq_nreads)
         E.info("allocating %i bytes" % (fastq_nreads * sizeof(CountsType)))
@@ -352,21 +607,13 @@ def bam2stats_count(AlignmentFile samfile,
             match_counts += base_counts_view[BAM_CMATCH]
 
         if count_fastq:
-            read_name = pysam_bam_get_qname(read._delegate)
-            # terminate string at first space to
-            # truncate read names containing more than
-            # just the id
-            position = strchr(read_name, ' ')
-            if position != NULL:
-                position[0] = '\0'
-
-            md5 = hashlib.md5(read_name).digest()[:hash_size]
-            read_index = reads[md5]
-            try:
-                fastq_count = &fastq_counts[read_index]
-            except KeyError:
+            read_index = reads.lookup(hash_read_name(
+                pysam_bam_get_qname(read._delegate),
+                read._delegate.core.l_qname))
+            if read_index < 0:
                 fastq_notfound += 1
                 continue
+            fastq_count = &fastq_counts[read_index]
 
             # only take primary alignments for read length. read.query_length
             # includes soft-clipped sequence.
@@ -525,7 +772,7 @@ def bam2stats_count(AlignmentFile samfile,
 
     if count_fastq:
         E.info("fastq counting: aggregating counts")
-        for qname, index in reads.items():
+        for index from 0 <= index < fastq_nreads:
             fastq_count = &fastq_counts[index]
 
             # paired read data
@@ -666,15 +913,16 @@ def bam2stats_count(AlignmentFile samfile,
         counter.total_read2_is_unmapped = total_read2_is_unmapped
         counter.total_read2_is_missing = total_read2_is_missing
 
-        substitution_rates = numpy.zeros(fastq_nreads, dtype=numpy.float)
-        insertion_rates = numpy.zeros(fastq_nreads, dtype=numpy.float)
-        deletion_rates = numpy.zeros(fastq_nreads, dtype=numpy.float)
-        error_rates = numpy.zeros(fastq_nreads, dtype=numpy.float)
-        coverages = numpy.zeros(fastq_nreads, dtype=numpy.float)
-        mask = numpy.ones(fastq_nreads, dtype=numpy.int)
+        substitution_rates = numpy.zeros(fastq_nreads, dtype=numpy.float64)
+        insertion_rates = numpy.zeros(fastq_nreads, dtype=numpy.float64)
+        deletion_rates = numpy.zeros(fastq_nreads, dtype=numpy.float64)
+        error_rates = numpy.zeros(fastq_nreads, dtype=numpy.float64)
+        coverages = numpy.zeros(fastq_nreads, dtype=numpy.float64)
+        mask = numpy.ones(fastq_nreads, dtype=numpy.int64)
 
         if outfile_details:
-            header = ["read_md5",
+            keys_view = reads.getKeys()
+            header = ["read_hash",
                       "read_length",
                       "alignments",
                       "mean_quality",
@@ -707,11 +955,10 @@ def bam2stats_count(AlignmentFile samfile,
             if outfile_details != sys.stdout:
                 # later: get access FILE * object
                 outfile_details.write("\t".join(header) + "\n")
-                for qname, read_index in reads.items():
+                for read_index from 0 <= read_index < fastq_nreads:
                     fastq_count = &fastq_counts[read_index]
-                    # remove "\n" from base64 encoded md5
-                    outfile_details.write("%s\t%s" % (
-                        base64.encodestring(qname)[:-1].decode("ascii"),
+                    outfile_details.write("%016x\t%s" % (
+                        keys_view[read_index],
                         "\t".join( \
                                    map(str,
                                        (fastq_count.read_length,
@@ -788,11 +1035,10 @@ def bam2stats_count(AlignmentFile samfile,
                 # use puts to avoid the following error:
                 # format not a string literal and no format arguments
                 puts("\t".join(header) + "\n")
-                for qname, read_index in reads.items():
+                for read_index from 0 <= read_index < fastq_nreads:
                     fastq_count = &fastq_counts[read_index]
-                    read_name = qname
-                    printf("%s\t%i\t%i\t%5.2f\t%5.2f\t%i\t%i\t%i\t%i\t%i\t%i\t%i\t%i\t%i\t%i",
-                           read_name,
+                    printf("%016llx\t%i\t%i\t%5.2f\t%5.2f\t%i\t%i\t%i\t%i\t%i\t%i\t%i\t%i\t%i\t%i",
+                           <unsigned long long>keys_view[read_index],
                            fastq_count.read_length,
                            fastq_count.alignments,
                            fastq_count.mean_quality / 1000.0,
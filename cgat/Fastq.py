@@ -6,6 +6,22 @@ This module provides an iterator of :term:`fastq` formatted files
 score format (:func:`iterate_guess`) or converting them
 (:func:`iterate_convert`) while iterating through a file.
 
+For large files, :func:`iterate_batches` parses blocks of bytes into
+:class:`RecordBatch` objects. A batch keeps all records in a shared
+buffer and permits format conversion, trimming and filtering with
+array operations. :func:`iterate_batches_guess` and
+:func:`iterate_batches_convert` are the batch equivalents of
+:func:`iterate_guess` and :func:`iterate_convert`, and
+:func:`write_batch` outputs a batch.
+
+:func:`iterate_sorted` sorts single or paired :term:`fastq` files
+with an external merge sort. :func:`iterate_sample_skip` and
+:func:`sample_reservoir` sample records without parsing the records
+that are not part of the sample.
+
+:class:`FastqIndex` is an on-disk index for looking up sequences and
+quality scores by read name, see also :func:`open_index`.
+
 :func:`guessFormat` inspects a fastq file to guess the quality score format
 and :func:`getOffset` returns the numeric offset for quality score conversion
 for a particular quality score format.
@@ -19,9 +35,21 @@ Reference
 
 '''
 
+import collections
+import hashlib
+import heapq
+import itertools
+import os
+import random
+import shutil
 import string
+import struct
+import tempfile
+import zlib
+
+from math import exp, log, log1p
 
-from math import log
+import numpy
 
 import cgatcore.experiment as E
 import cgatcore.iotools as iotools
@@ -33,6 +61,77 @@ RANGES = {
     'phred64': (64, 106),
 }
 
+# number of bytes to read at a time by iterate_batches
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# header of FastqIndex files: magic, number of records, number of blocks
+INDEX_MAGIC = b"CGATFQI1"
+INDEX_HEADER = struct.Struct("<8sqq")
+# uncompressed size of blocks in FastqIndex files
+INDEX_BLOCK_SIZE = 64 * 1024
+
+# characters used by write_batch: "@", "\n" and "\n+\n"
+LITERALS = numpy.frombuffer(b"@\n+\n", dtype=numpy.uint8)
+
+
+def _build_tables():
+    '''build lookup tables for quality score conversion.
+
+    Returns a tuple of two dictionaries. The first maps a format to a
+    table translating quality characters to phred scores. The second
+    maps a format to a table translating phred scores to quality
+    characters. Scores that can not be represented are set to -1.
+    '''
+    log10x = log(10.0) + .499
+    log10y = log(10.0, 10) / 10.0
+
+    def solexa_from_phred(x):
+        try:
+            return 64 + int(10.0 * (log(10 ** (x * log10y) - 1.0, 10)))
+        except ValueError:
+            return -1
+
+    to_phred = {
+        'sanger': lambda x: x - 33,
+        'illumina-1.8': lambda x: x - 33,
+        'solexa': lambda x: int(
+            10.0 * log(1.0 + 10 ** (x / 10.0), 10) / log10x),
+        'phred64': lambda x: x - 64}
+
+    from_phred = {
+        'sanger': lambda x: 33 + x,
+        'illumina-1.8': lambda x: 33 + x,
+        'solexa': solexa_from_phred,
+        'phred64': lambda x: 64 + x}
+
+    to_tables, from_tables = {}, {}
+    for format in RANGES:
+        to_tables[format] = numpy.array(
+            [to_phred[format](x) for x in range(256)], dtype=numpy.int16)
+        table = numpy.array(
+            [from_phred[format](x) for x in range(256)], dtype=numpy.int16)
+        table[(table < 0) | (table > 126)] = -1
+        from_tables[format] = table
+    return to_tables, from_tables
+
+
+TO_PHRED, FROM_PHRED = _build_tables()
+
+
+def _encode(scores, format):
+    '''return character codes for an array of phred scores.'''
+    scores = numpy.asarray(scores, dtype=numpy.int64)
+    if format == "integer":
+        codes = scores
+    elif len(scores) and (scores.min() < 0 or scores.max() > 255):
+        codes = numpy.array([-1])
+    else:
+        codes = FROM_PHRED[format][scores]
+    if len(codes) and (codes.min() < 0 or codes.max() > 255):
+        raise ValueError(
+            "quality scores out of range for format %s" % format)
+    return codes.astype(numpy.uint8)
+
 
 class Record:
     """A record representing a :term:`fastq` formatted record.
@@ -101,36 +200,230 @@ class Record:
     def toPhred(self):
         '''return qualities as a list of phred-scores.'''
         assert self.format is not None, "format needs to be set for conversion"
-        if self.format == "sanger":
-            return [ord(x) - 33 for x in self.quals]
-        elif self.format == "illumina-1.8":
-            return [ord(x) - 33 for x in self.quals]
-        elif self.format == "solexa":
-            # from -5 to 40 (i.e., can be negative)
-            log10x = log(10.0) + .499
-            return [int(10.0 * log(1.0 + 10 ** (ord(x) / 10.0), 10) / log10x)
-                    for x in self.quals]
-        elif self.format == "phred64":
-            return [ord(x) - 64 for x in self.quals]
+        if self.format in TO_PHRED:
+            return TO_PHRED[self.format][numpy.frombuffer(
+                self.quals.encode("ascii"), dtype=numpy.uint8)].tolist()
 
     def fromPhred(self, quals, format):
         '''set qualities from a list of phred-scores.'''
         self.format = format
         # -1 for color space fastq file
         assert len(quals) == len(self.seq) or len(quals) == len(self.seq) - 1
-        if self.format == "sanger":
-            self.quals = "".join([chr(33 + x) for x in quals])
-        elif self.format == "illumina-1.8":
-            return [chr(33 + x) for x in quals]
-        elif self.format == "solexa":
-            log10x = log(10.0, 10) / 10.0
-            q = [int(10.0 * (log(10 ** (x * log10x) - 1.0, 10)))
-                 for x in quals]
-            self.quals = "".join([chr(64 + x) for x in q])
-        elif self.format == "phred64":
-            self.quals = "".join([chr(64 + x) for x in quals])
-        elif self.format == "integer":
+        if self.format == "integer":
             self.quals = " ".join(map(str, quals))
+        else:
+            self.quals = _encode(quals, format).tobytes().decode("ascii")
+
+
+def _gather(data, starts, ends):
+    '''return the concatenation of the ranges *starts*:*ends* in *data*.'''
+    lengths = ends - starts
+    offsets = numpy.cumsum(lengths) - lengths
+    index = numpy.repeat(starts - offsets, lengths) + \
+        numpy.arange(lengths.sum())
+    return data[index]
+
+
+def _sum_ranges(values, starts, ends):
+    '''return the sums of *values* in the ranges *starts*:*ends*.'''
+    totals = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+    numpy.cumsum(values, out=totals[1:])
+    return totals[ends] - totals[starts]
+
+
+class RecordBatch:
+    """A batch of :term:`fastq` formatted records.
+
+    The records are stored in a buffer of bytes shared by all records
+    and are accessed through arrays of offsets. Batches returned by
+    :meth:`select` share the buffer with the original batch.
+
+    Attributes
+    ----------
+    data : numpy.array
+       Buffer (uint8) with identifiers, sequences and quality scores.
+    id_starts, id_ends : numpy.array
+       Offsets of sequence identifiers in `data`.
+    seq_starts, seq_ends : numpy.array
+       Offsets of sequences in `data`.
+    qual_starts, qual_ends : numpy.array
+       Offsets of quality scores in `data`.
+    format : string
+       Quality score format. Can be one of ``sanger``,
+       ``illumina-1.8``, ``solexa``, ``phred64`` or ``integer``.
+       For ``integer``, `data` contains the phred scores.
+
+    """
+
+    def __init__(self, data,
+                 id_starts, id_ends,
+                 seq_starts, seq_ends,
+                 qual_starts, qual_ends,
+                 format=None):
+        self.data = data
+        self.id_starts, self.id_ends = id_starts, id_ends
+        self.seq_starts, self.seq_ends = seq_starts, seq_ends
+        self.qual_starts, self.qual_ends = qual_starts, qual_ends
+        self.format = format
+
+    def __len__(self):
+        return len(self.id_starts)
+
+    def __iter__(self):
+        '''iterate over records as :class:`Record` objects.'''
+        if self.format == "integer":
+            quals = [" ".join(map(str, self.data[x:y].tolist()))
+                     for x, y in zip(self.qual_starts, self.qual_ends)]
+        else:
+            quals = self._getStrings(self.qual_starts, self.qual_ends)
+
+        for identifier, seq, qual in zip(
+                self.getIdentifiers(),
+                self.getSequences(),
+                quals):
+            record = Record(identifier, seq, qual)
+            record.format = self.format
+            yield record
+
+    def _getStrings(self, starts, ends):
+        '''return the ranges *starts*:*ends* as a list of strings.'''
+        if len(starts) == 0:
+            return []
+        data = numpy.concatenate((self.data, LITERALS))
+        newline = len(self.data) + 1
+        starts = numpy.column_stack(
+            (starts, numpy.full(len(starts), newline))).ravel()
+        ends = numpy.column_stack(
+            (ends, numpy.full(len(ends), newline + 1))).ravel()
+        return _gather(data, starts, ends).tobytes().decode(
+            "ascii").split("\n")[:-1]
+
+    def _getMask(self, starts, ends):
+        '''return a boolean array marking the ranges *starts*:*ends*
+        in data.'''
+        counts = numpy.zeros(len(self.data) + 1, dtype=numpy.int32)
+        numpy.add.at(counts, starts, 1)
+        numpy.subtract.at(counts, ends, 1)
+        return numpy.cumsum(counts[:-1]) > 0
+
+    def getIdentifiers(self):
+        '''return a list of sequence identifiers.'''
+        return self._getStrings(self.id_starts, self.id_ends)
+
+    def setIdentifiers(self, identifiers):
+        '''set sequence identifiers from a list of strings.'''
+        assert len(identifiers) == len(self)
+        lengths = numpy.array([len(x) for x in identifiers],
+                              dtype=numpy.int64)
+        buffer = numpy.frombuffer(
+            "".join(identifiers).encode("ascii"), dtype=numpy.uint8)
+        self.id_starts = len(self.data) + numpy.cumsum(lengths) - lengths
+        self.id_ends = self.id_starts + lengths
+        self.data = numpy.concatenate((self.data, buffer))
+
+    def getSequences(self):
+        '''return a list of sequences.'''
+        return self._getStrings(self.seq_starts, self.seq_ends)
+
+    def getLengths(self):
+        '''return an array of sequence lengths.'''
+        return self.seq_ends - self.seq_starts
+
+    def countBases(self, bases="N"):
+        '''return an array with the number of characters in *bases*
+        in each sequence.'''
+        matches = numpy.isin(
+            self.data,
+            numpy.frombuffer(bases.encode("ascii"), dtype=numpy.uint8))
+        return _sum_ranges(matches, self.seq_starts, self.seq_ends)
+
+    def sumQualities(self, values):
+        '''return an array with the sum of *values* over the
+        quality scores of each record.
+
+        *values* is an array aligned with :attr:`data`, for example
+        the result of :meth:`toPhred`.
+        '''
+        return _sum_ranges(values, self.qual_starts, self.qual_ends)
+
+    def select(self, mask):
+        '''return a batch with records selected by the boolean
+        array or index array *mask*.'''
+        return RecordBatch(self.data,
+                           self.id_starts[mask], self.id_ends[mask],
+                           self.seq_starts[mask], self.seq_ends[mask],
+                           self.qual_starts[mask], self.qual_ends[mask],
+                           format=self.format)
+
+    def getFormatMasks(self):
+        '''return an array with a bitmask of compatible quality score
+        formats for each record.
+
+        Bit ``i`` corresponds to the ``i``-th format in
+        :data:`RANGES`.
+        '''
+        if len(self) == 0:
+            return numpy.zeros(0, dtype=numpy.uint8)
+        mask = self._getMask(self.qual_starts, self.qual_ends)
+        minimum = numpy.minimum.reduceat(
+            numpy.where(mask, self.data, 255), self.qual_starts)
+        maximum = numpy.maximum.reduceat(
+            numpy.where(mask, self.data, 0), self.qual_starts)
+        result = numpy.zeros(len(self), dtype=numpy.uint8)
+        for bit, (m1, m2) in enumerate(RANGES.values()):
+            result[(minimum >= m1) & (maximum <= m2)] |= 1 << bit
+        return result
+
+    def guessFormat(self):
+        '''return quality score formats compatible with all records.'''
+        mask = numpy.bitwise_and.reduce(self.getFormatMasks(),
+                                        initial=(1 << len(RANGES)) - 1)
+        return [format for bit, format in enumerate(RANGES)
+                if mask & (1 << bit)]
+
+    def trim(self, trim3, trim5=0):
+        """remove nucleotides/quality scores from the 3' and 5' ends."""
+        for starts, ends in ((self.seq_starts, self.seq_ends),
+                             (self.qual_starts, self.qual_ends)):
+            numpy.minimum(starts + trim5, ends, out=starts)
+            numpy.maximum(ends - trim3, starts, out=ends)
+
+    def trim5(self, trim5=0):
+        """remove nucleotides/quality scores from the 5' ends."""
+        self.trim(0, trim5)
+
+    def toPhred(self):
+        '''return phred scores as an array aligned with :attr:`data`.
+
+        Only positions within quality scores are meaningful.
+        '''
+        assert self.format is not None, "format needs to be set for conversion"
+        if self.format == "integer":
+            return self.data.astype(numpy.int16)
+        return TO_PHRED[self.format][self.data]
+
+    def fromPhred(self, quals, format):
+        '''set quality scores from phred scores in an array aligned
+        with :attr:`data`.'''
+        mask = self._getMask(self.qual_starts, self.qual_ends)
+        self.data[mask] = _encode(quals[mask], format)
+        self.format = format
+
+    def convert(self, format):
+        '''convert quality scores to *format*.'''
+        assert self.format is not None, "format needs to be set for conversion"
+        mask = self._getMask(self.qual_starts, self.qual_ends)
+        codes = self.data[mask]
+        if self.format == "integer":
+            scores = numpy.arange(256)
+        else:
+            scores = TO_PHRED[self.format]
+        # convert the characters present with a lookup table
+        present = numpy.flatnonzero(numpy.bincount(codes, minlength=256))
+        table = numpy.zeros(256, dtype=numpy.uint8)
+        table[present] = _encode(scores[present], format)
+        self.data[mask] = table[codes]
+        self.format = format
 
 
 def iterate(infile):
@@ -298,6 +591,771 @@ def iterate_convert(infile, format, max_tries=10000, guess=None):
         yield r
 
 
+def _parse_block(data):
+    '''parse a buffer of complete fastq records into a
+    :class:`RecordBatch`.'''
+    newlines = numpy.flatnonzero(data == 10)
+    if len(newlines) % 4:
+        raise ValueError("incomplete entry at end of file")
+    starts = numpy.concatenate(([0], newlines[:-1] + 1))
+    headers = starts[0::4]
+    pluses = starts[2::4]
+    invalid = numpy.flatnonzero(data[headers] != ord("@"))
+    if len(invalid):
+        start = headers[invalid[0]]
+        raise ValueError("parsing error: expected '@' in line %s" %
+                         data[start:newlines[invalid[0] * 4]].tobytes())
+    invalid = numpy.flatnonzero(data[pluses] != ord("+"))
+    if len(invalid):
+        start = pluses[invalid[0]]
+        raise ValueError("parsing error: expected '+' in line %s" %
+                         data[start:newlines[invalid[0] * 4 + 2]].tobytes())
+    return RecordBatch(data,
+                       headers + 1, newlines[0::4].copy(),
+                       starts[1::4].copy(), newlines[1::4].copy(),
+                       starts[3::4].copy(), newlines[3::4].copy())
+
+
+def iterate_batches(infile, block_size=BLOCK_SIZE):
+    '''iterate over contents of fastq file in batches of records.
+
+    The file is read in blocks of `block_size` bytes. Each block
+    is parsed into a :class:`RecordBatch`.
+
+    Arguments
+    ---------
+    infile : File
+       File or file-like object to iterate over
+    block_size : int
+       Number of bytes to read at a time.
+
+    Yields
+    ------
+    batch
+        An object of type :class:`RecordBatch`.
+
+    Raises
+    ------
+    ValueError
+        If the file is not a correctly formatted :term:`fastq` file.
+    '''
+    remainder = b""
+    while True:
+        block = infile.read(block_size)
+        if isinstance(block, str):
+            block = block.encode("ascii")
+        if not block:
+            break
+        block = remainder + block
+        data = numpy.frombuffer(block, dtype=numpy.uint8)
+        newlines = numpy.flatnonzero(data == 10)
+        nlines = len(newlines) - len(newlines) % 4
+        if nlines == 0:
+            remainder = block
+            continue
+        end = newlines[nlines - 1] + 1
+        remainder = block[end:]
+        yield _parse_block(data[:end].copy())
+
+    if remainder.strip():
+        if not remainder.endswith(b"\n"):
+            remainder += b"\n"
+        yield _parse_block(
+            numpy.frombuffer(remainder, dtype=numpy.uint8).copy())
+
+
+def _guess_batches(batches, max_tries):
+    '''guess quality score format by looking at the first
+    `max_tries` records in an iterator of batches.
+
+    Returns a tuple with a list of the batches read and the set of
+    compatible formats.
+    '''
+    formats = list(RANGES.keys())
+    popcount = numpy.array([bin(x).count("1") for x in range(256)])
+    state = numpy.uint8((1 << len(formats)) - 1)
+    cache = []
+    nrecords = 0
+    for batch in batches:
+        cache.append(batch)
+        masks = batch.getFormatMasks()[:max_tries + 2 - nrecords]
+        nrecords += len(masks)
+        cumulative = numpy.bitwise_and.accumulate(
+            numpy.concatenate(([state], masks)))
+        decided = numpy.flatnonzero(popcount[cumulative] <= 1)
+        if len(decided):
+            state = cumulative[decided[0]]
+            break
+        state = cumulative[-1]
+        if nrecords >= max_tries + 2:
+            break
+
+    quals = set([format for bit, format in enumerate(formats)
+                 if state & (1 << bit)])
+    if len(quals) == 0:
+        raise ValueError("could not guess format - ranges incompatible.")
+    return cache, quals
+
+
+def iterate_batches_guess(infile, max_tries=10000, guess=None,
+                          block_size=BLOCK_SIZE):
+    '''iterate over contents of fastq file in batches of records.
+
+    Guess quality format by looking at the first `max_tries` entries
+    and set the quality score format of each batch. See
+    :func:`iterate_guess` for the arguments.
+
+    Yields
+    ------
+    batch
+        An object of type :class:`RecordBatch`.
+    '''
+    myiter = iterate_batches(infile, block_size=block_size)
+    cache, quals = _guess_batches(myiter, max_tries)
+
+    if len(quals) == 1:
+        ref_format = list(quals)[0]
+    elif guess in quals:
+        E.warn("multiple input formats possible: %s. Continuing with %s" %
+               (", ".join(quals), guess))
+        ref_format = guess
+    elif quals.issubset(set(["solexa", "phred64"])):
+        ref_format = "phred64"
+    else:
+        raise ValueError(
+            "could not guess format - could be one of %s." % str(quals))
+
+    for batch in cache:
+        batch.format = ref_format
+        yield batch
+
+    for batch in myiter:
+        batch.format = ref_format
+        yield batch
+
+
+def iterate_batches_convert(infile, format, max_tries=10000, guess=None,
+                            block_size=BLOCK_SIZE):
+    '''iterate over contents of fastq file in batches of records.
+
+    The quality score format is guessed and all batches are
+    converted to `format`. See :func:`iterate_convert` for the
+    arguments.
+
+    Yields
+    ------
+    batch
+        An object of type :class:`RecordBatch`.
+    '''
+    myiter = iterate_batches(infile, block_size=block_size)
+    cache, quals = _guess_batches(myiter, max_tries)
+
+    if len(quals) == 1:
+        ref_format = list(quals)[0]
+    elif quals.issubset(set(["solexa", "phred64"])):
+        ref_format = "phred64"
+    elif guess in quals:
+        E.warn("multiple input formats possible: %s. Continuing with %s" %
+               (", ".join(quals), guess))
+        ref_format = guess
+    else:
+        raise ValueError(
+            "could not guess format - could be one of %s. "
+            "If you know the format use the --format option" % str(quals))
+
+    for batch in cache:
+        batch.format = ref_format
+        batch.convert(format)
+        yield batch
+
+    for batch in myiter:
+        batch.format = ref_format
+        batch.convert(format)
+        yield batch
+
+
+def write_batch(outfile, batch):
+    '''write a :class:`RecordBatch` in :term:`fastq` format to
+    *outfile*.'''
+    if len(batch) == 0:
+        return
+
+    if batch.format == "integer":
+        outfile.write("".join(["%s\n" % x for x in batch]))
+        return
+
+    data = numpy.concatenate((batch.data, LITERALS))
+    at = len(batch.data)
+    constant = numpy.full(len(batch), at)
+    starts = numpy.column_stack(
+        (constant, batch.id_starts,
+         constant + 1, batch.seq_starts,
+         constant + 1, batch.qual_starts,
+         constant + 1)).ravel()
+    ends = numpy.column_stack(
+        (constant + 1, batch.id_ends,
+         constant + 2, batch.seq_ends,
+         constant + 4, batch.qual_ends,
+         constant + 2)).ravel()
+    buffer = _gather(data, starts, ends).tobytes()
+    if hasattr(outfile, "encoding"):
+        buffer = buffer.decode("ascii")
+    outfile.write(buffer)
+
+
+def iterate_raw(infile, block_size=BLOCK_SIZE):
+    '''iterate over contents of fastq file returning each record
+    as bytes, including the terminal newline.'''
+    for batch in iterate_batches(infile, block_size=block_size):
+        data = batch.data.tobytes()
+        for start, end in zip((batch.id_starts - 1).tolist(),
+                              (batch.qual_ends + 1).tolist()):
+            yield data[start:end]
+
+
+def get_name(record):
+    '''return the read name of a record in bytes.
+
+    The name is the identifier up to the first white space without
+    a trailing ``/1`` or ``/2``.'''
+    header = record[1:record.index(b"\n")].split(None, 1)
+    if not header:
+        return b""
+    name = header[0]
+    if name.endswith((b"/1", b"/2")):
+        name = name[:-2]
+    return name
+
+
+def get_sequence(record):
+    '''return the sequence of a record in bytes.'''
+    start = record.index(b"\n") + 1
+    return record[start:record.index(b"\n", start)]
+
+
+COMPLEMENT = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+
+
+def get_minimizer(sequence, kmer_size=15):
+    '''return the lexicographically smallest k-mer of *sequence*
+    and its reverse complement.'''
+    if len(sequence) <= kmer_size:
+        return sequence
+    reverse = sequence.translate(COMPLEMENT)[::-1]
+    return min(min(sequence[x:x + kmer_size], reverse[x:x + kmer_size])
+               for x in range(len(sequence) - kmer_size + 1))
+
+
+def _write_run(entries, tmpdir, nfiles):
+    '''write sorted *entries* to temporary files, one per mate.
+
+    Returns a list of filenames.'''
+    filenames = []
+    for x in range(nfiles):
+        with tempfile.NamedTemporaryFile(
+                dir=tmpdir, prefix="fastq_sort", delete=False) as outf:
+            outf.write(b"".join([entry[1][x] for entry in entries]))
+            filenames.append(outf.name)
+    return filenames
+
+
+def _iterate_run(filenames, get_key):
+    '''iterate over a run of sorted records in temporary files.'''
+    infiles = [open(x, "rb", buffering=1024 * 1024) for x in filenames]
+    try:
+        for records in zip(*[iterate_raw(x) for x in infiles]):
+            yield get_key(records), records
+    finally:
+        for infile in infiles:
+            infile.close()
+
+
+def iterate_sorted(infiles, key="name", memory=1024 * 1024 * 1024,
+                   tmpdir=None, kmer_size=15):
+    '''iterate over records of one or more fastq files in sorted
+    order.
+
+    Records of several files (mates in paired data) are read in
+    lockstep and kept together. Sort keys are compared as bytes and
+    the sort is stable. If the records exceed the memory budget, sorted
+    runs are written to temporary files and combined with a k-way
+    merge.
+
+    Arguments
+    ---------
+    infiles : list
+       Files or file-like objects to iterate over.
+    key : string
+       Sort key. ``name`` sorts by read name (see :func:`get_name`),
+       ``sequence`` by the sequence of the first file and
+       ``minimizer`` by the minimizer (see :func:`get_minimizer`)
+       and then the sequence of the first file. Sorting by sequence
+       groups similar reads and improves compression.
+    memory : int
+       Approximate memory budget in bytes.
+    tmpdir : string
+       Directory for temporary files. The default is the system
+       default.
+    kmer_size : int
+       k-mer size for minimizers.
+
+    Yields
+    ------
+    records
+        A tuple with a record of each file as bytes.
+
+    Raises
+    ------
+    ValueError
+        If the files have different numbers of records or names
+        of records in different files differ.
+    '''
+
+    if key == "name":
+        def get_key(records):
+            return get_name(records[0])
+    elif key == "sequence":
+        def get_key(records):
+            return get_sequence(records[0])
+    elif key == "minimizer":
+        def get_key(records):
+            sequence = get_sequence(records[0])
+            return get_minimizer(sequence, kmer_size) + b"\t" + sequence
+    else:
+        raise ValueError("unknown sort key '%s'" % key)
+
+    sentinel = object()
+    runs = []
+    entries = []
+    size = 0
+    try:
+        for records in itertools.zip_longest(
+                *[iterate_raw(x) for x in infiles], fillvalue=sentinel):
+            if sentinel in records:
+                raise ValueError("files have different numbers of records")
+            if len(records) > 1:
+                name = get_name(records[0])
+                for record in records[1:]:
+                    if get_name(record) != name:
+                        raise ValueError(
+                            "records out of order: %s and %s" %
+                            (name, get_name(record)))
+            entry = (get_key(records), records)
+            entries.append(entry)
+            # approximate size including python object overhead
+            size += sum(map(len, records)) + len(entry[0]) + \
+                100 * (len(records) + 1)
+            if size >= memory:
+                entries.sort(key=lambda x: x[0])
+                runs.append(_write_run(entries, tmpdir, len(infiles)))
+                E.debug("wrote run %i with %i records" %
+                        (len(runs), len(entries)))
+                entries, size = [], 0
+
+        entries.sort(key=lambda x: x[0])
+        if not runs:
+            for entry in entries:
+                yield entry[1]
+            return
+
+        if entries:
+            runs.append(_write_run(entries, tmpdir, len(infiles)))
+        entries = None
+        E.debug("merging %i runs" % len(runs))
+        for entry in heapq.merge(
+                *[_iterate_run(x, get_key) for x in runs],
+                key=lambda x: x[0]):
+            yield entry[1]
+    finally:
+        for filenames in runs:
+            for filename in filenames:
+                os.unlink(filename)
+
+
+def _read_records(infiles):
+    '''read the next record from each of *infiles*.
+
+    Returns a tuple of records as strings or None at the end of the
+    files. The header line after the ``+`` is removed.
+    '''
+    records = []
+    for infile in infiles:
+        lines = list(itertools.islice(infile, 4))
+        if not lines:
+            records.append(None)
+            continue
+        if len(lines) < 4 or not lines[0].startswith("@") or \
+           not lines[2].startswith("+"):
+            raise ValueError(
+                "parsing error: expected a fastq record, got %s" % lines)
+        records.append("%s%s+\n%s\n" % (
+            lines[0], lines[1], lines[3].rstrip("\r\n")))
+
+    if None in records:
+        if any(records):
+            raise ValueError("files have different numbers of records")
+        return None
+    return tuple(records)
+
+
+def _skip_records(infiles, nrecords):
+    '''skip *nrecords* records in each of *infiles* without
+    parsing them. If *nrecords* is None, all records are skipped.
+
+    Returns the number of records skipped in the first file.
+    '''
+    nlines = None if nrecords is None else 4 * nrecords
+    skipped = collections.deque(
+        enumerate(itertools.islice(infiles[0], nlines), 1), maxlen=1)
+    for infile in infiles[1:]:
+        collections.deque(itertools.islice(infile, nlines), maxlen=0)
+    return skipped[0][0] // 4 if skipped else 0
+
+
+def iterate_sample_skip(infiles, proportion, counter=None, rng=random):
+    '''iterate over a random sample of records in one or more
+    fastq files.
+
+    Each record is sampled independently with probability
+    *proportion*. Instead of drawing a random number for each record,
+    the number of records between sampled records is drawn from a
+    geometric distribution and these records are skipped without
+    parsing them.
+
+    Arguments
+    ---------
+    infiles : list
+       Files to sample from. Records of several files (mates in paired
+       data) are sampled together.
+    proportion : float
+       Proportion of records to sample.
+    counter : Counter
+       If given, ``counter.input`` is incremented by the number of
+       records in the files.
+    rng : object
+       Random number generator with the interface of :mod:`random`.
+
+    Yields
+    ------
+    records
+        A tuple with a record of each file as a string.
+    '''
+    ninput = 0
+    if proportion <= 0:
+        ninput = _skip_records(infiles, None)
+    else:
+        log_q = log1p(-proportion) if proportion < 1 else None
+        while True:
+            if log_q is not None:
+                ninput += _skip_records(
+                    infiles, int(log(1.0 - rng.random()) / log_q))
+            records = _read_records(infiles)
+            if records is None:
+                break
+            ninput += 1
+            yield records
+
+    if counter is not None:
+        counter.input += ninput
+
+
+def sample_reservoir(infiles, size, counter=None, rng=random):
+    '''return a random sample of exactly *size* records from one
+    or more fastq files.
+
+    Records are sampled with reservoir sampling (algorithm L, Li
+    1994). The number of records to skip before the next record
+    enters the reservoir is drawn from a geometric distribution and
+    skipped records are not parsed. If the files contain fewer than
+    *size* records, all records are returned.
+
+    Arguments
+    ---------
+    infiles : list
+       Files to sample from. Records of several files (mates in paired
+       data) are sampled together.
+    size : int
+       Number of records to sample.
+    counter : Counter
+       If given, ``counter.input`` is incremented by the number of
+       records in the files.
+    rng : object
+       Random number generator with the interface of :mod:`random`.
+
+    Returns
+    -------
+    records : list
+        A list of tuples with a record of each file as a string.
+        Records are in the order of the input.
+    '''
+    reservoir = []
+    ninput = 0
+    while ninput < size:
+        records = _read_records(infiles)
+        if records is None:
+            break
+        reservoir.append((ninput, records))
+        ninput += 1
+
+    if size > 0 and ninput == size:
+        w = exp(log(1.0 - rng.random()) / size)
+        while True:
+            if w < 1.0:
+                ninput += _skip_records(
+                    infiles, int(log(1.0 - rng.random()) / log1p(-w)))
+            records = _read_records(infiles)
+            if records is None:
+                break
+            reservoir[rng.randrange(size)] = (ninput, records)
+            ninput += 1
+            w *= exp(log(1.0 - rng.random()) / size)
+    elif size <= 0:
+        ninput += _skip_records(infiles, None)
+
+    if counter is not None:
+        counter.input += ninput
+
+    reservoir.sort(key=lambda x: x[0])
+    return [x[1] for x in reservoir]
+
+
+def hash_name(name):
+    '''return a 64-bit hash of read *name* as 8 bytes.'''
+    return hashlib.blake2b(name, digest_size=8).digest()
+
+
+def _map_array(filename, dtype, offset, size):
+    '''return a read-only memory map of *size* elements in *filename*.'''
+    if size == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode="r",
+                        offset=offset, shape=(size,))
+
+
+class FastqIndex:
+    """An on-disk index of the sequences and quality scores in a
+    :term:`fastq` file.
+
+    The index maps 64-bit hashes of read names (the identifier up to
+    the first white space) to records. Sequences and quality scores
+    are stored in zlib-compressed blocks. Hashes and the positions of
+    records are sorted by hash and memory-mapped, so that the index
+    can be opened quickly and shared between processes. Decompressed
+    blocks are kept in a cache of *cache_size* blocks.
+
+    Use :meth:`build` to create an index.
+    """
+
+    def __init__(self, filename, cache_size=256):
+        self.filename = filename
+        with open(filename, "rb") as inf:
+            header = inf.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size or \
+           header[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError("%s is not a fastq index" % filename)
+        magic, nrecords, nblocks = INDEX_HEADER.unpack(header)
+        offset = INDEX_HEADER.size
+        self.keys = _map_array(filename, "<u8", offset, nrecords)
+        offset += 8 * nrecords
+        self.positions = _map_array(filename, "<u8", offset, nrecords)
+        offset += 8 * nrecords
+        self.blocks = _map_array(filename, "<u8", offset, nblocks + 1)
+        self.data_offset = offset + 8 * (nblocks + 1)
+        self.infile = open(filename, "rb")
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        self.infile.close()
+
+    @classmethod
+    def build(cls, infile, filename, block_size=INDEX_BLOCK_SIZE):
+        '''build an index of the records in *infile* and save it
+        to *filename*.
+
+        Raises
+        ------
+        ValueError
+            If read names are not unique.
+        '''
+        keys, positions = [], []
+        total, nblocks = 0, 0
+        # current block: window number, position of first record and
+        # chunks of data
+        current, block_start, pending = -1, 0, []
+
+        tmpdir = os.path.dirname(os.path.abspath(filename))
+        with tempfile.NamedTemporaryFile(dir=tmpdir, prefix="fastq_index",
+                                         delete=False) as datafile:
+            block_offsets = [0]
+
+            def flush():
+                datafile.write(zlib.compress(b"".join(pending)))
+                block_offsets.append(datafile.tell())
+
+            try:
+                for batch in iterate_batches(infile):
+                    keys.append(numpy.frombuffer(b"".join(
+                        [hash_name(x.split(None, 1)[0].encode("ascii"))
+                         for x in batch.getIdentifiers()]), dtype="<u8"))
+
+                    # records are stored as "sequence\nquality\n"
+                    lengths = (batch.seq_ends + 1 - batch.seq_starts) + \
+                        (batch.qual_ends + 1 - batch.qual_starts)
+                    chunk = _gather(
+                        batch.data,
+                        numpy.column_stack((batch.seq_starts,
+                                            batch.qual_starts)).ravel(),
+                        numpy.column_stack((batch.seq_ends + 1,
+                                            batch.qual_ends + 1)).ravel()
+                    ).tobytes()
+
+                    # a new block starts at the first record in each
+                    # window of block_size bytes
+                    starts = total + numpy.cumsum(lengths) - lengths
+                    windows = starts // block_size
+                    is_new = windows != numpy.concatenate(
+                        ([current], windows[:-1]))
+                    blocks = nblocks + numpy.cumsum(is_new) - \
+                        (1 if current < 0 else 0)
+                    first = numpy.maximum.accumulate(
+                        numpy.where(is_new, starts, -1))
+                    first[first < 0] = block_start
+                    positions.append(
+                        (blocks.astype(numpy.uint64) << numpy.uint64(32)) |
+                        (starts - first).astype(numpy.uint64))
+
+                    last = 0
+                    for x in numpy.flatnonzero(is_new).tolist():
+                        cut = int(starts[x] - total)
+                        pending.append(chunk[last:cut])
+                        if current >= 0:
+                            flush()
+                            nblocks += 1
+                        pending = []
+                        current, block_start, last = \
+                            int(windows[x]), int(starts[x]), cut
+                    pending.append(chunk[last:])
+                    total += len(chunk)
+
+                if current >= 0:
+                    flush()
+                    nblocks += 1
+
+                if keys:
+                    keys = numpy.concatenate(keys)
+                    positions = numpy.concatenate(positions)
+                else:
+                    keys = numpy.zeros(0, dtype="<u8")
+                    positions = numpy.zeros(0, dtype="<u8")
+                order = numpy.argsort(keys, kind="stable")
+                keys, positions = keys[order], positions[order]
+                nduplicates = numpy.count_nonzero(keys[1:] == keys[:-1])
+                if nduplicates:
+                    raise ValueError(
+                        "%i duplicate read names - can not index" %
+                        nduplicates)
+
+                datafile.flush()
+                tmpfilename = "%s.%i.tmp" % (filename, os.getpid())
+                with open(tmpfilename, "wb") as outf:
+                    outf.write(INDEX_HEADER.pack(
+                        INDEX_MAGIC, len(keys), nblocks))
+                    keys.astype("<u8").tofile(outf)
+                    positions.astype("<u8").tofile(outf)
+                    numpy.array(block_offsets, dtype="<u8").tofile(outf)
+                    with open(datafile.name, "rb") as inf:
+                        shutil.copyfileobj(inf, outf)
+                os.rename(tmpfilename, filename)
+            finally:
+                os.unlink(datafile.name)
+
+        return cls(filename)
+
+    def _getBlock(self, block):
+        '''return decompressed data of *block*.'''
+        try:
+            self.cache.move_to_end(block)
+            return self.cache[block]
+        except KeyError:
+            pass
+        start, end = int(self.blocks[block]), int(self.blocks[block + 1])
+        self.infile.seek(self.data_offset + start)
+        data = zlib.decompress(self.infile.read(end - start))
+        self.cache[block] = data
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return data
+
+    def fetch(self, names):
+        '''return sequences and quality scores of reads.
+
+        Records are read in the order they are stored in the
+        index, so that each block is decompressed at most once per
+        call for batches smaller than the cache.
+
+        Arguments
+        ---------
+        names : list
+           Read names.
+
+        Returns
+        -------
+        records : list
+            A list of tuples (sequence, quality) in the order of `names`.
+
+        Raises
+        ------
+        KeyError
+            If a read name is not in the index.
+        '''
+        if not names:
+            return []
+        keys = numpy.frombuffer(b"".join(
+            [hash_name(x.encode("ascii")) for x in names]), dtype="<u8")
+        index = numpy.searchsorted(self.keys, keys)
+        index[index >= len(self.keys)] = 0
+        missing = numpy.flatnonzero(self.keys[index] != keys) \
+            if len(self.keys) else numpy.arange(len(keys))
+        if len(missing):
+            raise KeyError(names[missing[0]])
+
+        positions = self.positions[index]
+        order = numpy.argsort(positions, kind="stable")
+        result = [None] * len(names)
+        for x, position in zip(order.tolist(), positions[order].tolist()):
+            data = self._getBlock(position >> 32)
+            start = position & 0xffffffff
+            end = data.index(b"\n", start)
+            result[x] = (data[start:end].decode("ascii"),
+                         data[end + 1:data.index(b"\n", end + 1)].decode(
+                             "ascii"))
+        return result
+
+
+def open_index(filename, index_filename=None):
+    '''return a :class:`FastqIndex` of the :term:`fastq` file
+    *filename*.
+
+    An existing index in *index_filename* is used if it is newer
+    than *filename*. Otherwise the index is built. The default
+    filename of the index is *filename* with the suffix ``.fqi``.
+    '''
+    if index_filename is None:
+        index_filename = filename + ".fqi"
+    if os.path.exists(index_filename) and \
+       os.path.getmtime(index_filename) >= os.path.getmtime(filename):
+        E.info("using fastq index %s" % index_filename)
+        return FastqIndex(index_filename)
+
+    E.info("building fastq index %s" % index_filename)
+    with iotools.open_file(filename) as infile:
+        return FastqIndex.build(infile, index_filename)
+
+
 def guessFormat(infile, max_lines=10000, raises=True):
     '''guess format of FASTQ File.
 
@@ -1,46 +1,231 @@
-"""Utility functions for the bam2stats utility."""
+"""Utility functions for fastq files."""
 
-import collections
+import concurrent.futures
+import itertools
 
 import pysam
 from pysam.libchtslib cimport *
-from pysam.libcbcf cimport VariantFile, VariantRecord, VariantRecordSample
-from pysam.libcfaidx cimport FastxFile, FastqProxy
-from pysam.libctabix cimport TabixFile
-from libc.string cimport strchr
-from libc.stdint cimport int8_t
-from libc.stdio cimport puts, printf
-from cpython cimport array as c_array
+from pysam.libcfaidx cimport FastxFile
+from libc.stdint cimport uint8_t, uint32_t, uint64_t, int64_t
+from libc.stdlib cimport calloc, free
 
 import cgatcore.experiment as E
 from cgat.Genomics import reverse_complement
 import numpy
 cimport numpy
-DTYPE = numpy.uint32
-ctypedef numpy.uint32_t DTYPE_t
-
-cdef count_diagonals(sequence,
-                     forward_hash,
-                     reverse_hash,
-                     uint32_t query_sequence_length,
-                     uint32_t kmer_size):
-    cdef uint32_t x, count
-    cdef uint32_t offset = len(sequence)
-    cdef uint32_t l = len(sequence) + query_sequence_length
-    cdef numpy.ndarray[DTYPE_t, ndim=1] forward_counts = numpy.zeros(l, dtype=DTYPE)
-    cdef numpy.ndarray[DTYPE_t, ndim=1] reverse_counts = numpy.zeros(l, dtype=DTYPE)
-    
-    for x from 0 <= x < len(sequence) - kmer_size:
-        kmer = sequence[x: x + kmer_size]
-        if kmer in forward_hash:
-            for count in forward_hash[kmer]:
-                forward_counts[count - x + offset] += 1
-
-        if kmer in reverse_hash:
-            for count in reverse_hash[kmer]:
-                reverse_counts[count - x + offset] += 1
-
-    return forward_counts.max(), reverse_counts.max()
+cimport cython
+
+# number of bits of the k-mer pre-filter
+cdef enum:
+    FILTER_BITS = 20
+
+# 2-bit codes of nucleotides, 4 for all other characters
+cdef uint8_t NUCLEOTIDE_CODES[256]
+for _x in range(256):
+    NUCLEOTIDE_CODES[_x] = 4
+for _x, _c in enumerate(b"ACGT"):
+    NUCLEOTIDE_CODES[_c] = _x
+    NUCLEOTIDE_CODES[_c + 32] = _x
+
+
+cdef inline uint64_t filter_slot(uint64_t key) nogil:
+    return (key * <uint64_t>0x9E3779B97F4A7C15) >> (64 - FILTER_BITS)
+
+
+cdef class KmerMatcher:
+    '''match sequences against one or more query sequences.
+
+    Matches are counted as the number of k-mers a sequence shares with
+    a query sequence on the same diagonal, i.e., at the same offset
+    between the k-mer positions in the two sequences. Both strands of
+    each query sequence are considered and the score of a sequence is
+    the highest count on any diagonal.
+
+    K-mers are packed into 64-bit integers with 2 bits per nucleotide
+    and k-mers containing characters other than ``ACGT`` are
+    ignored. The query k-mers are kept in a sorted array with a bit
+    mask as a pre-filter. The k-mers of a sequence are computed with a
+    rolling encoding over its bytes.
+    '''
+
+    cdef readonly uint32_t kmer_size
+    cdef uint64_t mask
+    cdef readonly int64_t nregions
+    cdef readonly int64_t query_length
+    cdef const uint64_t[:] keys
+    cdef const int64_t[:] offsets
+    cdef const int64_t[:] regions
+    cdef uint8_t[:] bitfilter
+
+    def __init__(self, query_sequences, uint32_t kmer_size=10):
+        if kmer_size < 1 or kmer_size > 32:
+            raise ValueError("kmer size needs to be between 1 and 32")
+        if isinstance(query_sequences, str):
+            query_sequences = [query_sequences]
+
+        self.kmer_size = kmer_size
+        self.mask = (<uint64_t>-1) >> (64 - 2 * kmer_size)
+
+        keys, offsets, regions = [], [], []
+        self.nregions = 0
+        self.query_length = 0
+        for query_sequence in query_sequences:
+            query_sequence = query_sequence.upper()
+            for sequence in (query_sequence,
+                             reverse_complement(query_sequence)):
+                # diagonals of each strand of each query are counted
+                # in separate regions of the count buffer
+                for x, key in self._iterate_kmers(
+                        sequence.encode("ascii")):
+                    keys.append(key)
+                    offsets.append(self.query_length + x)
+                    regions.append(self.nregions)
+                self.nregions += 1
+                self.query_length += len(sequence)
+
+        keys = numpy.array(keys, dtype=numpy.uint64)
+        order = numpy.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)[order]
+        self.regions = numpy.array(regions, dtype=numpy.int64)[order]
+
+        self.bitfilter = numpy.zeros(1 << FILTER_BITS, dtype=numpy.uint8)
+        cdef Py_ssize_t i
+        for i in range(self.keys.shape[0]):
+            self.bitfilter[filter_slot(self.keys[i])] = 1
+
+    def _iterate_kmers(self, bytes sequence):
+        '''iterate over k-mers in *sequence* yielding tuples of
+        position and key.
+
+        The last k-mer is not included.
+        '''
+        cdef uint64_t key = 0
+        cdef uint32_t valid = 0
+        cdef int64_t x
+        cdef uint8_t code
+        for x in range(len(sequence) - 1):
+            code = NUCLEOTIDE_CODES[<uint8_t>sequence[x]]
+            if code > 3:
+                key, valid = 0, 0
+                continue
+            key = ((key << 2) | code) & self.mask
+            valid += 1
+            if valid >= self.kmer_size:
+                yield x - self.kmer_size + 1, key
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef uint32_t _score(self,
+                         const uint8_t * sequence,
+                         int64_t length,
+                         int64_t capacity,
+                         uint32_t * counts) nogil:
+        '''return the highest diagonal count of *sequence*.
+
+        *counts* is a buffer of size ``query_length + nregions *
+        capacity``, where *capacity* is at least *length*. The buffer
+        needs to be zero and is reset before returning.
+        '''
+        cdef Py_ssize_t nkeys = self.keys.shape[0]
+        cdef uint64_t key
+        cdef uint32_t valid, best = 0
+        cdef uint8_t code
+        cdef int64_t x, i, idx
+        cdef Py_ssize_t lower, upper, middle
+        cdef int reset
+
+        for reset in range(2):
+            key, valid = 0, 0
+            for i in range(length - 1):
+                code = NUCLEOTIDE_CODES[sequence[i]]
+                if code > 3:
+                    key, valid = 0, 0
+                    continue
+                key = ((key << 2) | code) & self.mask
+                valid += 1
+                if valid < self.kmer_size or \
+                   not self.bitfilter[filter_slot(key)]:
+                    continue
+
+                lower, upper = 0, nkeys
+                while lower < upper:
+                    middle = (lower + upper) // 2
+                    if self.keys[middle] < key:
+                        lower = middle + 1
+                    else:
+                        upper = middle
+
+                x = i - self.kmer_size + 1
+                while lower < nkeys and self.keys[lower] == key:
+                    idx = (self.offsets[lower] +
+                           (self.regions[lower] + 1) * capacity - x)
+                    if reset:
+                        counts[idx] = 0
+                    else:
+                        counts[idx] += 1
+                        if counts[idx] > best:
+                            best = counts[idx]
+                    lower += 1
+        return best
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def score_batch(self, const uint8_t[:] data,
+                    const int64_t[:] starts,
+                    const int64_t[:] ends):
+        '''return the scores of sequences in *data*.
+
+        Sequence *i* is the slice ``starts[i]:ends[i]`` of *data*. The
+        global interpreter lock is released while computing scores.
+        '''
+        cdef Py_ssize_t nsequences = starts.shape[0]
+        cdef numpy.ndarray[uint32_t, ndim=1] result = numpy.zeros(
+            nsequences, dtype=numpy.uint32)
+        cdef uint32_t[:] scores = result
+        cdef int64_t capacity = 0
+        cdef Py_ssize_t x
+        for x in range(nsequences):
+            capacity = max(capacity, ends[x] - starts[x])
+        if nsequences == 0:
+            return result
+
+        cdef uint32_t * counts = <uint32_t *>calloc(
+            self.query_length + self.nregions * capacity, sizeof(uint32_t))
+        if counts == NULL:
+            raise MemoryError("could not allocate count buffer")
+        try:
+            with nogil:
+                for x in range(nsequences):
+                    scores[x] = self._score(&data[starts[x]],
+                                            ends[x] - starts[x],
+                                            capacity,
+                                            counts)
+        finally:
+            free(counts)
+        return result
+
+    def score(self, sequences, executor=None, uint32_t chunk_size=1000):
+        '''return the scores of a list of *sequences*.
+
+        If *executor* is given, chunks of *chunk_size* sequences are
+        scored in parallel.
+        '''
+        data = numpy.frombuffer(
+            "".join(sequences).encode("ascii"), dtype=numpy.uint8)
+        lengths = numpy.array([len(x) for x in sequences], dtype=numpy.int64)
+        ends = numpy.cumsum(lengths)
+        starts = ends - lengths
+        if executor is None:
+            return self.score_batch(data, starts, ends)
+
+        chunks = [executor.submit(self.score_batch, data,
+                                  starts[x:x + chunk_size],
+                                  ends[x:x + chunk_size])
+                  for x in range(0, len(sequences), chunk_size)]
+        return numpy.concatenate(
+            [numpy.zeros(0, dtype=numpy.uint32)] +
+            [x.result() for x in chunks])
 
 
 def filter_by_sequence(
@@ -52,54 +237,61 @@ def filter_by_sequence(
         outf_unmatched1,
         outf_unmatched2,
         uint32_t kmer_size=10,
-        uint32_t min_kmer_matches=20):
+        uint32_t min_kmer_matches=20,
+        num_threads=1,
+        batch_size=100000):
+    '''split read pairs by whether they match *query_sequence*.
+
+    *query_sequence* can be a single sequence or a list of
+    sequences. A pair matches if either read has more than
+    *min_kmer_matches* k-mers on the same diagonal with a query
+    sequence, see :class:`KmerMatcher`.
 
-    _query_sequence = query_sequence.encode("ascii")
-    reverse_sequence = reverse_complement(query_sequence)
-    cdef uint32_t query_sequence_length = len(query_sequence)
-    cdef uint32_t x
-    cdef char * s = _query_sequence
+    Pairs are processed in batches of *batch_size* pairs. Batches are
+    scored with *num_threads* threads.
+    '''
 
-    forward_hash = collections.defaultdict(list)
-    reverse_hash = collections.defaultdict(list)
-    for x from 0 <= x < query_sequence_length - kmer_size:
-        forward_hash[query_sequence[x:x + kmer_size]].append(x)
-        reverse_hash[reverse_sequence[x: x + kmer_size]].append(x)
+    matcher = KmerMatcher(query_sequence, kmer_size)
+    if num_threads > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+    else:
+        executor = None
 
-    cdef FastqProxy read1, read2
     cdef uint32_t ninput = 0
     cdef uint32_t nmatched = 0
     cdef uint32_t nunmatched = 0
-    cdef uint32_t fc1, rc1, fc2, rc2
-
-    for read1, read2 in zip(in_stream1, in_stream2):
-    
-        fc1, rc1 = count_diagonals(
-            read1.sequence,
-            forward_hash,
-            reverse_hash,
-            query_sequence_length,
-            kmer_size)
-        fc2, rc2 = count_diagonals(
-            read2.sequence,
-            forward_hash,
-            reverse_hash,
-            query_sequence_length,
-            kmer_size)
-
-        if max(fc1, rc1, fc2, rc2) > min_kmer_matches:
-            nmatched += 1
-            outf_matched1.write(str(read1) + "\n")
-            outf_matched2.write(str(read2) + "\n")
-        else:
-            nunmatched += 1
-            outf_unmatched1.write(str(read1) + "\n")
-            outf_unmatched2.write(str(read2) + "\n")
-        
-        ninput += 1
-        if ninput % 1000 == 0:
+
+    pairs = zip(in_stream1, in_stream2)
+    try:
+        while True:
+            records, sequences = [], []
+            for read1, read2 in itertools.islice(pairs, batch_size):
+                records.append((str(read1), str(read2)))
+                sequences.append(read1.sequence)
+                sequences.append(read2.sequence)
+            if not records:
+                break
+
+            scores = matcher.score(sequences, executor)
+            is_matched = numpy.maximum(
+                scores[0::2], scores[1::2]) > min_kmer_matches
+
+            for (record1, record2), matched in zip(records, is_matched):
+                if matched:
+                    outf_matched1.write(record1 + "\n")
+                    outf_matched2.write(record2 + "\n")
+                else:
+                    outf_unmatched1.write(record1 + "\n")
+                    outf_unmatched2.write(record2 + "\n")
+
+            ninput += len(records)
+            nmatched += is_matched.sum()
+            nunmatched = ninput - nmatched
             E.info("iteration: {}, matched={}, unmatched={}, permille_matched={}".format(
                 ninput, nmatched, nunmatched, 1000.0 * nmatched / ninput))
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     c = E.Counter()
     c.input = ninput
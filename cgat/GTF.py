@@ -7,9 +7,12 @@ according to http://www.sanger.ac.uk/Software/formats/GFF/.
 
 The default GTF version is 2.2.
 
-This module uses pysam_ to provide the principal engine for iterating over
-files (:func:`iterate`). As a consequence, the returned objects are of
-type :func:`pysam.GTFProxy`.
+Files are iterated over with the compiled parser in
+:mod:`cgat.GTFTools` (:func:`iterator`). The returned objects are of
+type :class:`cgat.GTFTools.GTFRecord`, which provides the same interface
+as :class:`pysam.GTFProxy`. Only the fixed columns and the ``gene_id``
+and ``transcript_id`` attributes are parsed when a record is read,
+other attributes are decoded on first access.
 
 The class defined in this model :class:`Entry` is useful for re-formatting
 records.
@@ -36,16 +39,36 @@ Apart from basic iteration, this module provides the following utilities:
 """
 
 import collections
+import heapq
+import os
+import struct
+import tempfile
 from cgat import Intervals as Intervals
 from cgat import Genomics as Genomics
 from cgat import IndexedGenome as IndexedGenome
+from cgat import GTFTools as GTFTools
 import pysam
 from cgatcore import iotools as iotools
 
 
-def iterator(infile):
-    """return a simple iterator over all entries in a file."""
-    return pysam.tabix_iterator(infile, pysam.asGTF())
+def iterator(infile, engine="cgat"):
+    """return a simple iterator over all entries in a file.
+
+    Arguments
+    ---------
+    infile : File
+       File to read from.
+    engine : string
+       Parser to use. ``cgat`` returns records of type
+       :class:`cgat.GTFTools.GTFRecord`, ``pysam`` returns records of
+       type :class:`pysam.GTFProxy`.
+    """
+    if engine == "cgat":
+        return GTFTools.iterator(infile)
+    elif engine == "pysam":
+        return pysam.tabix_iterator(infile, pysam.asGTF())
+    else:
+        raise ValueError("unknown engine '%s'" % engine)
 
 
 def track_iterator(infile):
@@ -331,31 +354,165 @@ def iterator_min_feature_length(gff_iterator, min_length, feature="exon"):
             yield gffs
 
 
-def iterator_sorted(gff_iterator, sort_order="gene"):
-    '''sort input and yield sorted output.'''
-    entries = list(gff_iterator)
-    if sort_order == "gene":
-        entries.sort(key=lambda x: (x.gene_id, x.contig, x.start))
+# fixed width encoding of integers in sort keys, offset so that
+# negative numbers sort first
+SORT_KEY_INT = struct.Struct(">Q")
+SORT_KEY_OFFSET = 1 << 63
+
+
+def encode_sort_key(*values):
+    '''pack *values* into a byte string.
+
+    Byte strings compare in the same order as the tuple of values.
+    Integers are encoded with a fixed width and strings are terminated
+    by a null byte. Integers sort before strings.
+    '''
+    key = []
+    for value in values:
+        if isinstance(value, str):
+            key.append(b"\x02" + value.encode() + b"\x00")
+        else:
+            key.append(b"\x01" + SORT_KEY_INT.pack(value + SORT_KEY_OFFSET))
+    return b"".join(key)
+
+
+def _write_run(gffs, tmpdir):
+    '''write *gffs* to a temporary file and return the filename.'''
+    with tempfile.NamedTemporaryFile(
+            "w", dir=tmpdir, prefix="gtf_sort", delete=False) as outf:
+        for gff in gffs:
+            outf.write("%s\n" % str(gff))
+        return outf.name
+
+
+def _iterate_run(filename):
+    '''iterate over the records in a temporary file.'''
+    with open(filename, buffering=1024 * 1024) as infile:
+        for gff in iterator(infile):
+            yield gff
+
+
+def _split_runs(gff_iterator, runs, memory, tmpdir, get_key=None):
+    '''split records into runs within the memory budget.
+
+    If *get_key* is given, the records in each run are sorted. Runs
+    are written to temporary files if the records do not fit into
+    memory and the filenames are appended to *runs*.
+
+    Returns the list of records if all records fit into memory,
+    otherwise None.
+    '''
+    gffs, size = [], 0
+    for gff in gff_iterator:
+        gffs.append(gff)
+        # approximate size including python object overhead
+        size += len(gff.attributes) + 600
+        if size >= memory:
+            if get_key:
+                gffs.sort(key=get_key)
+            runs.append(_write_run(gffs, tmpdir))
+            gffs, size = [], 0
+
+    if get_key:
+        gffs.sort(key=get_key)
+    if not runs:
+        return gffs
+    if gffs:
+        runs.append(_write_run(gffs, tmpdir))
+    return None
+
+
+def _sort_external(gff_iterator, get_key, memory, tmpdir):
+    '''sort records with an external merge sort.'''
+    runs = []
+    try:
+        gffs = _split_runs(gff_iterator, runs, memory, tmpdir, get_key)
+        if gffs is None:
+            gffs = heapq.merge(*[_iterate_run(x) for x in runs],
+                               key=get_key)
+        for gff in gffs:
+            yield gff
+    finally:
+        for filename in runs:
+            os.unlink(filename)
+
+
+def iterator_sorted(gff_iterator, sort_order="gene",
+                    memory=1024 * 1024 * 1024, tmpdir=None):
+    '''sort input and yield sorted output.
+
+    Records are sorted by packed byte keys (see
+    :func:`encode_sort_key`) and the sort is stable. If the records
+    exceed the memory budget, sorted runs are written to temporary
+    files and combined with a k-way merge. Records read back from
+    temporary files are of type :class:`GTFTools.GTFRecord`.
+
+    Arguments
+    ---------
+    gff_iterator : iterator
+       Iterator yielding GTF records.
+    sort_order : string
+       Sort order, see :doc:`tools/gtf2gtf` for a description.
+    memory : int
+       Approximate memory budget in bytes.
+    tmpdir : string
+       Directory for temporary files. The default is the system
+       default.
+    '''
+
+    if sort_order in ("gene", "gene+position"):
+        def get_key(x):
+            return encode_sort_key(x.gene_id, x.contig, x.start)
     elif sort_order == "gene+transcript":
-        entries.sort(
-            key=lambda x: (x.gene_id, x.transcript_id, x.contig, x.start))
+        def get_key(x):
+            return encode_sort_key(x.gene_id, x.transcript_id,
+                                   x.contig, x.start)
     elif sort_order == "contig+gene":
-        entries.sort(
-            key=lambda x: (x.contig, x.gene_id, x.transcript_id, x.start))
+        def get_key(x):
+            return encode_sort_key(x.contig, x.gene_id,
+                                   x.transcript_id, x.start)
     elif sort_order == "transcript":
-        entries.sort(key=lambda x: (x.transcript_id, x.contig, x.start))
+        def get_key(x):
+            return encode_sort_key(x.transcript_id, x.contig, x.start)
     elif sort_order == "position":
-        entries.sort(key=lambda x: (x.contig, x.start))
+        def get_key(x):
+            return encode_sort_key(x.contig, x.start)
     elif sort_order == "position+gene":
-        entries.sort(key=lambda x: (x.gene_id, x.start))
-        genes = list(flat_gene_iterator(entries))
-        genes.sort(key=lambda x: (x[0].contig, x[0].start))
-        entries = iotools.flatten(genes)
+        # genes are sorted by the position of their first feature,
+        # which is known only after a first pass over the data.
+        genes = {}
+
+        def collect_genes(gffs):
+            for gff in gffs:
+                gene = genes.get(gff.gene_id, None)
+                if gene is None or gff.start < gene[1]:
+                    genes[gff.gene_id] = (gff.contig, gff.start)
+                yield gff
+
+        def get_key(x):
+            contig, start = genes[x.gene_id]
+            return encode_sort_key(contig, start, x.gene_id, x.start)
+
+        runs = []
+        try:
+            gffs = _split_runs(collect_genes(gff_iterator), runs,
+                               memory, tmpdir)
+            if gffs is None:
+                gffs = (gff for x in runs for gff in _iterate_run(x))
+            for gff in _sort_external(gffs, get_key, memory, tmpdir):
+                yield gff
+        finally:
+            for filename in runs:
+                os.unlink(filename)
+        return
     elif sort_order == "gene+exon":
-        entries.sort(key=lambda x: (x.gene_id, x.exon_number))
+        def get_key(x):
+            return encode_sort_key(x.gene_id, x.exon_number)
+    else:
+        raise ValueError("unknown sort order '%s'" % sort_order)
 
-    for entry in entries:
-        yield entry
+    for gff in _sort_external(gff_iterator, get_key, memory, tmpdir):
+        yield gff
 
 
 def iterator_overlapping_genes(gtf_iterator, min_overlap=0):
@@ -615,7 +772,7 @@ def toSequence(chunk, fasta):
 def readFromFile(infile):
     """read records from file and return as list."""
     result = []
-    for gff in pysam.tabix_iterator(infile, pysam.asGTF()):
+    for gff in iterator(infile):
         result.append(gff)
     return result
 
@@ -975,8 +1132,8 @@ class Entry:
     def copy(self, other):
         """fill from other entry.
 
-        This method works if other is :class:`GTF.Entry` or
-        :class:`pysam.GTFProxy`.
+        This method works if other is :class:`GTF.Entry`,
+        :class:`GTFTools.GTFRecord` or :class:`pysam.GTFProxy`.
         """
         self.contig = other.contig
         self.source = other.source
@@ -0,0 +1,408 @@
+"""Compiled parser for :term:`GTF` formatted files.
+
+Records are returned as :class:`GTFRecord` objects. The fixed columns
+and the ``gene_id`` and ``transcript_id`` attributes are parsed when a
+line is read. All other attributes are kept as the raw attribute
+string and only decoded into a dictionary when they are accessed.
+
+The interface follows :class:`pysam.GTFProxy`.
+"""
+
+import collections
+from cpython.object cimport PyObject_GenericSetAttr, PyObject_RichCompare
+
+# fields that are set through properties, all other names
+# are treated as attributes in the last column.
+FIELDS = frozenset(("contig", "source", "feature", "start", "end",
+                    "score", "strand", "frame", "attributes",
+                    "gene_id", "transcript_id"))
+
+# marker for attributes not present in a record
+cdef object MISSING = object()
+
+
+cdef inline str to_dot(value):
+    if value is None:
+        return "."
+    return str(value)
+
+
+cdef inline object from_dot(str value):
+    if value == ".":
+        return None
+    return value
+
+
+cdef tuple decode_field(str field):
+    '''decode a single attribute field into a (key, value) tuple.
+
+    Quoted values are returned without quotes, unquoted values are
+    converted to numbers if possible.
+    '''
+    cdef list parts
+    cdef str key
+    cdef object value
+
+    if field.endswith(";"):
+        field = field[:-1]
+    parts = field.split(" ", 1)
+    if len(parts) < 2:
+        raise ValueError("malformatted attribute field '%s'" % field)
+    key, value = parts[0].strip(), parts[1].strip()
+    if value and value[0] == '"' and value[-1] == '"':
+        value = value[1:-1]
+    else:
+        try:
+            value = float(value)
+            value = int(value)
+        except (ValueError, OverflowError):
+            pass
+    return key, value
+
+
+cdef object decode_attributes(str attributes):
+    '''decode an attribute string into a dictionary.
+
+    Fields are separated by a semicolon followed by a space as fields
+    might contain a ``;``, for example ``transcript_name "TXNRD2;-001"``
+    in ENSEMBL GTF files.
+    '''
+    cdef str field
+    result = collections.OrderedDict()
+    for field in attributes.strip().split("; "):
+        field = field.strip()
+        if field and field != ";":
+            key, value = decode_field(field)
+            result[key] = value
+    return result
+
+
+cdef str encode_attributes(attributes):
+    '''encode a dictionary of attributes into a string.'''
+    cdef list fields = []
+    for key, value in attributes.items():
+        if isinstance(value, str):
+            fields.append('%s "%s"' % (key, value))
+        elif isinstance(value, (list, tuple)):
+            fields.append('%s "%s"' % (key, " ".join(map(str, value))))
+        else:
+            fields.append("%s %s" % (key, value))
+    return "; ".join(fields) + ";"
+
+
+cdef object find_attribute(str attributes, str key):
+    '''return the value of attribute *key* without decoding the
+    full attribute string.
+
+    *key* is given with a trailing space. The full string is only
+    decoded if the key appears more than once or in an unusual
+    position.
+    '''
+    cdef Py_ssize_t count, start, end
+    cdef str s
+
+    count = attributes.count(key)
+    if count == 0:
+        return MISSING
+
+    if count == 1:
+        s = attributes.lstrip()
+        if s.startswith(key):
+            start = 0
+        else:
+            s = attributes
+            start = s.find("; " + key)
+            if start >= 0:
+                start += 2
+        if start >= 0:
+            end = s.find("; ", start)
+            if end < 0:
+                end = len(s)
+            return decode_field(s[start:end].strip())[1]
+
+    return decode_attributes(attributes).get(key[:-1], MISSING)
+
+
+cdef class GTFRecord:
+    '''a record in a :term:`GTF` formatted file.
+
+    Coordinates are 0-based, half-open. Empty fields (``.``) in the
+    source, feature, score, strand and frame columns are returned as
+    None.
+
+    Attributes in the last column can be accessed by name, either
+    as ``record.exon_number`` or ``record["exon_number"]``. Accessing
+    a missing attribute raises a KeyError. Attributes are changed
+    with :meth:`setAttribute` or by assignment, for example
+    ``record.exon_number = 1``.
+    '''
+
+    cdef str _contig
+    cdef str _source
+    cdef str _feature
+    cdef long _start
+    cdef long _end
+    cdef str _score
+    cdef str _strand
+    cdef str _frame
+    cdef str _attributes
+    cdef object _gene_id
+    cdef object _transcript_id
+    # decoded attributes, None if not decoded yet
+    cdef object _attribute_dict
+    # True if _attribute_dict has been changed and _attributes
+    # is out of date
+    cdef bint _is_modified
+
+    def __init__(self, contig=None, source=None, feature=None,
+                 start=0, end=0, score=None, strand=None, frame=None,
+                 attributes=""):
+        self._contig = to_dot(contig)
+        self._source = to_dot(source)
+        self._feature = to_dot(feature)
+        self._start = start
+        self._end = end
+        self._score = to_dot(score)
+        self._strand = to_dot(strand)
+        self._frame = to_dot(frame)
+        self._setAttributeString(attributes)
+
+    cdef _setAttributeString(self, str attributes):
+        self._attributes = attributes
+        self._attribute_dict = None
+        self._is_modified = False
+        self._gene_id = find_attribute(attributes, "gene_id ")
+        self._transcript_id = find_attribute(attributes, "transcript_id ")
+
+    property contig:
+        def __get__(self):
+            return self._contig
+
+        def __set__(self, value):
+            self._contig = to_dot(value)
+
+    property source:
+        def __get__(self):
+            return from_dot(self._source)
+
+        def __set__(self, value):
+            self._source = to_dot(value)
+
+    property feature:
+        def __get__(self):
+            return from_dot(self._feature)
+
+        def __set__(self, value):
+            self._feature = to_dot(value)
+
+    property start:
+        def __get__(self):
+            return self._start
+
+        def __set__(self, value):
+            self._start = value
+
+    property end:
+        def __get__(self):
+            return self._end
+
+        def __set__(self, value):
+            self._end = value
+
+    property score:
+        def __get__(self):
+            if self._score == ".":
+                return None
+            return float(self._score)
+
+        def __set__(self, value):
+            self._score = to_dot(value)
+
+    property strand:
+        def __get__(self):
+            return from_dot(self._strand)
+
+        def __set__(self, value):
+            self._strand = to_dot(value)
+
+    property frame:
+        def __get__(self):
+            if self._frame == ".":
+                return None
+            return int(self._frame)
+
+        def __set__(self, value):
+            self._frame = to_dot(value)
+
+    property attributes:
+        '''the attribute column as a string.'''
+        def __get__(self):
+            if self._is_modified:
+                self._attributes = encode_attributes(self._attribute_dict)
+                self._is_modified = False
+            return self._attributes
+
+        def __set__(self, value):
+            self._setAttributeString(value)
+
+    property gene_id:
+        def __get__(self):
+            if self._gene_id is MISSING:
+                raise KeyError("gene_id")
+            return self._gene_id
+
+        def __set__(self, value):
+            self.setAttribute("gene_id", value)
+
+    property transcript_id:
+        def __get__(self):
+            if self._transcript_id is MISSING:
+                raise KeyError("transcript_id")
+            return self._transcript_id
+
+        def __set__(self, value):
+            self.setAttribute("transcript_id", value)
+
+    def to_dict(self):
+        '''return attributes as a dictionary.
+
+        Use :meth:`setAttribute` to change attributes.
+        '''
+        if self._attribute_dict is None:
+            self._attribute_dict = decode_attributes(self._attributes)
+        return self._attribute_dict
+
+    def as_dict(self):
+        return self.to_dict()
+
+    def asDict(self):
+        return self.to_dict()
+
+    def from_dict(self, d):
+        '''set attributes from dictionary *d*.'''
+        self.attributes = encode_attributes(d)
+
+    def fromDict(self, d):
+        self.from_dict(d)
+
+    def keys(self):
+        '''return attribute names.'''
+        return self.to_dict().keys()
+
+    def setAttribute(self, name, value):
+        '''set attribute *name* to *value*.'''
+        self.to_dict()[name] = value
+        self._is_modified = True
+        if name == "gene_id":
+            self._gene_id = value
+        elif name == "transcript_id":
+            self._transcript_id = value
+
+    def invert(self, long lcontig):
+        '''invert genomic coordinates from forward to reverse
+        coordinates and back.
+
+        Arguments
+        ---------
+        lcontig : int
+           Length of the chromosome that the feature resides on.
+        '''
+        cdef long start, end
+        if self._strand in ("-", "0", "-1"):
+            start = min(self._start, self._end)
+            end = max(self._start, self._end)
+            self._start = lcontig - end
+            self._end = lcontig - start
+
+    def __getattr__(self, key):
+        if key.startswith("__"):
+            raise AttributeError(key)
+        return self.to_dict()[key]
+
+    def __setattr__(self, key, value):
+        if key in FIELDS:
+            PyObject_GenericSetAttr(self, key, value)
+        else:
+            self.setAttribute(key, value)
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            return getattr(self, key)
+        return self.to_dict()[key]
+
+    def __setitem__(self, key, value):
+        self.__setattr__(key, value)
+
+    def __len__(self):
+        return 9
+
+    def __str__(self):
+        return "\t".join((self._contig, self._source, self._feature,
+                          str(self._start + 1), str(self._end),
+                          self._score, self._strand, self._frame,
+                          self.attributes))
+
+    def __repr__(self):
+        return "<GTFRecord %s:%i-%i>" % (self._contig, self._start, self._end)
+
+    def __richcmp__(self, other, int op):
+        if not isinstance(other, GTFRecord):
+            return NotImplemented
+        return PyObject_RichCompare(str(self), str(other), op)
+
+    def __copy__(self):
+        cdef GTFRecord other = GTFRecord.__new__(GTFRecord)
+        other._contig = self._contig
+        other._source = self._source
+        other._feature = self._feature
+        other._start = self._start
+        other._end = self._end
+        other._score = self._score
+        other._strand = self._strand
+        other._frame = self._frame
+        other._attributes = self.attributes
+        other._attribute_dict = None
+        other._is_modified = False
+        other._gene_id = self._gene_id
+        other._transcript_id = self._transcript_id
+        return other
+
+    def __reduce__(self):
+        return parse, (str(self),)
+
+
+cpdef GTFRecord parse(str line):
+    '''parse a :term:`GTF` formatted *line* and return a
+    :class:`GTFRecord`.'''
+    cdef list fields = line.rstrip("\r\n").split("\t")
+    cdef GTFRecord record
+
+    if len(fields) != 9:
+        raise ValueError(
+            "parsing error: %s than 9 fields in line: %s" %
+            ("fewer" if len(fields) < 9 else "more", line.rstrip()))
+
+    record = GTFRecord.__new__(GTFRecord)
+    record._contig = fields[0]
+    record._source = fields[1]
+    record._feature = fields[2]
+    record._start = int(fields[3]) - 1
+    record._end = int(fields[4])
+    record._score = fields[5]
+    record._strand = fields[6]
+    record._frame = fields[7]
+    record._setAttributeString(fields[8])
+    return record
+
+
+def iterator(infile):
+    '''iterate over :term:`GTF` formatted records in *infile*.
+
+    Empty lines and lines starting with ``#`` are skipped.
+    '''
+    for line in infile:
+        if type(line) is bytes:
+            line = line.decode()
+        if line[0] == "#" or line[0] == "\n" or line[0] == "\r":
+            continue
+        yield parse(line)
@@ -210,11 +210,10 @@ class Counter:
 
         contig = self.getContig()
         strand = self.getStrand()
-        
-        s = []
-        for start,end in segments:
-            s.append(self.fasta.getSequence( contig, strand, start, end ))
-            
+
+        s = self.fasta.getSequences(
+            [(contig, strand, start, end) for start, end in segments])
+
         if Genomics.IsNegativeStrand(strand):
             return Genomics.reverse_complement("".join(s))
         else:
@@ -1901,8 +1900,10 @@ class CounterSpliceSites(Counter):
         contig = self.getContig()
         strand = self.getStrand()
 
-        for start, end in introns:
-            s = self.fasta.getSequence(contig, "+", start, end)
+        sequences = self.fasta.getSequences(
+            [(contig, "+", start, end) for start, end in introns])
+
+        for s in sequences:
 
             if self.mCheckBothStrands:
                 r = self.getIntronType(s)
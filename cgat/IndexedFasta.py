@@ -50,42 +50,110 @@ import zlib
 import gzip
 import tempfile
 import io
+import mmap
+import collections
+import numpy
 from cgatcore import experiment as E
 import cgatcore.iotools as iotools
 import cgat.Genomics as Genomics
 from cgat.AString import AString
 import pysam
 import dbm
-from io import StringIO
+
+
+class BlockCache:
+
+    """a least recently used cache of decompressed blocks.
+
+    Blocks are stored under a key such as (filename, block). Once the
+    total size of the cached blocks exceeds *max_bytes*, the least
+    recently used blocks are discarded.
+
+    The number of cache hits and misses is counted in the attributes
+    :attr:`hits` and :attr:`misses`.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.mBlocks = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.mBlocks)
+
+    def get(self, key):
+        """return block stored under *key* or None if not cached."""
+        try:
+            block = self.mBlocks.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.mBlocks[key] = block
+        self.hits += 1
+        return block
+
+    def add(self, key, block):
+        """add *block* to the cache, discarding old blocks if necessary."""
+        if key in self.mBlocks:
+            self.nbytes -= len(self.mBlocks.pop(key))
+        self.mBlocks[key] = block
+        self.nbytes += len(block)
+        while self.nbytes > self.max_bytes and len(self.mBlocks) > 1:
+            key, block = self.mBlocks.popitem(last=False)
+            self.nbytes -= len(block)
+
+    def clear(self):
+        """remove all blocks from the cache."""
+        self.mBlocks.clear()
+        self.nbytes = 0
 
 
 class Uncompressor:
 
-    def __init__(self, filename, unmangler):
+    def __init__(self, filename, unmangler, cache=None):
+        self.mFilename = filename
         self.mFile = open(filename, "rb")
         self.mUnMangler = unmangler
+        self.mCache = cache
+
+    def readBlock(self, indices, x):
+        """return the uncompressed block *x*.
+
+        Blocks are identified by their position in the compressed
+        file and are taken from the :class:`BlockCache` if possible.
+        """
+        if self.mCache is not None:
+            key = (self.mFilename, indices[x])
+            block = self.mCache.get(key)
+            if block is not None:
+                return block
+
+        self.mFile.seek(indices[x])
+        block = self.mUnMangler(self.mFile.read(indices[x + 1] - indices[x]))
+
+        if self.mCache is not None:
+            self.mCache.add(key, block)
+        return block
 
     def read(self, block_size, indices, start, end):
         """read an uncompressed block from start:end.
 
         The compressed chunk starts at first_pos.
-        NOTE: This is poorly implemented - do better.
         """
 
         # skip over uncompressed blocks
         d = int(math.floor(float(start) / block_size))
         r = start % block_size
         assert(d < len(indices))
-        self.mFile.seek(indices[d])
 
         # read x bytes of compressed data, at least one full chunk.
         nchunks = int(math.ceil(float((r + end - start)) / block_size))
 
-        fragments = []
-        for x in range(d, d + nchunks):
-            s = self.mFile.read(indices[x + 1] - indices[x])
-            fragments.append(self.mUnMangler(s))
-        u = "".join(fragments)
+        fragments = [self.readBlock(indices, x)
+                     for x in range(d, d + nchunks)]
+        u = fragments[0][:0].join(fragments)
 
         assert len(u) >= end - start, \
             "fragment smaller than requested size: %i > %i-%i=%i" %\
@@ -112,7 +180,7 @@ def writeFragments(outfile_fasta,
 
     s = "".join(fragments)
     rest = len(s) % size
-    if len(s) > size:
+    if len(s) >= size:
         for x in range(0, len(s) - rest, size):
             outfile_index.write("\t%i" % outfile_fasta.tell())
             outfile_fasta.write(mangler(s[x:x + size]))
@@ -126,14 +194,17 @@ def writeFragments(outfile_fasta,
         else:
             return s[-rest:]
     else:
+        if write_all:
+            # end of the last full chunk
+            outfile_index.write("\t%i" % outfile_fasta.tell())
         return ""
 
 
 def gzip_mangler(s):
 
-    xfile = StringIO()
+    xfile = io.BytesIO()
     gzipfile = gzip.GzipFile(fileobj=xfile, mode="wb")
-    gzipfile.write(s)
+    gzipfile.write(s.encode("ascii"))
     gzipfile.close()
 
     m = xfile.getvalue()
@@ -363,11 +434,15 @@ def createDatabase(db, iterator,
                    clean_sequence=False,
                    ignore_duplicates=False,
                    allow_duplicates=False,
-                   translator=None):
+                   translator=None,
+                   binary_index=False):
     """index files in filenames to create database.
 
     Two new files are created - db.fasta and db_name.idx
 
+    If binary_index is set, a memory mappable binary index is
+    created in addition (see :meth:`cgatIndexedFasta.writeBinaryIndex`).
+
     If compression is enabled, provide random access points
     every # bytes.
 
@@ -387,13 +462,13 @@ def createDatabase(db, iterator,
             import lzo
 
             def lzo_mangler(s):
-                return lzo.compress(s, 9)
+                return lzo.compress(s.encode("ascii"), 9)
             mangler = lzo_mangler
             db_name = db + ".lzo"
             write_chunks = True
         elif compression == "zlib":
             def zlib_mangler(s):
-                return zlib.compress(s, 9)
+                return zlib.compress(s.encode("ascii"), 9)
             mangler = zlib_mangler
             db_name = db + ".zlib"
             write_chunks = True
@@ -405,7 +480,7 @@ def createDatabase(db, iterator,
             from . import dictzip
 
             def mangler(x):
-                return x
+                return x.encode("ascii")
 
             db_name = db + ".dz"
             write_chunks = False
@@ -413,14 +488,14 @@ def createDatabase(db, iterator,
             import bz2
 
             def bzip_mangler(x):
-                return bz2.compress(x, 9)
+                return bz2.compress(x.encode("ascii"), 9)
 
             mangler = bzip_mangler
             db_name = db + ".bz2"
             write_chunks = True
         elif compression == "debug":
             def mangler(x):
-                return x
+                return x.encode("ascii")
             db_name = db + ".debug"
             write_chunks = True
         elif compression == "rle":
@@ -431,7 +506,11 @@ def createDatabase(db, iterator,
         else:
             raise ValueError("unknown compression library: %s" % compression)
 
-        index_name = db + ".cdx"
+        # dictzip files are seekable and use the uncompressed index
+        if compression == "dictzip":
+            index_name = db + ".idx"
+        else:
+            index_name = db + ".cdx"
 
         if write_chunks and random_access_points is None \
            or random_access_points <= 0:
@@ -458,6 +537,8 @@ def createDatabase(db, iterator,
         outfile_fasta = dictzip.open(
             db_name, "wb", buffersize=1000000, chunksize=random_access_points)
         compression = None
+    elif write_chunks:
+        outfile_fasta = open(db_name, "wb")
     else:
         outfile_fasta = open(db_name, "w")
 
@@ -520,7 +601,7 @@ def createDatabase(db, iterator,
                     fragments = []
                     lfragment = 0
                 else:
-                    outfile_fasta.write("\n")
+                    outfile_fasta.write(mangler("\n"))
 
                 outfile_index.write("\t%i\n" % lsequence)
 
@@ -567,7 +648,7 @@ def createDatabase(db, iterator,
         writeFragments(outfile_fasta, outfile_index, fragments, mangler,
                        size=random_access_points, write_all=True)
     else:
-        outfile_fasta.write("\n")
+        outfile_fasta.write(mangler("\n"))
 
     outfile_index.write("\t%i\n" % lsequence)
 
@@ -577,6 +658,307 @@ def createDatabase(db, iterator,
             for val in vals:
                 outfile_index.write("%s\t%s\n" % (key, val))
 
+    outfile_fasta.close()
+    outfile_index.close()
+
+    if binary_index:
+        cgatIndexedFasta(db).writeBinaryIndex()
+
+# Binary index format. The file starts with a header followed by
+# five sections:
+#
+# 1. contig records in the order of the database
+# 2. contig record numbers sorted by contig name
+# 3. synonym records sorted by synonym
+# 4. random access points of compressed databases
+# 5. contig and synonym names
+#
+# The header records size and modification time of the database
+# and the text index the binary index was built from.
+BINARY_INDEX_MAGIC = b"CGATIDX\0"
+BINARY_INDEX_VERSION = 2
+BINARY_INDEX_HEADER = struct.Struct("<8sIII4xQQQQQqqqq")
+
+CONTIG_RECORD = numpy.dtype([("name_offset", "<u8"),
+                             ("name_length", "<u4"),
+                             ("is_chunked", "<u4"),
+                             ("pos_id", "<u8"),
+                             ("pos_seq", "<u8"),
+                             ("lsequence", "<u8"),
+                             ("points_offset", "<u8"),
+                             ("npoints", "<u8")])
+
+SYNONYM_RECORD = numpy.dtype([("name_offset", "<u8"),
+                              ("name_length", "<u4"),
+                              ("target", "<u4")])
+
+
+def getSourceStamp(filenames):
+    """return size and modification time of *filenames*.
+
+    Missing files are recorded as size and time -1.
+    """
+    stamp = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+            stamp.extend((st.st_size, st.st_mtime_ns))
+        except OSError:
+            stamp.extend((-1, -1))
+    return tuple(stamp)
+
+
+def writeBinaryIndex(filename, index, synonyms, sources):
+    """write a binary contig index to *filename*.
+
+    *index* is a dictionary mapping contigs to index entries as
+    built by :meth:`cgatIndexedFasta._loadIndex` and *synonyms*
+    a dictionary mapping synonyms to contigs. *sources* is a tuple
+    with the names of the database and the text index. Their size
+    and modification time are stored in the header.
+    """
+
+    contigs = list(index.keys())
+    map_contig2record = dict((y, x) for x, y in enumerate(contigs))
+    synonyms = sorted((x.encode("ascii"), y) for x, y in synonyms.items()
+                      if y in map_contig2record)
+
+    names = io.BytesIO()
+    points = []
+    records = numpy.zeros(len(contigs), dtype=CONTIG_RECORD)
+    for x, contig in enumerate(contigs):
+        data = index[contig]
+        try:
+            pos_id, pos_seq, lsequence = struct.unpack("QQi", data)
+            is_chunked = 0
+            contig_points = []
+        except (struct.error, TypeError):
+            pos_id, pos_seq, lsequence, contig_points = data
+            is_chunked = 1
+        name = contig.encode("ascii")
+        records[x] = (names.tell(), len(name), is_chunked,
+                      pos_id, pos_seq, lsequence,
+                      len(points), len(contig_points))
+        names.write(name)
+        points.extend(contig_points)
+
+    sorted_records = numpy.array(
+        sorted(range(len(contigs)), key=lambda x: contigs[x].encode("ascii")),
+        dtype="<u4")
+
+    synonym_records = numpy.zeros(len(synonyms), dtype=SYNONYM_RECORD)
+    for x, (name, contig) in enumerate(synonyms):
+        synonym_records[x] = (names.tell(), len(name),
+                              map_contig2record[contig])
+        names.write(name)
+
+    points = numpy.array(points, dtype="<u8")
+
+    with open(filename, "wb") as outf:
+        offset = BINARY_INDEX_HEADER.size
+        offsets = []
+        for section in (records, sorted_records, synonym_records, points):
+            offsets.append(offset)
+            offset += section.nbytes
+            # keep sections 8-byte aligned
+            offset += -offset % 8
+        offsets.append(offset)
+
+        outf.write(BINARY_INDEX_HEADER.pack(
+            BINARY_INDEX_MAGIC, BINARY_INDEX_VERSION,
+            len(contigs), len(synonyms), *offsets,
+            *getSourceStamp(sources)))
+        for section, offset in zip(
+                (records, sorted_records, synonym_records, points),
+                offsets):
+            outf.write(b"\0" * (offset - outf.tell()))
+            outf.write(section.tobytes())
+        outf.write(b"\0" * (offsets[-1] - outf.tell()))
+        outf.write(names.getvalue())
+
+
+class BinaryIndex:
+
+    """a memory mapped binary contig index.
+
+    The index is opened in constant time. Names are looked up by
+    binary search in the sorted name tables of the memory map and
+    entries are cached once decoded. Entries are returned in the same
+    format as the entries of the text index.
+
+    If *synonyms* is set, the object gives access to the synonyms
+    stored in the index instead of the contigs.
+    """
+
+    def __init__(self, filename, synonyms=False, mapped=None):
+
+        if mapped is None:
+            with open(filename, "rb") as inf:
+                mapped = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mapped[:len(BINARY_INDEX_MAGIC)] != BINARY_INDEX_MAGIC:
+            raise ValueError("%s is not a binary index" % filename)
+        version = struct.unpack_from("<I", mapped, len(BINARY_INDEX_MAGIC))[0]
+        if version != BINARY_INDEX_VERSION:
+            raise ValueError("%s: unsupported binary index version %i" %
+                             (filename, version))
+
+        header = BINARY_INDEX_HEADER.unpack_from(mapped, 0)
+        (magic, version, ncontigs, nsynonyms,
+         contigs_offset, sorted_offset, synonyms_offset,
+         points_offset, names_offset) = header[:9]
+
+        self.mFilename = filename
+        self.mMap = mapped
+        self.mRecords = numpy.frombuffer(
+            mapped, dtype=CONTIG_RECORD, count=ncontigs,
+            offset=contigs_offset)
+        self.mSorted = numpy.frombuffer(
+            mapped, dtype="<u4", count=ncontigs, offset=sorted_offset)
+        self.mSynonyms = numpy.frombuffer(
+            mapped, dtype=SYNONYM_RECORD, count=nsynonyms,
+            offset=synonyms_offset)
+        self.mPointsOffset = points_offset
+        self.mNamesOffset = names_offset
+        self.mSourceStamp = header[9:]
+        self.mIsSynonyms = synonyms
+        if synonyms:
+            table = self.mSynonyms
+        else:
+            table = self.mRecords
+        self.mNameOffsets = table["name_offset"]
+        self.mNameLengths = table["name_length"]
+        # result of the last lookup, as a name is usually checked
+        # before its entry is requested
+        self.mLastFind = (None, -1)
+        self.mEntries = {}
+
+    def isCurrent(self, sources):
+        """return True if the files in *sources* are unchanged since
+        the index was built."""
+        return self.mSourceStamp == getSourceStamp(sources)
+
+    def getSynonyms(self):
+        """return an object giving access to the synonyms."""
+        return BinaryIndex(self.mFilename, synonyms=True, mapped=self.mMap)
+
+    def _getName(self, record):
+        start = self.mNamesOffset + int(record["name_offset"])
+        return self.mMap[start:start + int(record["name_length"])]
+
+    def _findName(self, x):
+        """return name of record *x* in the sorted name table."""
+        if not self.mIsSynonyms:
+            x = self.mSorted.item(x)
+        start = self.mNamesOffset + self.mNameOffsets.item(x)
+        return self.mMap[start:start + self.mNameLengths.item(x)]
+
+    def _find(self, key):
+        """return contig record number for *key* or -1 if not found."""
+        if key == self.mLastFind[0]:
+            return self.mLastFind[1]
+        try:
+            name = key.encode("ascii")
+        except (AttributeError, UnicodeEncodeError):
+            return -1
+
+        lo, hi = 0, len(self.mNameOffsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._findName(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self.mNameOffsets) or self._findName(lo) != name:
+            x = -1
+        elif self.mIsSynonyms:
+            x = int(self.mSynonyms[lo]["target"])
+        else:
+            x = self.mSorted.item(lo)
+        self.mLastFind = (key, x)
+        return x
+
+    def _getEntry(self, x):
+        """return index entry for contig record number *x*."""
+        try:
+            return self.mEntries[x]
+        except KeyError:
+            pass
+        self.mEntries[x] = entry = self._decodeEntry(x)
+        return entry
+
+    def _decodeEntry(self, x):
+        """decode index entry for contig record number *x*."""
+        record = self.mRecords[x]
+        if record["is_chunked"]:
+            return (int(record["pos_id"]),
+                    int(record["pos_seq"]),
+                    int(record["lsequence"]),
+                    numpy.frombuffer(
+                        self.mMap, dtype="<u8",
+                        count=int(record["npoints"]),
+                        offset=self.mPointsOffset +
+                        8 * int(record["points_offset"])))
+        else:
+            return struct.pack("QQi",
+                               int(record["pos_id"]),
+                               int(record["pos_seq"]),
+                               int(record["lsequence"]))
+
+    def __len__(self):
+        if self.mIsSynonyms:
+            return len(self.mSynonyms)
+        return len(self.mRecords)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        x = self._find(key)
+        if x < 0:
+            raise KeyError(key)
+        if self.mIsSynonyms:
+            return self._getName(self.mRecords[x]).decode("ascii")
+        return self._getEntry(x)
+
+    def keys(self):
+        if self.mIsSynonyms:
+            return [self._getName(x).decode("ascii") for x in self.mSynonyms]
+        return [self._getName(x).decode("ascii") for x in self.mRecords]
+
+    def values(self):
+        return [self[x] for x in self.keys()]
+
+    def items(self):
+        return [(x, self[x]) for x in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+def groupFragments(fragments, max_gap):
+    """group sorted fragments into chunks that can be read at once.
+
+    *fragments* is a sorted list of tuples starting with
+    (key, first_pos, last_pos). Fragments with the same key that
+    are at most *max_gap* positions apart are combined.
+
+    Yields tuples of (key, start, end, members) with members being
+    the fragments contained in the chunk.
+    """
+    x = 0
+    while x < len(fragments):
+        key, chunk_start, chunk_end = fragments[x][:3]
+        y = x + 1
+        while y < len(fragments) and \
+                fragments[y][0] == key and \
+                fragments[y][1] <= chunk_end + max_gap:
+            chunk_end = max(chunk_end, fragments[y][2])
+            y += 1
+        yield key, chunk_start, chunk_end, fragments[x:y]
+        x = y
+
+
 NAME_MAP = {
     'uncompressed': ('fasta', 'idx', False),
     'lzo': ('lzo',   'cdx', True),
@@ -590,12 +972,30 @@ NAME_MAP = {
 PREFERENCES = (
     'uncompressed', 'lzo', 'dictzip', 'zlib', 'gzip', 'bzip2', 'debug')
 
+# lookup table for complementing bytes, usable both as a numpy
+# index array and as a table for bytes.translate
+COMPLEMENT_TABLE = numpy.arange(256, dtype=numpy.uint8)
+COMPLEMENT_TABLE[numpy.frombuffer(b"ACGTacgt", dtype=numpy.uint8)] = \
+    numpy.frombuffer(b"TGCAtgca", dtype=numpy.uint8)
+COMPLEMENT_BYTES = COMPLEMENT_TABLE.tobytes()
+
 
 class cgatIndexedFasta:
 
-    """an indexed fasta file."""
+    """an indexed fasta file.
 
-    def __init__(self, dbname):
+    If *memory_map* is set, uncompressed databases are accessed
+    through a read-only memory map of the sequence file instead of
+    seek/read calls. Sequences can then be obtained without copying
+    through :meth:`getSequenceView`.
+
+    Blocks of compressed databases are kept in a :class:`BlockCache`
+    of *cache_size* bytes, so that consecutive queries within the
+    same block decompress it only once. Set *cache_size* to 0 to
+    disable the cache.
+    """
+
+    def __init__(self, dbname, memory_map=False, cache_size=16 * 1024 * 1024):
 
         if dbname.endswith(".fasta"):
             dbname = dbname[:-len(".fasta")]
@@ -617,6 +1017,13 @@ class cgatIndexedFasta:
         self.mConverter = None
         self.mIndex = {}
         self.mTranslator = None
+        self.mMemoryMap = memory_map and self.mMethod == "uncompressed"
+        self.mMap = None
+        self.mBuffer = numpy.empty(0, dtype=numpy.uint8)
+        if cache_size and self.mMethod != "uncompressed":
+            self.mCache = BlockCache(cache_size)
+        else:
+            self.mCache = None
 
     def __len__(self):
         """return the number of sequences in fasta file."""
@@ -639,27 +1046,52 @@ class cgatIndexedFasta:
         if compress is set to true, the index will not be loaded,
         but a compressed index will be created instead.
         """
-        if self.mMethod == "uncompressed":
+        if self.mMemoryMap:
+            self.mDatabaseFile = open(self.mDbname, "rb")
+            self.mMap = mmap.mmap(self.mDatabaseFile.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        elif self.mMethod == "uncompressed":
             self.mDatabaseFile = open(self.mDbname, "r")
         elif self.mMethod == "dictzip":
             from . import dictzip
-            self.mDatabaseFile = dictzip.GzipFile(self.mDbname)
+            self.mDatabaseFile = dictzip.GzipFile(self.mDbname,
+                                                  cache=self.mCache)
         elif self.mMethod == "lzo":
             import lzo
-            self.mDatabaseFile = Uncompressor(self.mDbname, lzo.decompress)
+            self.mDatabaseFile = Uncompressor(self.mDbname, lzo.decompress,
+                                              cache=self.mCache)
         elif self.mMethod == "gzip":
-            self.mDatabaseFile = Uncompressor(self.mDbname, gzip_demangler)
+            self.mDatabaseFile = Uncompressor(self.mDbname, gzip_demangler,
+                                              cache=self.mCache)
         elif self.mMethod == "zlib":
-            self.mDatabaseFile = Uncompressor(self.mDbname, zlib.decompress)
+            self.mDatabaseFile = Uncompressor(self.mDbname, zlib.decompress,
+                                              cache=self.mCache)
         elif self.mMethod == "bzip2":
             import bz2
-            self.mDatabaseFile = Uncompressor(self.mDbname, bz2.decompress)
+            self.mDatabaseFile = Uncompressor(self.mDbname, bz2.decompress,
+                                              cache=self.mCache)
         elif self.mMethod == "debug":
             self.mDatabaseFile = Uncompressor(
-                self.mDbname + ".debug", lambda x: x)
+                self.mDbname + ".debug", lambda x: x, cache=self.mCache)
 
+        filename_binary = self.mNameIndex + ".bin"
         filename_index = self.mNameIndex + ".dbm"
 
+        if not compress and os.path.exists(filename_binary):
+            try:
+                index = BinaryIndex(filename_binary)
+            except ValueError:
+                # index written by a different version
+                index = None
+            # ignore binary index if the database has changed
+            if index is not None and \
+               index.isCurrent((self.mDbname, self.mNameIndex)):
+                # synonyms are part of the binary index
+                self.mIndex = index
+                self.mSynonyms = index.getSynonyms()
+                self.mIsLoaded = True
+                return
+
         if compress:
             # if os.path.exists(filename_index):
             #     raise OSError("file %s already exists" % filename_index)
@@ -796,6 +1228,19 @@ class cgatIndexedFasta:
             results.append(lcontig)
         return results
 
+    def writeBinaryIndex(self, filename=None):
+        """write a binary version of the index.
+
+        The binary index includes all synonyms and is used in
+        preference to the text index when opening the database.
+        """
+        if not self.mIsLoaded:
+            self._loadIndex()
+        if filename is None:
+            filename = self.mNameIndex + ".bin"
+        writeBinaryIndex(filename, self.mIndex, self.mSynonyms,
+                         (self.mDbname, self.mNameIndex))
+
     def compressIndex(self):
         """compress index.
         Creates a database interface to an index.
@@ -830,41 +1275,21 @@ class cgatIndexedFasta:
         """
         self.mConverter = converter
 
-    def getSequence(self,
-                    contig,
-                    strand="+",
-                    start=0,
-                    end=0,
-                    converter=None,
-                    as_array=False):
-        """get a genomic fragment.
-
-        A genomic fragment is identified by the coordinates
-        contig, strand, start, end.
-
-        The converter function supplied translated these coordinates
-        into 0-based coordinates. By default, start and end are assumed
-        to be pythonic coordinates and are forward/reverse coordinates.
+    def _getFragmentPosition(self, contig, strand, start, end, converter):
+        """resolve fragment coordinates.
 
-        If as_array is set to true, return the AString object. This might
-        be beneficial for large sequence chunks. If as_array is set to False,
-        return a python string.
+        Returns the index entry of *contig* and the 0-based, forward
+        strand, half-open coordinates of the fragment.
         """
 
         contig = self.getToken(contig)
 
         data = self.mIndex[contig]
-        # dummy is
-        # -> pos_seq for seekable streams
-        # -> block_size for unseekable streams
         try:
             pos_id, dummy, lsequence = struct.unpack("QQi", data)
         except (struct.error, TypeError):
             pos_id, dummy, lsequence, points = data
 
-        pos_seq = dummy
-        block_size = dummy
-
         if end == 0:
             end = lsequence
 
@@ -891,26 +1316,76 @@ class cgatIndexedFasta:
                 first_pos, last_pos = lsequence - \
                     last_pos, lsequence - first_pos
 
+        assert first_pos <= last_pos, \
+            "first position %i is larger than last position %i " % \
+            (first_pos, last_pos)
+
+        return data, dummy, first_pos, last_pos
+
+    def getSequence(self,
+                    contig,
+                    strand="+",
+                    start=0,
+                    end=0,
+                    converter=None,
+                    as_array=False):
+        """get a genomic fragment.
+
+        A genomic fragment is identified by the coordinates
+        contig, strand, start, end.
+
+        The converter function supplied translated these coordinates
+        into 0-based coordinates. By default, start and end are assumed
+        to be pythonic coordinates and are forward/reverse coordinates.
+
+        If as_array is set to true, return the AString object. This might
+        be beneficial for large sequence chunks. If as_array is set to False,
+        return a python string.
+        """
+
+        # dummy is
+        # -> pos_seq for seekable streams
+        # -> block_size for unseekable streams
+        data, dummy, first_pos, last_pos = self._getFragmentPosition(
+            contig, strand, start, end, converter)
+
+        pos_seq = dummy
+        block_size = dummy
+
         if first_pos == last_pos:
             return ""
 
-        assert first_pos < last_pos, \
-            "first position %i is larger than last position %i " % \
-            (first_pos, last_pos)
+        if self.mMemoryMap:
+            # slicing the map copies the fragment once, without
+            # any system calls
+            s = self.mMap[pos_seq + first_pos:pos_seq + last_pos]
+            if str(strand) in ("-", "0", "-1"):
+                s = s[::-1].translate(COMPLEMENT_BYTES)
+            if as_array and not self.mTranslator:
+                p = AString()
+                p.frombytes(s)
+                return p
+            s = s.decode("ascii")
+            if self.mTranslator:
+                return self.mTranslator.translate(s)
+            return s
 
         p = AString()
 
         if self.mNoSeek:
             # read directly from position
-            p.fromstring(
-                self.mDatabaseFile.read(block_size, data[3],
-                                        first_pos, last_pos))
+            s = self.mDatabaseFile.read(block_size, data[3],
+                                        first_pos, last_pos)
         else:
             first_pos += pos_seq
             last_pos += pos_seq
 
             self.mDatabaseFile.seek(first_pos)
-            p.fromstring(self.mDatabaseFile.read(last_pos - first_pos))
+            s = self.mDatabaseFile.read(last_pos - first_pos)
+
+        if isinstance(s, str):
+            s = s.encode("ascii")
+        p.frombytes(s)
 
         if str(strand) in ("-", "0", "-1"):
             p = AString(Genomics.reverse_complement(str(p)))
@@ -920,7 +1395,125 @@ class cgatIndexedFasta:
         elif as_array:
             return p
         else:
-            return p.tostring().decode("ascii")
+            return p.tobytes().decode("ascii")
+
+    def _readChunk(self, start, end):
+        """read a chunk of the database file between start and end."""
+        if self.mMemoryMap:
+            return self.mMap[start:end].decode("ascii")
+
+        self.mDatabaseFile.seek(start)
+        s = self.mDatabaseFile.read(end - start)
+        if isinstance(s, bytes):
+            s = s.decode("ascii")
+        return s
+
+    def getSequences(self, regions, converter=None, max_gap=1024):
+        """get multiple genomic fragments.
+
+        *regions* is a list of tuples of (contig, strand, start, end)
+        with coordinates interpreted as in :meth:`getSequence`.
+
+        The fragments are read in the order of their position in the
+        database and the reads of fragments that are less than
+        *max_gap* bases apart are combined into a single read.
+
+        Returns a list of python strings in the order of *regions*.
+        """
+        if not self.mIsLoaded:
+            self._loadIndex()
+
+        if self.mNoSeek:
+            # block compressed databases are decompressed block-wise
+            return [self.getSequence(contig, strand, start, end,
+                                     converter=converter)
+                    for contig, strand, start, end in regions]
+
+        fragments = []
+        for idx, (contig, strand, start, end) in enumerate(regions):
+            data, pos_seq, first_pos, last_pos = self._getFragmentPosition(
+                contig, strand, start, end, converter)
+            fragments.append((0,
+                              pos_seq + first_pos,
+                              pos_seq + last_pos,
+                              idx,
+                              str(strand) in ("-", "0", "-1")))
+        fragments.sort()
+
+        result = [""] * len(fragments)
+        for key, chunk_start, chunk_end, members in groupFragments(
+                fragments, max_gap):
+            chunk = self._readChunk(chunk_start, chunk_end)
+            for key, first_pos, last_pos, idx, is_negative in members:
+                s = chunk[first_pos - chunk_start:last_pos - chunk_start]
+                if is_negative:
+                    s = Genomics.reverse_complement(s)
+                if self.mTranslator:
+                    s = self.mTranslator.translate(s)
+                result[idx] = s
+
+        return result
+
+    def getSequenceView(self,
+                        contig,
+                        strand="+",
+                        start=0,
+                        end=0,
+                        converter=None,
+                        out=None):
+        """get a genomic fragment as a numpy array of bytes.
+
+        Coordinates are interpreted as in :meth:`getSequence`. This
+        method requires the database to be memory mapped (see the
+        *memory_map* option to the constructor).
+
+        Forward strand fragments are returned as a read-only view
+        into the mapped file and no data is copied. Reverse strand
+        fragments are complemented into a buffer that is re-used
+        by the next call to this method, so the result needs to
+        be copied if it is to be kept.
+
+        If *out* is given, the fragment is written to the start of
+        this uint8 array instead and the filled part of *out* is
+        returned. *out* needs to be large enough for the fragment.
+        """
+
+        if not self.mIsLoaded:
+            self._loadIndex()
+
+        if not self.mMemoryMap:
+            raise ValueError(
+                "sequence views require a memory mapped, "
+                "uncompressed database")
+
+        data, pos_seq, first_pos, last_pos = self._getFragmentPosition(
+            contig, strand, start, end, converter)
+
+        view = numpy.frombuffer(self.mMap,
+                                dtype=numpy.uint8,
+                                count=last_pos - first_pos,
+                                offset=pos_seq + first_pos)
+
+        if out is not None:
+            if len(out) < len(view):
+                raise ValueError(
+                    "buffer of size %i too small for fragment of size %i" %
+                    (len(out), len(view)))
+            result = out[:len(view)]
+        elif str(strand) in ("-", "0", "-1"):
+            if len(self.mBuffer) < len(view):
+                self.mBuffer = numpy.empty(
+                    max(len(view), 2 * len(self.mBuffer)),
+                    dtype=numpy.uint8)
+            result = self.mBuffer[:len(view)]
+        else:
+            return view
+
+        if str(strand) in ("-", "0", "-1"):
+            numpy.take(COMPLEMENT_TABLE, view[::-1], out=result)
+        else:
+            result[:] = view
+        return result
 
     def getRandomCoordinates(self, size):
         """returns coordinates for a random fragment of size #.
@@ -963,9 +1556,13 @@ class cgatIndexedFasta:
 class PysamIndexedFasta(cgatIndexedFasta):
 
     '''interface a  pysam/samtools indexed fasta file with the
-    cgatIndexedFasta API.'''
+    cgatIndexedFasta API.
+
+    The *memory_map* and *cache_size* options are accepted for
+    compatibility, but ignored as access is handled by htslib.
+    '''
 
-    def __init__(self, dbname):
+    def __init__(self, dbname, memory_map=False, cache_size=None):
 
         # open database file and truncate
         if os.path.exists(dbname) and dbname.endswith(".fa"):
@@ -996,6 +1593,9 @@ class PysamIndexedFasta(cgatIndexedFasta):
         self.mConverter = None
         self.mIndex = {}
         self.mTranslator = None
+        self.mMemoryMap = False
+        self.mMap = None
+        self.mCache = None
 
     def _loadIndex(self, compress=False):
         '''load index into memory.'''
@@ -1027,6 +1627,9 @@ class PysamIndexedFasta(cgatIndexedFasta):
         except struct.error:
             pos_id, pos_seq, lsequence, points = data
 
+        if end == 0:
+            end = lsequence
+
         # convert to 0-based positive strand coordinates
         if converter:
             first_pos, last_pos = converter(start, end,
@@ -1056,6 +1659,39 @@ class PysamIndexedFasta(cgatIndexedFasta):
 
         return sequence
 
+    def getSequences(self, regions, converter=None, max_gap=1024):
+        """get multiple genomic fragments.
+
+        See :meth:`cgatIndexedFasta.getSequences`. Fragments on the
+        same contig that are less than *max_gap* bases apart are
+        fetched together.
+        """
+        if not self.mIsLoaded:
+            self._loadIndex()
+
+        fragments = []
+        for idx, (contig, strand, start, end) in enumerate(regions):
+            data, pos_seq, first_pos, last_pos = self._getFragmentPosition(
+                contig, strand, start, end, converter)
+            fragments.append((self.getToken(contig),
+                              first_pos,
+                              last_pos,
+                              idx,
+                              str(strand) in ("-", "0", "-1")))
+        fragments.sort()
+
+        result = [""] * len(fragments)
+        for contig, chunk_start, chunk_end, members in groupFragments(
+                fragments, max_gap):
+            chunk = self.mDatabaseFile.fetch(contig, chunk_start, chunk_end)
+            for contig, first_pos, last_pos, idx, is_negative in members:
+                s = chunk[first_pos - chunk_start:last_pos - chunk_start]
+                if is_negative:
+                    s = Genomics.reverse_complement(s)
+                result[idx] = s
+
+        return result
+
 
 def IndexedFasta(dbname, *args, **kwargs):
     '''factory function for IndexedFasta objects.'''
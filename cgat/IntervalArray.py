@@ -0,0 +1,516 @@
+'''IntervalArray.py - columnar sets of genomic intervals
+=====================================================
+
+This module provides :class:`IntervalArray`, a set of genomic
+intervals stored as numpy arrays of contig codes, start and end
+coordinates and strands. Coordinates are 0-based, half-open.
+
+Operations on interval arrays are vectorized: each position is
+mapped to a single 64-bit coordinate that combines the contig (and
+optionally the strand) with the position on the contig. The
+positions of all contigs are thus arranged on a single line and
+operations become sorts, cumulative sums and binary searches over
+these coordinates.
+
+:meth:`IntervalArray.fromBed` loads a :term:`bed` formatted file in
+bulk. Operations such as :meth:`IntervalArray.merge`,
+:meth:`IntervalArray.complement`, :meth:`IntervalArray.intersect`,
+:meth:`IntervalArray.subtract`, :meth:`IntervalArray.closest` and
+:meth:`IntervalArray.coverage` return new arrays or per-interval
+results.
+
+Example::
+
+   import cgat.IntervalArray as IntervalArray
+   a = IntervalArray.IntervalArray.fromBed(open("a.bed"))
+   b = IntervalArray.IntervalArray.fromBed(open("b.bed"))
+   for contig, start, end in a.subtract(b):
+       print(contig, start, end)
+
+Reference
+---------
+
+'''
+
+import io
+import re
+
+import numpy
+import pandas
+
+# number of bits for positions within a global coordinate. Positions
+# need to be within +/- 2**(POSITION_BITS - 1). The remaining bits of
+# a 64-bit integer allow for 2**(63 - POSITION_BITS) keys.
+POSITION_BITS = 42
+POSITION_OFFSET = 1 << (POSITION_BITS - 1)
+MAX_KEYS = 1 << (63 - POSITION_BITS)
+
+# strand codes
+STRANDS = (".", "+", "-")
+STRAND2CODE = {".": 0, "+": 1, "-": 2}
+
+# lines to skip in bed files
+IGNORE_LINE = re.compile("^(#|track|browser)", re.MULTILINE)
+
+
+def _getBases(keys):
+    """return the global coordinate of position 0 for each key.
+
+    Raises
+    ------
+    ValueError
+       If a key does not fit into a 64-bit global coordinate.
+    """
+    if len(keys) and keys.max() >= MAX_KEYS:
+        raise ValueError(
+            "global coordinates support at most %i keys "
+            "(contigs, or contigs and strands), got key %i" %
+            (MAX_KEYS, keys.max()))
+    return (keys << POSITION_BITS) + POSITION_OFFSET
+
+
+class IntervalArray(object):
+    """a set of genomic intervals stored in columns.
+
+    Attributes
+    ----------
+    contig_names : list
+       Names of contigs. Intervals refer to contigs by their
+       index in this list.
+    contigs : numpy.ndarray
+       Contig code of each interval.
+    starts : numpy.ndarray
+       Start of each interval.
+    ends : numpy.ndarray
+       End of each interval.
+    strands : numpy.ndarray
+       Strand code of each interval (0: unknown, 1: forward,
+       2: reverse), see :data:`STRANDS`.
+    records : list
+       Optional list of records the intervals have been created
+       from, such as lines in a :term:`bed` file.
+    """
+
+    def __init__(self, contig_names, contigs, starts, ends, strands=None,
+                 records=None):
+        self.contig_names = list(contig_names)
+        self.contigs = numpy.asarray(contigs, dtype=numpy.int64)
+        self.starts = numpy.asarray(starts, dtype=numpy.int64)
+        self.ends = numpy.asarray(ends, dtype=numpy.int64)
+        if strands is None:
+            strands = numpy.zeros(len(self.starts), dtype=numpy.int8)
+        self.strands = numpy.asarray(strands, dtype=numpy.int8)
+        self.records = records
+
+    @classmethod
+    def fromBed(cls, infile, with_records=False):
+        """read intervals from a :term:`bed` formatted file.
+
+        Comments, track and browser lines are ignored. The strand is
+        read from the sixth column if the first interval has one.
+
+        Arguments
+        ---------
+        infile : File
+           File object to read from.
+        with_records : bool
+           If True, keep the lines in :attr:`records`.
+        """
+        text = infile.read()
+        if IGNORE_LINE.search(text):
+            text = "\n".join([x for x in text.split("\n")
+                              if not IGNORE_LINE.match(x)])
+
+        records = None
+        if with_records:
+            records = [x for x in text.split("\n") if x]
+
+        if not text.strip():
+            return cls([], [], [], [], records=records)
+
+        first = text.lstrip("\n").split("\n", 1)[0].split("\t")
+        columns = [0, 1, 2]
+        if len(first) > 5:
+            columns.append(5)
+        df = pandas.read_csv(
+            io.StringIO(text), sep="\t", header=None, usecols=columns,
+            dtype={0: str, 1: numpy.int64, 2: numpy.int64, 5: str},
+            keep_default_na=False, quoting=3)
+
+        codes, contig_names = pandas.factorize(df[0])
+        if len(columns) > 3:
+            strands = df[5].map(STRAND2CODE).fillna(0).values
+        else:
+            strands = None
+        return cls(contig_names, codes, df[1].values, df[2].values,
+                   strands=strands, records=records)
+
+    @classmethod
+    def fromTuples(cls, intervals):
+        """build from a list of tuples of (contig, start, end) or
+        (contig, start, end, strand)."""
+        intervals = list(intervals)
+        if not intervals:
+            return cls([], [], [], [])
+        columns = list(zip(*intervals))
+        codes, contig_names = pandas.factorize(
+            pandas.Series(columns[0], dtype=object))
+        strands = None
+        if len(columns) > 3:
+            strands = [STRAND2CODE.get(x, 0) for x in columns[3]]
+        return cls(contig_names, codes, columns[1], columns[2],
+                   strands=strands)
+
+    @classmethod
+    def fromCoordinates(cls, contig_names, starts, ends, stranded=False):
+        """build from global coordinates, see :meth:`getCoordinates`."""
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        keys = starts >> POSITION_BITS
+        base = _getBases(keys)
+        if stranded:
+            contigs, strands = keys // 3, keys % 3
+        else:
+            contigs, strands = keys, None
+        return cls(contig_names, contigs, starts - base, ends - base,
+                   strands=strands)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        """return a new array with the intervals selected by
+        *index*, a boolean mask or an array of indices."""
+        records = None
+        if self.records is not None:
+            records = [self.records[x] for x in
+                       numpy.arange(len(self))[index]]
+        return IntervalArray(self.contig_names,
+                             self.contigs[index],
+                             self.starts[index],
+                             self.ends[index],
+                             self.strands[index],
+                             records=records)
+
+    def __iter__(self):
+        """iterate over tuples of (contig, start, end)."""
+        names = self.contig_names
+        return zip([names[x] for x in self.contigs.tolist()],
+                   self.starts.tolist(),
+                   self.ends.tolist())
+
+    def getLength(self):
+        """return the sum of interval lengths."""
+        return int((self.ends - self.starts).sum())
+
+    def withContigs(self, contig_names):
+        """return a copy using the contig codes of *contig_names*.
+
+        Contigs not in *contig_names* are appended.
+        """
+        contig_names = list(contig_names)
+        map_name2code = dict((y, x) for x, y in enumerate(contig_names))
+        for name in self.contig_names:
+            if name not in map_name2code:
+                map_name2code[name] = len(contig_names)
+                contig_names.append(name)
+        lookup = numpy.array(
+            [map_name2code[x] for x in self.contig_names], dtype=numpy.int64)
+        contigs = lookup[self.contigs] if len(lookup) else self.contigs
+        return IntervalArray(contig_names, contigs, self.starts,
+                             self.ends, self.strands, records=self.records)
+
+    def _align(self, other):
+        """return *other* with the contig codes of this array and
+        the new list of contig names."""
+        other = other.withContigs(self.contig_names)
+        return other, other.contig_names
+
+    def getCoordinates(self, stranded=False):
+        """return global start and end coordinates.
+
+        Global coordinates order intervals by contig code, strand if
+        *stranded* is set, and position.
+
+        Raises
+        ------
+        ValueError
+           If there are more than :data:`MAX_KEYS` contigs (or
+           contigs and strands if *stranded* is set).
+        """
+        keys = self.contigs
+        if stranded:
+            keys = keys * 3 + self.strands
+        base = _getBases(keys)
+        return base + self.starts, base + self.ends
+
+    def argsort(self):
+        """return indices that sort intervals by contig name, start
+        and end."""
+        order = numpy.argsort(self.contig_names, kind="stable") \
+            if self.contig_names else numpy.zeros(0, dtype=numpy.int64)
+        rank = numpy.empty(len(order), dtype=numpy.int64)
+        rank[order] = numpy.arange(len(order))
+        contigs = rank[self.contigs] if len(rank) else self.contigs
+        return numpy.lexsort((self.ends, self.starts, contigs))
+
+    def sort(self):
+        """return a copy sorted by contig name, start and end."""
+        return self[self.argsort()]
+
+    def isSorted(self):
+        """return True if the intervals are sorted by position within
+        contigs and all intervals of a contig are consecutive."""
+        if len(self) < 2:
+            return True
+        same = self.contigs[1:] == self.contigs[:-1]
+        if numpy.any(same & (self.starts[1:] < self.starts[:-1])):
+            return False
+        # contigs must not re-appear after a different contig
+        first = numpy.concatenate(([True], ~same))
+        return len(numpy.unique(self.contigs[first])) == first.sum()
+
+    def getMergeGroups(self, distance=0):
+        """return the group of each interval when merging adjacent
+        intervals in order.
+
+        A new group is started if the contig changes or if an
+        interval starts more than *distance* bases after the end of
+        all previous intervals in the group. Intervals on a contig
+        need to be sorted by their start.
+
+        Returns an array of group numbers.
+
+        Raises
+        ------
+        ValueError
+           If intervals are not sorted or there are more than
+           :data:`MAX_KEYS` runs of intervals on the same contig.
+        """
+        if len(self) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        is_new = numpy.concatenate(
+            ([True], self.contigs[1:] != self.contigs[:-1]))
+        if numpy.any(~is_new[1:] & (self.starts[1:] < self.starts[:-1])):
+            raise ValueError(
+                "intervals should be sorted by contig and position")
+        # runs of intervals on the same contig are placed one after
+        # the other on the global coordinate line
+        base = _getBases(numpy.cumsum(is_new) - 1)
+        max_ends = numpy.maximum.accumulate(base + self.ends)
+        is_new[1:] |= (base + self.starts)[1:] - max_ends[:-1] > distance
+        return numpy.cumsum(is_new) - 1
+
+    def merge(self, distance=0, stranded=False, with_groups=False):
+        """return merged intervals.
+
+        Intervals are merged if they overlap or if the gap between
+        them is at most *distance*. If *stranded* is set, only
+        intervals on the same strand are merged.
+
+        The result is sorted by contig code, strand if *stranded* is
+        set, and position. If *with_groups* is set, a tuple is
+        returned with the merged intervals and an array with the
+        index of the merged interval each interval is part of.
+        """
+        starts, ends = self.getCoordinates(stranded)
+        order = numpy.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+        if len(starts) == 0:
+            merged = IntervalArray(self.contig_names, [], [], [])
+            if with_groups:
+                return merged, numpy.zeros(0, dtype=numpy.int64)
+            return merged
+        max_ends = numpy.maximum.accumulate(ends)
+        is_new = numpy.concatenate(
+            ([True], starts[1:] - max_ends[:-1] > distance))
+        is_last = numpy.concatenate((is_new[1:], [True]))
+        merged = IntervalArray.fromCoordinates(
+            self.contig_names, starts[is_new], max_ends[is_last],
+            stranded=stranded)
+        if with_groups:
+            groups = numpy.empty(len(order), dtype=numpy.int64)
+            groups[order] = numpy.cumsum(is_new) - 1
+            return merged, groups
+        return merged
+
+    def _getBoundaries(self, other):
+        """return sorted segment boundaries and coverage of segments
+        by this array and *other*. Strand is ignored."""
+        other, contig_names = self._align(other)
+        starts1, ends1 = self.withContigs(contig_names).getCoordinates()
+        starts2, ends2 = other.getCoordinates()
+        points = numpy.concatenate((starts1, ends1, starts2, ends2))
+        n1, n2 = len(starts1), len(starts2)
+        delta1 = numpy.concatenate((numpy.ones(n1, dtype=numpy.int64),
+                                    -numpy.ones(n1, dtype=numpy.int64),
+                                    numpy.zeros(2 * n2, dtype=numpy.int64)))
+        delta2 = numpy.concatenate((numpy.zeros(2 * n1, dtype=numpy.int64),
+                                    numpy.ones(n2, dtype=numpy.int64),
+                                    -numpy.ones(n2, dtype=numpy.int64)))
+        order = numpy.argsort(points, kind="stable")
+        return (contig_names, points[order],
+                numpy.cumsum(delta1[order]), numpy.cumsum(delta2[order]))
+
+    def _combine(self, other, select):
+        """return regions covered according to *select*, a function
+        of the coverage by this array and *other*."""
+        contig_names, points, coverage1, coverage2 = \
+            self._getBoundaries(other)
+        if len(points) == 0:
+            return IntervalArray(contig_names, [], [], [])
+        take = select(coverage1[:-1] > 0, coverage2[:-1] > 0) & \
+            (points[1:] > points[:-1])
+        return IntervalArray.fromCoordinates(
+            contig_names, points[:-1][take], points[1:][take]).merge()
+
+    def intersect(self, other):
+        """return regions covered by both this array and *other*.
+
+        Overlapping and adjacent regions are merged and strand is
+        ignored.
+        """
+        return self._combine(other, numpy.logical_and)
+
+    def subtract(self, other):
+        """return regions covered by this array but not by *other*.
+
+        Overlapping and adjacent regions are merged and strand is
+        ignored.
+        """
+        return self._combine(
+            other, lambda x, y: numpy.logical_and(x, ~y))
+
+    def union(self, other):
+        """return regions covered by this array or *other*."""
+        return self._combine(other, numpy.logical_or)
+
+    def complement(self, contig_sizes):
+        """return regions not covered by intervals.
+
+        *contig_sizes* is a dictionary of contig sizes. Contigs not in
+        *contig_sizes* are ignored. The result is sorted by contig
+        name and position.
+        """
+        names = sorted(contig_sizes)
+        contigs = IntervalArray(names, numpy.arange(len(names)),
+                                numpy.zeros(len(names), dtype=numpy.int64),
+                                [contig_sizes[x] for x in names])
+        return contigs.subtract(self).sort()
+
+    def countOverlaps(self, other):
+        """return the number of intervals in *other* overlapping each
+        interval. Strand is ignored."""
+        other, contig_names = self._align(other)
+        starts, ends = self.withContigs(contig_names).getCoordinates()
+        other_starts, other_ends = other.getCoordinates()
+        other_starts.sort()
+        other_ends.sort()
+        return numpy.searchsorted(other_starts, ends, "left") - \
+            numpy.searchsorted(other_ends, starts, "right")
+
+    def overlaps(self, other):
+        """return a boolean array indicating intervals that overlap
+        with any interval in *other*. Strand is ignored."""
+        return self.countOverlaps(other) > 0
+
+    def coverage(self, other):
+        """return the number of bases in each interval that are
+        covered by intervals in *other*. Strand is ignored."""
+        other, contig_names = self._align(other)
+        merged = other.merge()
+        starts, ends = self.withContigs(contig_names).getCoordinates()
+        if len(merged) == 0:
+            return numpy.zeros(len(self), dtype=numpy.int64)
+        merged_starts, merged_ends = merged.getCoordinates()
+        lengths = merged_ends - merged_starts
+        # number of bases covered before each merged interval
+        covered = numpy.cumsum(lengths) - lengths
+
+        def covered_before(positions):
+            index = numpy.searchsorted(merged_starts, positions, "right") - 1
+            valid = index >= 0
+            index = numpy.maximum(index, 0)
+            result = covered[index] + numpy.clip(
+                positions - merged_starts[index], 0, lengths[index])
+            return numpy.where(valid, result, 0)
+
+        return covered_before(ends) - covered_before(starts)
+
+    def closest(self, other):
+        """return the closest interval in *other* for each interval.
+
+        Strand is ignored. Returns a tuple of indices into *other* and
+        distances. Overlapping intervals have a distance of 0. The
+        index is -1 if there is no interval on the same contig.
+        """
+        other, contig_names = self._align(other)
+        starts, ends = self.withContigs(contig_names).getCoordinates()
+        other_starts, other_ends = other.getCoordinates()
+        index = numpy.full(len(self), -1, dtype=numpy.int64)
+        distance = numpy.full(len(self), -1, dtype=numpy.int64)
+        if len(other) == 0:
+            return index, distance
+
+        # left: interval with the largest end among those starting
+        # before the end of the interval
+        by_start = numpy.argsort(other_starts, kind="stable")
+        sorted_starts = other_starts[by_start]
+        sorted_ends = other_ends[by_start]
+        max_ends = numpy.maximum.accumulate(sorted_ends)
+        best = numpy.arange(len(sorted_ends))
+        best[sorted_ends < max_ends] = 0
+        best = numpy.maximum.accumulate(best)
+
+        n = numpy.searchsorted(sorted_starts, ends, "left")
+        left = best[numpy.maximum(n - 1, 0)]
+        has_left = (n > 0) & ((sorted_ends[left] >> POSITION_BITS) ==
+                              (starts >> POSITION_BITS))
+        left_distance = numpy.maximum(starts - sorted_ends[left], 0)
+
+        # right: first interval starting at or after the end
+        right = numpy.minimum(n, len(sorted_starts) - 1)
+        has_right = (n < len(sorted_starts)) & (
+            (sorted_starts[right] >> POSITION_BITS) ==
+            (starts >> POSITION_BITS))
+        right_distance = sorted_starts[right] - ends
+
+        use_left = has_left & (~has_right | (left_distance <= right_distance))
+        use_right = has_right & ~use_left
+        index[use_left] = by_start[left[use_left]]
+        distance[use_left] = left_distance[use_left]
+        index[use_right] = by_start[right[use_right]]
+        distance[use_right] = right_distance[use_right]
+        return index, distance
+
+    def write(self, outfile):
+        """write intervals in :term:`bed` format to *outfile*."""
+        for contig, start, end in self:
+            outfile.write("%s\t%i\t%i\n" % (contig, start, end))
+
+
+def concatenate(arrays):
+    """return a single :class:`IntervalArray` with all intervals in
+    *arrays*.
+
+    Records are kept if all arrays have records.
+    """
+    contig_names = []
+    aligned = []
+    for array in arrays:
+        array = array.withContigs(contig_names)
+        contig_names = array.contig_names
+        aligned.append(array)
+    if not aligned:
+        return IntervalArray([], [], [], [])
+
+    records = None
+    if all(x.records is not None for x in aligned):
+        records = [record for x in aligned for record in x.records]
+    return IntervalArray(
+        contig_names,
+        numpy.concatenate([x.contigs for x in aligned]),
+        numpy.concatenate([x.starts for x in aligned]),
+        numpy.concatenate([x.ends for x in aligned]),
+        numpy.concatenate([x.strands for x in aligned]),
+        records=records)
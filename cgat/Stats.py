@@ -312,9 +312,9 @@ class DistributionalParameters:
         self.mCounts = len(n)
         self.mMin = min(n)
         self.mMax = max(n)
-        self.mMean = scipy.mean(n)
-        self.mMedian = scipy.median(n)
-        self.mSampleStd = scipy.std(n)
+        self.mMean = numpy.mean(n)
+        self.mMedian = numpy.median(n)
+        self.mSampleStd = numpy.std(n)
         self.mSum = reduce(lambda x, y: x + y, n)
 
     def getZScore(self, value):
@@ -441,9 +441,9 @@ class Summary(Result):
             self.counts = len(n)
             self.min = min(n)
             self.max = max(n)
-            self.mean = scipy.mean(n)
-            self.median = scipy.median(n)
-            self.samplestd = scipy.std(n)
+            self.mean = numpy.mean(n)
+            self.median = numpy.median(n)
+            self.samplestd = numpy.std(n)
             self.sum = reduce(lambda x, y: x + y, n)
 
     def getHeaders(self):
@@ -0,0 +1,348 @@
+'''ThreadedGzip.py - multi-threaded reading and writing of gzip files
+===================================================================
+
+This module provides file objects for gzip compressed files that
+use several threads for compression and decompression. :mod:`zlib`
+releases the global interpreter lock while (de)compressing, so
+threads permit using several cores.
+
+Compressed files are written in the BGZF format (see the SAM
+specification). BGZF files are a series of gzip members of at most
+64kb each and can be read by any standard gzip reader. Blocks are
+compressed in parallel and written in order.
+
+Reading decompresses on a background thread ahead of the consumer.
+If the file is in BGZF format, blocks are decompressed in parallel.
+Other gzip files, including files with multiple members, are
+decompressed as a single stream.
+
+:func:`open_file` and :func:`open_output_file` are drop-in
+replacements for :func:`cgatcore.iotools.open_file` and
+:func:`cgatcore.experiment.open_output_file` with an additional
+argument *threads*. With a single thread, the :mod:`cgatcore`
+functions are used. :func:`reopen` re-opens a gzip compressed stream
+opened by :mod:`cgatcore`, such as the ``--stdin`` and ``--stdout``
+options.
+
+Reference
+---------
+
+'''
+
+import collections
+import concurrent.futures
+import gzip
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+
+import cgatcore.experiment as E
+import cgatcore.iotools as iotools
+
+# maximum number of uncompressed bytes per BGZF block
+BLOCK_SIZE = 0xff00
+
+# empty BGZF block marking the end of a file
+EOF_BLOCK = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# gzip header of a BGZF block without the block size
+BGZF_HEADER = bytes.fromhex("1f8b08040000000000ff060042430200")
+
+
+def compress_block(data, compresslevel=6):
+    '''return *data* compressed as a BGZF block.'''
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return b"".join((
+        BGZF_HEADER,
+        struct.pack("<H", len(compressed) + 25),
+        compressed,
+        struct.pack("<II", zlib.crc32(data), len(data))))
+
+
+def decompress_block(data):
+    '''return decompressed data of a BGZF block without header.'''
+    crc, size = struct.unpack("<II", data[-8:])
+    uncompressed = zlib.decompress(data[:-8], -15)
+    if len(uncompressed) != size or zlib.crc32(uncompressed) != crc:
+        raise ValueError("corrupted BGZF block")
+    return uncompressed
+
+
+class BGZFWriter(io.RawIOBase):
+    '''write BGZF compressed data to *fileobj* using
+    *threads* threads for compression.'''
+
+    def __init__(self, fileobj, threads=1, compresslevel=6):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.max_pending = 2 * threads
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+
+    @property
+    def name(self):
+        return self.fileobj.name
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        offset = 0
+        if self.buffer:
+            offset = min(len(data), BLOCK_SIZE - len(self.buffer))
+            self.buffer.extend(data[:offset])
+            if len(self.buffer) < BLOCK_SIZE:
+                return len(data)
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(data) - offset >= BLOCK_SIZE:
+            self._submit(bytes(data[offset:offset + BLOCK_SIZE]))
+            offset += BLOCK_SIZE
+        self.buffer.extend(data[offset:])
+        return len(data)
+
+    def _submit(self, data):
+        self.pending.append(self.executor.submit(
+            compress_block, data, self.compresslevel))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+        '''write all buffered data.'''
+        if self.closed:
+            return
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            self.fileobj.write(EOF_BLOCK)
+        finally:
+            self.executor.shutdown()
+            super().close()
+            self.fileobj.close()
+
+
+def iterate_bgzf_blocks(fileobj):
+    '''iterate over the compressed blocks of a BGZF file.
+
+    Yields the data of each block without the gzip header.
+    '''
+    while True:
+        header = fileobj.read(18)
+        if not header:
+            break
+        if len(header) < 18 or header[12:14] != b"BC":
+            raise ValueError("not a BGZF file or truncated block")
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        data = fileobj.read(block_size - 18)
+        if len(data) < block_size - 18:
+            raise ValueError("truncated BGZF block")
+        yield data
+
+
+def iterate_bgzf(fileobj, threads=1):
+    '''iterate over decompressed blocks of a BGZF file, decompressing
+    blocks in parallel.'''
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        for data in iterate_bgzf_blocks(fileobj):
+            pending.append(executor.submit(decompress_block, data))
+            while len(pending) > 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iterate_gzip(fileobj, chunk_size=1024 * 1024):
+    '''iterate over decompressed chunks of a gzip file.
+
+    Files with multiple gzip members are decompressed completely.
+    '''
+    decompressor = None
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            break
+        while data:
+            if decompressor is None or decompressor.eof:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            yield decompressor.decompress(data)
+            data = decompressor.unused_data
+    if decompressor is not None and not decompressor.eof:
+        raise EOFError("compressed file ended before the "
+                       "end-of-stream marker was reached")
+
+
+def is_bgzf(header):
+    '''return True if *header* is the start of a BGZF file.'''
+    return len(header) >= 18 and header[:4] == b"\x1f\x8b\x08\x04" and \
+        header[12:14] == b"BC"
+
+
+class ThreadedReader(io.RawIOBase):
+    '''read decompressed data from a gzip compressed *fileobj*.
+
+    Data are decompressed on a background thread. BGZF files are
+    decompressed with *threads* threads.
+    '''
+
+    def __init__(self, fileobj, threads=1, max_chunks=8):
+        self.fileobj = io.BufferedReader(fileobj) \
+            if not hasattr(fileobj, "peek") else fileobj
+        self.threads = threads
+        self.chunks = queue.Queue(max_chunks)
+        self.chunk = b""
+        self.offset = 0
+        self.finished = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _produce(self):
+        try:
+            if is_bgzf(self.fileobj.peek(18)):
+                chunks = iterate_bgzf(self.fileobj, self.threads)
+            else:
+                chunks = iterate_gzip(self.fileobj)
+            for chunk in chunks:
+                if self.stopped:
+                    return
+                if chunk:
+                    self.chunks.put(chunk)
+            self.chunks.put(None)
+        except Exception as exc:
+            self.chunks.put(exc)
+
+    @property
+    def name(self):
+        return self.fileobj.name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.chunk):
+            if self.finished:
+                return 0
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.finished = True
+                return 0
+            if isinstance(chunk, Exception):
+                self.finished = True
+                raise chunk
+            self.chunk, self.offset = chunk, 0
+
+        n = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:n] = self.chunk[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self.stopped = True
+        # unblock the background thread
+        while self.thread.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.fileobj.close()
+        super().close()
+
+
+def open_file(filename, mode="r", threads=1, compresslevel=6,
+              create_dir=False, encoding="utf-8"):
+    '''open file called *filename* with mode *mode*.
+
+    gzip compressed files are recognized by the suffix ``.gz`` and are
+    read and written with *threads* threads. Modes ``r``, ``w`` and
+    ``a`` return text streams, ``rb``, ``wb`` and ``ab`` binary
+    streams. If *threads* is 1, :func:`cgatcore.iotools.open_file` is
+    used for text streams.
+    '''
+    _, ext = os.path.splitext(filename)
+    compressed = ext.lower() in (".gz", ".z")
+    binary = "b" in mode
+    mode = mode.replace("b", "")
+
+    if threads <= 1 and not binary:
+        return iotools.open_file(filename, mode, create_dir=create_dir,
+                                 encoding=encoding)
+
+    if create_dir:
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    if not compressed:
+        stream = open(filename, mode + "b")
+    elif threads <= 1:
+        stream = gzip.open(filename, mode + "b")
+    elif mode == "r":
+        stream = io.BufferedReader(
+            ThreadedReader(open(filename, "rb"), threads))
+    else:
+        stream = io.BufferedWriter(
+            BGZFWriter(open(filename, mode + "b"), threads, compresslevel),
+            buffer_size=BLOCK_SIZE)
+
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream, encoding=encoding)
+
+
+def open_output_file(section, mode="w", threads=1, encoding="utf-8"):
+    '''open file for writing substituting section in the
+    output_pattern, see :func:`cgatcore.experiment.open_output_file`.
+
+    gzip compressed files are written with *threads* threads.
+    '''
+    if threads <= 1:
+        return E.open_output_file(section, mode, encoding=encoding)
+
+    fn = E.get_output_file(section)
+    args = E.get_args()
+
+    if fn == "-":
+        return args.stdout
+
+    if not args.output_force and os.path.exists(fn):
+        raise OSError(
+            "file %s already exists, use --force-output to "
+            "overwrite existing files." % fn)
+
+    return open_file(fn, mode, threads=threads, create_dir=True,
+                     encoding=encoding)
+
+
+def reopen(stream, mode="r", threads=1):
+    '''re-open *stream* with *threads* threads if it is a gzip
+    compressed file opened by :func:`cgatcore.iotools.open_file`.
+
+    Otherwise, *stream* is returned unchanged.
+    '''
+    if threads <= 1:
+        return stream
+    fileobj = getattr(stream, "buffer", None)
+    if not isinstance(fileobj, gzip.GzipFile):
+        return stream
+    filename = fileobj.name
+    stream.close()
+    return open_file(filename, mode, threads=threads)
@@ -72,7 +72,8 @@ class GzipFile:
     myfileobj = None
 
     def __init__(self, filename=None, mode=None,
-                 compresslevel=9, fileobj=None, buffersize=None, chunksize=58315):
+                 compresslevel=9, fileobj=None, buffersize=None, chunksize=58315,
+                 cache=None):
         """Constructor for the GzipFile class.
 
         At least one of fileobj and filename must be given a
@@ -105,6 +106,11 @@ class GzipFile:
         flush points; smaller values means faster random access but lower
         compression.  The default value is close to maximum compression.
 
+        The cache argument is an optional block cache (for example
+        :class:`cgat.IndexedFasta.BlockCache`) with get() and add()
+        methods. If given, chunks of dictzip files are decompressed
+        once and then served from the cache after seeks.
+
         """
 
         # guarantee the file is opened in binary mode on platforms
@@ -130,7 +136,7 @@ class GzipFile:
             self._new_member = True
             # Set flag indicating normal gzip format
             self.dictzip = False
-            self.extrabuf = ""
+            self.extrabuf = b""
             self.extrasize = 0
             self.filename = filename
 
@@ -159,11 +165,14 @@ class GzipFile:
 
         self.fileobj = fileobj
         self.offset = 0
+        self.cache = cache
+        # next chunk to read from cache as (member, chunk)
+        self._next_chunk = None
 
         if self.mode == WRITE:
             if self.dictzip:
                 # intialize write buffer
-                self.writebuf = ''
+                self.writebuf = b''
             else:
                 # for ordinary gzip files, write header now
                 self._write_gzip_header()
@@ -219,7 +228,7 @@ class GzipFile:
             else:
                 filename = filename + '.gz'
         self.filename = filename
-        self.crc = zlib.crc32("")
+        self.crc = zlib.crc32(b"")
         self.size = 0
         self.compress = zlib.compressobj(self.compresslevel,
                                          zlib.DEFLATED,
@@ -228,50 +237,48 @@ class GzipFile:
                                          0)
 
     def _write_gzip_header(self, size=None):
-        self.fileobj.write('\037\213')             # magic header
-        self.fileobj.write('\010')                 # compression method
+        self.fileobj.write(b'\037\213')            # magic header
+        self.fileobj.write(b'\010')                # compression method
         flags = 0
         if self.filename:
             flags = FNAME
         if self.dictzip:
             flags |= FEXTRA
-        self.fileobj.write(chr(flags))
+        self.fileobj.write(bytes((flags,)))
         write32u(self.fileobj, int(time.time()))
-        self.fileobj.write('\002')                 # extraflag
-        self.fileobj.write('\377')                 # os (unknown)
+        self.fileobj.write(b'\002')                # extraflag
+        self.fileobj.write(b'\377')                # os (unknown)
         if self.dictzip:
             chunks = 1 + (size - 1) // self.chunksize
             xlen = 10 + 2 * chunks
             # length of extra field
-            self.fileobj.write(chr(xlen % 256))
-            self.fileobj.write(chr(xlen // 256))
+            self.fileobj.write(bytes((xlen % 256, xlen // 256)))
             # dictzip's magic word - 'R'andom 'A'ccess
-            self.fileobj.write('RA')
+            self.fileobj.write(b'RA')
             sublen = xlen - 4
             # length of subfield
-            self.fileobj.write(chr(sublen % 256))
-            self.fileobj.write(chr(sublen // 256))
+            self.fileobj.write(bytes((sublen % 256, sublen // 256)))
             # dictzip header version
-            self.fileobj.write('\001\000')
-            self.fileobj.write(chr(self.chunksize % 256))    # size of chunk
-            self.fileobj.write(chr(self.chunksize // 256))
+            self.fileobj.write(b'\001\000')
+            # size of chunk
+            self.fileobj.write(bytes((self.chunksize % 256,
+                                      self.chunksize // 256)))
             # number of chunks
-            self.fileobj.write(chr(chunks % 256))
-            self.fileobj.write(chr(chunks // 256))
+            self.fileobj.write(bytes((chunks % 256, chunks // 256)))
             self.chunktablepos = self.fileobj.tell()
             for chunk in range(chunks):
-                self.fileobj.write('\000\000')                  # placeholders
+                self.fileobj.write(b'\000\000')                 # placeholders
         if self.filename:
-            self.fileobj.write(self.filename[:-3] + '\000')
+            self.fileobj.write(self.filename[:-3].encode() + b'\000')
 
     def _init_read(self):
-        self.crc = zlib.crc32("")
+        self.crc = zlib.crc32(b"")
         self.size = 0
 
     def _read_gzip_extra(self):
         xlen = ord(self.fileobj.read(1))
         xlen = xlen + 256 * ord(self.fileobj.read(1))
-        xtra = self.fileobj.read(xlen)
+        xtra = bytearray(self.fileobj.read(xlen))
         xptr = 0
         # loop over subfields
         while xptr < xlen:
@@ -279,25 +286,25 @@ class GzipFile:
                 # ill-formed header: magic word + subfield length required
                 return
             # subfield length
-            sublen = ord(xtra[xptr + 2]) + 256 * ord(xtra[xptr + 3])
+            sublen = xtra[xptr + 2] + 256 * xtra[xptr + 3]
             ptr = xptr
             xptr += sublen + 4
-            if xtra[ptr] != 'R' or xtra[ptr + 1] != 'A':
+            if xtra[ptr:ptr + 2] != b'RA':
                 continue     # magic word for dictzip data is 'R'andom 'A'ccess
-            if xtra[ptr + 4] != '\001' or xtra[ptr + 5] != '\000':
+            if xtra[ptr + 4:ptr + 6] != b'\001\000':
                 raise IOError("Unrecognized DictZip version: " +
-                              str(ord(xtra[ptr + 4]) + 256 * ord(xtra[ptr + 5])))
+                              str(xtra[ptr + 4] + 256 * xtra[ptr + 5]))
             # chunk length
-            chlen = ord(xtra[ptr + 6]) + 256 * ord(xtra[ptr + 7])
+            chlen = xtra[ptr + 6] + 256 * xtra[ptr + 7]
             # chunk count
-            chcnt = ord(xtra[ptr + 8]) + 256 * ord(xtra[ptr + 9])
+            chcnt = xtra[ptr + 8] + 256 * xtra[ptr + 9]
             if chcnt * 2 != sublen - 6:
                 raise IOError("Invalid DictZip header: wrong number of chunks:" +
                               str(chcnt) + " expected " + str((sublen - 6) // 2))
             flushpoints = [0]
             for idx in range(chcnt):
                 flushpoints.append(
-                    flushpoints[-1] + ord(xtra[ptr + 10 + 2 * idx]) + 256 * ord(xtra[ptr + 11 + 2 * idx]))
+                    flushpoints[-1] + xtra[ptr + 10 + 2 * idx] + 256 * xtra[ptr + 11 + 2 * idx])
             # ignore other subfields
             return (chlen, flushpoints)
         if xptr != xlen:
@@ -306,7 +313,7 @@ class GzipFile:
 
     def _read_gzip_header(self):
         magic = self.fileobj.read(2)
-        if magic != '\037\213':
+        if magic != b'\037\213':
             raise IOError('Not a gzipped file')
         method = ord(self.fileobj.read(1))
         if method != 8:
@@ -325,13 +332,13 @@ class GzipFile:
             # Read and discard a null-terminated string containing the filename
             while True:
                 s = self.fileobj.read(1)
-                if not s or s == '\000':
+                if not s or s == b'\000':
                     break
         if flag & FCOMMENT:
             # Read and discard a null-terminated string containing a comment
             while True:
                 s = self.fileobj.read(1)
-                if not s or s == '\000':
+                if not s or s == b'\000':
                     break
         if flag & FHCRC:
             # Read & discard the 16-bit header CRC
@@ -385,8 +392,7 @@ class GzipFile:
         current_pos = self.fileobj.tell()
         self.fileobj.seek(self.chunktablepos)
         for block_size in block_sizes:
-            self.fileobj.write(chr(block_size % 256))
-            self.fileobj.write(chr(block_size // 256))
+            self.fileobj.write(bytes((block_size % 256, block_size // 256)))
         # return to previous position
         self.fileobj.seek(current_pos)
         # initialize - with no filename - for next member
@@ -398,7 +404,7 @@ class GzipFile:
             raise IOError(errno.EBADF, "read() on write-only GzipFile object")
 
         if self.extrasize <= 0 and self.fileobj is None:
-            return ''
+            return b''
 
         if not _block_read_size:
             # start small, in case the compression factor is high
@@ -443,10 +449,38 @@ class GzipFile:
         else:
             self.fileobj.seek(pos)  # Return to original position
 
+    def _read_chunk(self, member, idx):
+        """return decompressed chunk *idx* of *member*.
+
+        Chunks are taken from the cache if possible.
+        """
+        key = (self.filename, member, idx)
+        data = self.cache.get(key)
+        if data is None:
+            flushpoints = self.memberflushpoints[member]
+            self.fileobj.seek(flushpoints[idx])
+            data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+                self.fileobj.read(flushpoints[idx + 1] - flushpoints[idx]))
+            self.cache.add(key, data)
+        return data
+
     def _read(self, size):
         if self.fileobj is None:
             raise EOFError("Reached EOF")
 
+        if self._next_chunk is not None:
+            # read whole chunks through the cache
+            member, idx = self._next_chunk
+            if idx >= len(self.memberflushpoints[member]) - 1:
+                member, idx = member + 1, 0
+                if member >= len(self.memberflushpoints):
+                    raise EOFError("Reached EOF")
+            data = self._read_chunk(member, idx)
+            self.extrabuf = self.extrabuf + data
+            self.extrasize = self.extrasize + len(data)
+            self._next_chunk = (member, idx + 1)
+            return
+
         if self._new_member:
             # If the _new_member flag is set, we have to
             # jump to the next member, if there is one.
@@ -466,7 +500,7 @@ class GzipFile:
         # If the EOF has been reached, flush the decompression object
         # and mark this object as finished.
 
-        if buf == "":
+        if buf == b"":
             uncompress = self.decompress.flush()
             self._read_eof()
             self._add_read_data(uncompress)
@@ -475,7 +509,7 @@ class GzipFile:
         uncompress = self.decompress.decompress(buf)
         self._add_read_data(uncompress)
 
-        if self.decompress.unused_data != "":
+        if self.decompress.unused_data != b"":
             # Ending case: we've come to the end of a member in the file,
             # so seek back to the start of the unused data, finish up
             # this member, and read a new gzip header.
@@ -514,7 +548,7 @@ class GzipFile:
     def _endmember(self):
         if self.mode == WRITE:
             self.fileobj.write(self.compress.flush())  # unbuffered output
-            write32(self.fileobj, self.crc)
+            write32u(self.fileobj, self.crc)
             # self.size may exceed 2GB, or even 4GB
             write32u(self.fileobj, LOWU32(self.size))
 
@@ -565,9 +599,10 @@ class GzipFile:
             raise IOError("Can't rewind in write mode")
         self.fileobj.seek(0)
         self._new_member = True
-        self.extrabuf = ""
+        self.extrabuf = b""
         self.extrasize = 0
         self.offset = 0
+        self._next_chunk = None
 
     def seek(self, offset, whence=SEEK_SET):
         if whence == SEEK_CUR:
@@ -579,8 +614,8 @@ class GzipFile:
                 raise IOError('Negative seek in write mode')
             count = offset - self.offset
             for i in range(count // 1024):
-                self.write(1024 * '\0')
-            self.write((count % 1024) * '\0')
+                self.write(1024 * b'\0')
+            self.write((count % 1024) * b'\0')
         elif self.mode == READ:
             readahead = None
             if self.dictzip:
@@ -590,6 +625,19 @@ class GzipFile:
                 if count >= 0 and count < 32768:
                     # small forward seeks
                     pass
+                elif self.cache is not None:
+                    # position at start of chunk and read through cache
+                    member = max(
+                        0, bisect.bisect_right(self.memberoffset, offset) - 1)
+                    memberoffset = self.memberoffset[member]
+                    chlen = self.memberchlen[member]
+                    idx = min((offset - memberoffset) // chlen,
+                              len(self.memberflushpoints[member]) - 2)
+                    self.offset = memberoffset + idx * chlen
+                    self.extrabuf = b""
+                    self.extrasize = 0
+                    self._next_chunk = (member, idx)
+                    count = offset - self.offset
                 else:
                     # use table of flush points
                     member = max(
@@ -610,10 +658,10 @@ class GzipFile:
                     self.offset = memberoffset + idx * chlen
                     # Size is relative to member (ignored)
                     self.size = idx * chlen
-                    self.extrabuf = ""
+                    self.extrabuf = b""
                     self.extrasize = 0
                     # CRC is invalid (ignored)
-                    self.crc = zlib.crc32("")
+                    self.crc = zlib.crc32(b"")
                     self.decompress = zlib.decompressobj(-zlib.MAX_WBITS)
                     # Reset possible EOF
                     self._new_member = False
@@ -646,10 +694,10 @@ class GzipFile:
         readsize = min(100, size)    # Read from the file in small chunks
         while True:
             if size == 0:
-                return "".join(bufs)  # Return resulting line
+                return b"".join(bufs)  # Return resulting line
 
             c = self.read(readsize)
-            i = c.find('\n')
+            i = c.find(b'\n')
             if size is not None:
                 # We set i=size to break out of the loop under two
                 # conditions: 1) there's no newline, and the chunk is
@@ -660,10 +708,10 @@ class GzipFile:
                 elif size <= i:
                     i = size - 1
 
-            if i >= 0 or c == '':
+            if i >= 0 or c == b'':
                 bufs.append(c[:i + 1])    # Add portion of last chunk
                 self._unread(c[i + 1:])   # Push back rest of chunk
-                return ''.join(bufs)    # Return resulting line
+                return b''.join(bufs)    # Return resulting line
 
             # Append chunk to list, decrease 'size',
             bufs.append(c)
@@ -677,7 +725,7 @@ class GzipFile:
         L = []
         while sizehint > 0:
             line = self.readline()
-            if line == "":
+            if line == b"":
                 break
             L.append(line)
             sizehint = sizehint - len(line)
@@ -78,7 +78,26 @@ The script implements the following methods:
 
    add sequence and quality scores back to a bam file. Requires a
    :term:`fastq` formatted file with the sequences and quality scores
-   to insert.
+   to insert. The option ``--unstrip-method`` determines how reads
+   are looked up:
+
+   ``memory``
+      load all sequences and quality scores into memory (default).
+
+   ``index``
+      build an on-disk index of the :term:`fastq` files (see
+      :class:`Fastq.FastqIndex`) or use an existing index and look
+      up reads in batches of ``--batch-size`` reads. The index is
+      saved next to the :term:`fastq` file with the suffix ``.fqi``
+      or in the directory given by ``--fastq-index-dir``. Memory
+      usage does not depend on the number of reads.
+
+   ``merge``
+      read the :term:`fastq` files alongside the :term:`bam` file.
+      Requires the reads in the :term:`bam` file to be in the same
+      order as in the :term:`fastq` files, for example the
+      unsorted output of a mapper. Reads missing from the
+      :term:`bam` file are skipped.
 
 ``unset-unmapped-mapq``
 
@@ -103,6 +122,19 @@ The script implements the following methods:
    retains multimapping reads. The use of this requires downsampling
    parameter to be set and optionally randomseed.
 
+   Reads are selected by a random hash of the read name, so that
+   mates and multimapping alignments are kept together. With
+   ``--downsample``, exactly the given number of reads is selected
+   in two passes through the file. Input from stdin is saved to a
+   temporary file for the second pass. With ``--downsample-fraction``,
+   single ended reads are selected in a single pass.
+
+   For paired data, the first pass selects read names among reads in
+   proper pairs. The second pass outputs all alignments of the
+   selected read names, including secondary and supplementary
+   alignments. Memory usage depends on the number of selected reads,
+   but not on the size of the input file.
+
 ``add-sequence-error``
 
    add a certain amount of random error to read sequences. This method
@@ -143,13 +175,16 @@ Command line options
 
 import os
 import sys
+import itertools
+import hashlib
+import heapq
 import tempfile
 import shutil
 import random
 import pysam
 import cgatcore.experiment as E
 import cgatcore.iotools as iotools
-import itertools
+import cgat.Fastq as Fastq
 import math
 
 from cgat.BamTools.bamtools import bam2bam_filter_bam, SetNH
@@ -160,41 +195,155 @@ class SubsetBam(object):
     ''' base class for performing downsampling on single and
     paired bam file
 
-    A dictionary of the read names is made and then an
-    array matching the numbers of reads in the dictionary will be
-    created. This array contains 1s that match the number of reads
-    to be downsampled to and 0s to fill out the rest of the array.
+    Reads are selected by a pseudo-random 64-bit hash of the read
+    name that is keyed by *random_seed*. As all alignments of a read
+    share the same hash, mates and multimapping alignments are kept or
+    removed together.
+
+    If *fraction* is given, reads are selected by keeping those with
+    a hash below ``fraction * 2^64``. Single end data is processed in
+    a single pass.
+
+    Otherwise, exactly *downsample* reads are selected in two passes.
+    The first pass collects the *downsample* smallest hashes, the
+    second pass outputs all alignments of reads with a hash up to the
+    largest of these.
+
+    For paired data, only reads in proper pairs are selected in the
+    first pass. The second pass then outputs all alignments of the
+    selected reads including secondary and supplementary alignments
+    that are not flagged as proper pairs.
 
-    The read is kept if the value in the dictionary matches 1. The
-    read is yielded and iterated over to produce the output bam.
+    The second pass works on *infile*, the first on a separate
+    iterator over *samfile*. If *samfile* is a stream, the first pass
+    saves the alignments to a temporary uncompressed :term:`bam` file
+    which is then read in the second pass.
 
-    The script will handle multimapping reads.
+    Memory usage depends on the number of reads selected, but not on
+    the number of alignments in the input.
     '''
 
-    def __init__(self, infile, downsample, paired_end=None,
-                 single_end=None, random_seed=None):
+    def __init__(self, infile, downsample=None, paired_end=None,
+                 single_end=None, random_seed=None, fraction=None,
+                 samfile=None):
 
-        self.pysam_in1, self.pysam_in2 = itertools.tee(infile)
+        self.infile = infile
+        self.samfile = samfile
         self.downsample = downsample
+        self.fraction = fraction
         self.paired_end = paired_end
         self.single_end = single_end
         self.random_seed = random_seed
 
-    def list_of_reads(self, paired=None):
+        if self.random_seed is not None:
+            self.key = str(self.random_seed).encode("ascii")
+        else:
+            self.key = os.urandom(16)
 
+    def hash_read(self, read):
+        '''return 64-bit hash of the name of *read*.'''
+        return int.from_bytes(
+            hashlib.blake2b(read.query_name.encode("ascii"),
+                            digest_size=8,
+                            key=self.key).digest(), "little")
+
+    def iterate_first_pass(self):
+        '''iterate over reads for collecting read names.
+
+        If the input is a stream, reads are saved to a temporary
+        file and *infile* is replaced by an iterator over the
+        temporary file.
         '''
-        This will create a dictionary of uniqe reads in the bam
-        '''
-        read_list = []
+        if not self.samfile.is_stream:
+            with pysam.AlignmentFile(self.samfile.filename, "rb") as inf:
+                for read in inf.fetch(until_eof=True):
+                    yield read
+            return
+
+        handle, tmpfilename = tempfile.mkstemp(suffix=".bam")
+        os.close(handle)
+        with pysam.AlignmentFile(tmpfilename, "wbu",
+                                 template=self.samfile) as outf:
+            for read in self.infile:
+                outf.write(read)
+                yield read
 
-        for read in self.pysam_in1:
-            if paired is True:
-                if read.is_proper_pair:
-                    read_list.append(read.qname)
-            else:
-                read_list.append(read.qname)
+        def iterate_tmpfile():
+            try:
+                with pysam.AlignmentFile(tmpfilename, "rb") as inf:
+                    for read in inf.fetch(until_eof=True):
+                        yield read
+            finally:
+                os.unlink(tmpfilename)
+
+        self.infile = iterate_tmpfile()
+
+    def get_threshold(self, paired=None):
+        '''return largest hash of the *downsample* reads with the
+        smallest hashes and the set of these hashes.
 
-        return sorted(set(read_list))
+        If *paired* is set, only reads in proper pairs are
+        considered. The largest hash is None if there are not more
+        than *downsample* reads.
+        '''
+        # max-heap of selected hashes
+        heap = []
+        selected = set()
+        for read in self.iterate_first_pass():
+            if paired is True and not read.is_proper_pair:
+                continue
+            h = self.hash_read(read)
+            if h in selected:
+                continue
+            if len(heap) < self.downsample:
+                heapq.heappush(heap, -h)
+                selected.add(h)
+            elif h < -heap[0]:
+                selected.discard(-heapq.heapreplace(heap, -h))
+                selected.add(h)
+
+        if len(heap) < self.downsample:
+            return None, selected
+        return -heap[0], selected
+
+    def downsample_reads(self, paired=None):
+
+        if self.fraction is not None:
+            threshold = int(self.fraction * 2 ** 64)
+            if not paired:
+                for read in self.infile:
+                    if self.hash_read(read) < threshold:
+                        yield read
+                return
+
+            selected = set()
+            for read in self.iterate_first_pass():
+                if read.is_proper_pair:
+                    h = self.hash_read(read)
+                    if h < threshold:
+                        selected.add(h)
+        else:
+            threshold, selected = self.get_threshold(paired=paired)
+            if threshold is None:
+                E.warn('''The downsample reads is equal to or larger than the
+                number of unique reads''')
+                if not paired:
+                    for read in self.infile:
+                        yield read
+                    return
+            elif not paired:
+                # all alignments of a selected read are yielded, so
+                # multimapping reads are retained
+                for read in self.infile:
+                    if self.hash_read(read) <= threshold:
+                        yield read
+                return
+
+        # all alignments of a selected read pair are yielded, so
+        # multimapping reads are retained
+        for read in self.infile:
+            if self.hash_read(read) in selected:
+                yield read
 
     def downsample_paired(self):
 
@@ -203,26 +352,7 @@ class SubsetBam(object):
         It will retain multimapping reads if they have not been
         pre-filtered
         '''
-        if self.random_seed is not None:
-            random.seed(self.random_seed)
-
-        collect_list = self.list_of_reads(paired=True)
-        read_list = random.sample(collect_list, self.downsample)
-
-        if self.downsample == len(collect_list):
-            E.warn('''The downsample reads is equal to the
-            number of unique reads''')
-            for read in self.pysam_in2:
-                yield read
-
-        # yield read if it is in read_list, if the read is multimapped
-        # then all multimapping reads will be yielded
-        else:
-            E.warn('''Multimaping reads have been detected and these will
-            be output to the final bam file''')
-            for read in self.pysam_in2:
-                if read.qname in read_list:
-                    yield read
+        return self.downsample_reads(paired=True)
 
     def downsample_single(self):
 
@@ -230,26 +360,7 @@ class SubsetBam(object):
         This function will downsample a single bam file.
         It will retain multimapping reads if not pre-filtered
         '''
-        if self.random_seed is not None:
-            random.seed(self.random_seed)
-
-        collect_list = self.list_of_reads(paired=False)
-        read_list = random.sample(collect_list, self.downsample)
-
-        if self.downsample == len(collect_list):
-            E.warn('''The downsample reads is equal to the
-            number of unique reads''')
-            for read in self.pysam_in2:
-                yield read
-
-        # yield read if it is in read_list, if the reads is multimapped
-        # then all multimapping reads will be yielded
-        else:
-            E.warn('''Multimaping reads have been detected and these will
-            be output to the final bam file''')
-            for read in self.pysam_in2:
-                if read.qname in read_list:
-                    yield read
+        return self.downsample_reads(paired=False)
 
 
 def process_bam(infile, outfile, options):
@@ -410,9 +521,15 @@ def process_bam(infile, outfile, options):
             if not options.fastq_pair1:
                 raise ValueError(
                     "please supply fastq file(s) for unstripping")
-            fastq2sequence1 = buildReadDictionary(options.fastq_pair1)
+
+            fastq_files = [options.fastq_pair1]
             if options.fastq_pair2:
-                fastq2sequence2 = buildReadDictionary(options.fastq_pair2)
+                fastq_files.append(options.fastq_pair2)
+
+            def get_mate(read):
+                if options.fastq_pair2 and not read.is_read1:
+                    return 1
+                return 0
 
             def unstrip_unpaired(i):
                 for read in i:
@@ -427,10 +544,66 @@ def process_bam(infile, outfile, options):
                         read.seq, read.qual = fastq2sequence2[read.qname]
                     yield read
 
-            if options.fastq_pair2:
-                it = unstrip_pair(it)
+            def unstrip_indexed(i):
+                indices = []
+                for filename in fastq_files:
+                    if not os.path.exists(filename):
+                        raise OSError("file not found: %s" % filename)
+                    if options.fastq_index_dir:
+                        index_filename = os.path.join(
+                            options.fastq_index_dir,
+                            os.path.basename(filename) + ".fqi")
+                    else:
+                        index_filename = None
+                    indices.append(Fastq.open_index(filename, index_filename))
+
+                while True:
+                    reads = list(itertools.islice(i, options.batch_size))
+                    if not reads:
+                        break
+                    for mate, index in enumerate(indices):
+                        selected = [read for read in reads
+                                    if get_mate(read) == mate]
+                        records = index.fetch(
+                            [read.query_name for read in selected])
+                        for read, record in zip(selected, records):
+                            read.seq, read.qual = record
+                    for read in reads:
+                        yield read
+
+                for index in indices:
+                    index.close()
+
+            def unstrip_merge(i):
+                iterators = [iter(pysam.FastxFile(x)) for x in fastq_files]
+                records = [None] * len(iterators)
+                for read in i:
+                    mate = get_mate(read)
+                    record = records[mate]
+                    while record is None or record.name != read.qname:
+                        try:
+                            record = next(iterators[mate])
+                        except StopIteration:
+                            raise ValueError(
+                                "read %s not found in %s - are bam and "
+                                "fastq files in the same order?" %
+                                (read.qname, fastq_files[mate]))
+                    records[mate] = record
+                    read.seq, read.qual = record.sequence, record.quality
+                    yield read
+
+            if options.unstrip_method == "index":
+                it = unstrip_indexed(it)
+            elif options.unstrip_method == "merge":
+                it = unstrip_merge(it)
             else:
-                it = unstrip_unpaired(it)
+                fastq2sequence1 = buildReadDictionary(options.fastq_pair1)
+                if options.fastq_pair2:
+                    fastq2sequence2 = buildReadDictionary(
+                        options.fastq_pair2)
+                    it = unstrip_pair(it)
+                else:
+                    it = unstrip_unpaired(it)
 
         if "set-nh" in options.methods:
             it = SetNH(it)
@@ -469,7 +642,7 @@ def process_bam(infile, outfile, options):
 
         if "downsample-single" in options.methods:
 
-            if not options.downsample:
+            if not options.downsample and not options.downsample_fraction:
                 raise ValueError("Please provide downsample size")
 
             else:
@@ -477,12 +650,14 @@ def process_bam(infile, outfile, options):
                                  downsample=options.downsample,
                                  paired_end=None,
                                  single_end=True,
-                                 random_seed=options.random_seed)
+                                 random_seed=options.random_seed,
+                                 fraction=options.downsample_fraction,
+                                 samfile=infile)
                 it = down.downsample_single()
 
         if "downsample-paired" in options.methods:
 
-            if not options.downsample:
+            if not options.downsample and not options.downsample_fraction:
                 raise ValueError("Please provide downsample size")
 
             else:
@@ -490,7 +665,9 @@ def process_bam(infile, outfile, options):
                                  downsample=options.downsample,
                                  paired_end=True,
                                  single_end=None,
-                                 random_seed=options.random_seed)
+                                 random_seed=options.random_seed,
+                                 fraction=options.downsample_fraction,
+                                 samfile=infile)
                 it = down.downsample_paired()
 
         if "add-sequence-error" in options.methods:
@@ -597,11 +774,34 @@ def main(argv=None):
         "in pair. Used for unstripping sequence "
         "and quality scores  ")
 
+    parser.add_argument(
+        "--unstrip-method", dest="unstrip_method", type=str,
+        choices=("memory", "index", "merge"),
+        help="method to look up sequences and quality scores when "
+        "unstripping ")
+
+    parser.add_argument(
+        "--fastq-index-dir", dest="fastq_index_dir", type=str,
+        help="directory for fastq indices if --unstrip-method=index. "
+        "The default is the directory of the fastq file ")
+
+    parser.add_argument(
+        "--batch-size", dest="batch_size", type=int,
+        help="number of reads to look up at a time if "
+        "--unstrip-method=index ")
+
     parser.add_argument(
         "--downsample", dest="downsample",
         type=int,
         help="Number of reads to downsample to")
 
+    parser.add_argument(
+        "--downsample-fraction", dest="downsample_fraction",
+        type=float,
+        help="Fraction of reads to downsample to. Reads are selected "
+        "in a single pass, so the number of reads output is "
+        "approximate. Overrides --downsample")
+
     parser.add_argument(
         "--filename-read-list", dest="filename_read_list",
         type=str,
@@ -633,7 +833,11 @@ def main(argv=None):
         force=False,
         fastq_pair1=None,
         fastq_pair2=None,
+        unstrip_method="memory",
+        fastq_index_dir=None,
+        batch_size=100000,
         downsample=None,
+        downsample_fraction=None,
         random_seed=None,
         filename_read_list=None,
         error_rate=None,
@@ -1,14 +1,163 @@
 '''output depth statistics for a BAM file.
+
+Purpose
+-------
+
+Compute histograms of read depth and base depth across all covered
+positions in a :term:`bam` formatted file.
+
+The read depth of a position is the number of reads overlapping it,
+including reads with a deletion or reference skip at that position.
+The base depth is the number of reads with an aligned base at the
+position. Only positions with a read depth larger than 0 are counted.
+
+Depth is computed in-process. Each contig is processed in chunks of
+``--chunk-size`` bases. Read and base depth of a chunk are obtained by
+cumulative sums over difference arrays of aligned segments and the
+histograms are built with :func:`numpy.bincount`. With
+``--num-threads``, chunks are processed in parallel by a pool of
+worker processes.
+
+Unmapped, secondary, qc-failed and duplicate reads are always
+ignored. With ``--counting-mode=pileup_defaults``, reads that are
+paired but not in a proper pair are ignored as well and bases with a
+quality below 13 are not counted. Reads without base qualities are
+counted in full. Base alignment quality (BAQ)
+recalculation is not performed and bases in overlapping read pairs
+are counted for both mates.
+
+The options ``--input-filename-fasta`` and ``--mpileup-options`` of
+the previous samtools based implementation are accepted, but ignored.
+
+``--region`` restricts the computation to a contig or a region
+given as ``contig:start-end`` (1-based, inclusive). The option can be
+given multiple times.
+
+Usage
+-----
+
+Example::
+
+   cgat bam2depth in.bam > depth.tsv
+
+Command line options
+--------------------
+
 '''
 
-import collections
-import subprocess
+import sys
 import re
-import os
-import shlex
+import multiprocessing
+import numpy
+import pysam
 
 import cgatcore.experiment as E
-import cgatcore.iotools as iotools
+
+# reads that are always ignored: unmapped, secondary, qc fail and
+# duplicate reads.
+FILTER_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# alignment files opened in this process, see compute_histograms
+SAMFILES = {}
+
+
+def parse_region(region, contig_sizes):
+    '''parse a samtools style region string.
+
+    Returns a tuple of (contig, start, end) with 0-based, half-open
+    coordinates.
+    '''
+    match = re.match(r"^(.+?)(?::([\d,]+)(?:-([\d,]+))?)?$", region)
+    if not match or match.group(1) not in contig_sizes:
+        raise ValueError("invalid region '%s'" % region)
+    contig, start, end = match.groups()
+    lcontig = contig_sizes[contig]
+    start = int(start.replace(",", "")) - 1 if start else 0
+    end = int(end.replace(",", "")) if end else lcontig
+    return contig, max(0, start), min(lcontig, end)
+
+
+def add_segments(diff, starts, ends, offset):
+    '''add segments to difference array *diff*, clipping them
+    to the array.'''
+    if not starts:
+        return
+    size = len(diff) - 1
+    numpy.add.at(
+        diff, numpy.clip(numpy.array(starts) - offset, 0, size), 1)
+    numpy.subtract.at(
+        diff, numpy.clip(numpy.array(ends) - offset, 0, size), 1)
+
+
+def compute_histograms(args):
+    '''compute read and base depth histograms in a region.
+
+    *args* is a tuple of (filename, contig, start, end, ignore_orphans,
+    min_base_quality) so that the function can be used with a process
+    pool. Each process keeps its own open :class:`pysam.AlignmentFile`.
+
+    Returns a tuple of read depth and base depth histograms.
+    '''
+    filename, contig, start, end, ignore_orphans, min_base_quality = args
+    if filename not in SAMFILES:
+        SAMFILES[filename] = pysam.AlignmentFile(filename, "rb")
+    samfile = SAMFILES[filename]
+
+    read_starts, read_ends = [], []
+    base_starts, base_ends = [], []
+    low_quality = []
+
+    for read in samfile.fetch(contig, start, end):
+        flag = read.flag
+        if flag & FILTER_FLAGS:
+            continue
+        if ignore_orphans and flag & 1 and not flag & 2:
+            continue
+
+        read_starts.append(read.reference_start)
+        read_ends.append(read.reference_end)
+        for block_start, block_end in read.get_blocks():
+            base_starts.append(block_start)
+            base_ends.append(block_end)
+
+        # reads without base qualities pass the quality filter
+        if min_base_quality and read.query_qualities is not None:
+            pairs = numpy.array(read.get_aligned_pairs(matches_only=True),
+                                dtype=numpy.int64)
+            if len(pairs) == 0:
+                continue
+            qualities = numpy.asarray(read.query_qualities)[pairs[:, 0]]
+            low_quality.append(pairs[qualities < min_base_quality, 1])
+
+    read_depth = numpy.zeros(end - start + 1, dtype=numpy.int32)
+    base_depth = numpy.zeros(end - start + 1, dtype=numpy.int32)
+    add_segments(read_depth, read_starts, read_ends, start)
+    add_segments(base_depth, base_starts, base_ends, start)
+    read_depth = numpy.cumsum(read_depth[:-1], dtype=numpy.int32)
+    base_depth = numpy.cumsum(base_depth[:-1], dtype=numpy.int32)
+
+    # remove bases below quality threshold
+    if low_quality:
+        positions = numpy.concatenate(low_quality) - start
+        positions = positions[(positions >= 0) & (positions < end - start)]
+        counts = numpy.bincount(positions, minlength=end - start).astype(
+            numpy.int32)
+        read_depth -= counts
+        base_depth -= counts
+
+    covered = read_depth > 0
+    return (numpy.bincount(read_depth[covered]),
+            numpy.bincount(base_depth[covered]))
+
+
+def add_histogram(histogram, counts):
+    '''add *counts* to *histogram*, extending it if necessary.'''
+    if len(counts) > len(histogram):
+        histogram = numpy.concatenate(
+            (histogram,
+             numpy.zeros(len(counts) - len(histogram), dtype=numpy.int64)))
+    histogram[:len(counts)] += counts
+    return histogram
 
 
 def main(argv=None):
@@ -23,96 +172,114 @@ def main(argv=None):
     # setup command line parser
     parser = E.ArgumentParser(description=__doc__)
 
+    parser.add_argument("--version", action='version', version="1.0")
+
     parser.add_argument(
         "--input-filename-fasta", dest="input_filename_fasta", type=str,
-        help="filename with reference sequence in fasta format ")
+        help="deprecated, a reference sequence is not required. ")
 
     parser.add_argument(
         "--counting-mode", dest="counting_mode", type=str,
         choices=("all", "pileup_defaults"),
         help="counting mode. all=all reads/bases. pileup-defaults= "
-        "use default pileup thresholds. Options will be added to "
-        "--mpileup-options. .")
+        "use default pileup thresholds, i.e. ignore orphan reads and "
+        "bases with quality below 13.")
 
     parser.add_argument(
         "--mpileup-options", dest="mpileup_options", type=str,
-        help="pileup options to use ")
+        help="deprecated, samtools mpileup is not used any more. ")
+
+    parser.add_argument(
+        "--region", dest="regions", type=str, action="append",
+        help="restrict computation to region (contig or "
+        "contig:start-end). Can be given multiple times.")
+
+    parser.add_argument(
+        "--chunk-size", dest="chunk_size", type=int,
+        help="number of bases to process at a time.")
+
+    parser.add_argument(
+        "--num-threads", "--processes", dest="num_threads", type=int,
+        help="number of worker processes.")
 
     parser.set_defaults(
+        input_filename_fasta=None,
         mpileup_options="",
         counting_mode="all",
-        input_filename_fasta=None,
-        report_step=1000000,
+        regions=[],
+        chunk_size=10000000,
+        num_threads=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
-    (args) = E.start(parser, argv=argv, add_output_options=True)
+    (args, unknown) = E.start(parser, argv=argv, add_output_options=True,
+                              unknowns=True)
 
-    bamfile = args[0]
+    if len(unknown) != 1:
+        raise ValueError("please supply a single BAM file.")
+    bamfile = unknown[0]
 
-    mpileup_options = args.mpileup_options
+    if args.input_filename_fasta:
+        E.warn("--input-filename-fasta is deprecated and ignored")
+    if args.mpileup_options:
+        E.warn("--mpileup-options is deprecated and ignored")
 
     if args.counting_mode == "all":
-        mpileup_options += " -Q 0 -B -A"
-
-    read_depth_histogram = collections.defaultdict(int)
-    base_depth_histogram = collections.defaultdict(int)
+        ignore_orphans, min_base_quality = False, 0
+    else:
+        ignore_orphans, min_base_quality = True, 13
 
-    # deletions are marked by something like -2AA at the first
-    # position and a '*' for subsequent positions
-    rx_deletions = re.compile("([-][0-9]+|[*])")
-    report_step = args.report_step
-    npositions = 0
+    with pysam.AlignmentFile(bamfile, "rb") as samfile:
+        contig_sizes = dict(zip(samfile.references, samfile.lengths))
+        if args.regions:
+            regions = [parse_region(x, contig_sizes) for x in args.regions]
+        else:
+            regions = [(contig, 0, lcontig) for contig, lcontig in
+                       zip(samfile.references, samfile.lengths)]
 
-    samtools = iotools.which("samtools")
+    tasks = [(bamfile, contig, chunk_start,
+              min(end, chunk_start + args.chunk_size),
+              ignore_orphans, min_base_quality)
+             for contig, start, end in regions
+             for chunk_start in range(start, end, args.chunk_size)]
 
-    statement = (
-        "{samtools} mpileup "
-        "-f {reference_fasta} "
-        "{mpileup_options} "
-        "{bamfile} ".format(
-            samtools=samtools,
-            reference_fasta=args.input_filename_fasta,
-            mpileup_options=mpileup_options,
-            bamfile=os.path.abspath(bamfile)))
+    if args.num_threads > 1:
+        pool = multiprocessing.Pool(args.num_threads)
+        results = pool.imap(compute_histograms, tasks)
+    else:
+        pool = None
+        results = map(compute_histograms, tasks)
 
-    E.info("running the following statement: {}".format(statement))
+    read_depth_histogram = numpy.zeros(0, dtype=numpy.int64)
+    base_depth_histogram = numpy.zeros(0, dtype=numpy.int64)
 
-    cmd_args = shlex.split(statement)
-    proc = subprocess.Popen(
-        cmd_args,
-        shell=False,
-        stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        cwd=os.path.abspath(os.curdir))
+    for task, (read_depth, base_depth) in zip(tasks, results):
+        E.debug("finished {}:{}-{}".format(*task[1:4]))
+        read_depth_histogram = add_histogram(
+            read_depth_histogram, read_depth)
+        base_depth_histogram = add_histogram(
+            base_depth_histogram, base_depth)
 
-    for line in proc.stdout:
-        line = line.decode("utf-8")
-        contig, pos, base, read_depth, info, qualities = line[:-1].split("\t")
-        read_depth = int(read_depth)
-        pos = int(pos)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        if pos % report_step == 0:
-            E.info("working on {}: {}".format(contig, pos))
-
-        ndeletions = len(rx_deletions.findall(info))
-        base_depth = read_depth - ndeletions
-
-        read_depth_histogram[read_depth] += 1
-        base_depth_histogram[base_depth] += 1
-
-    for line in proc.stderr:
-        E.warn(line)
-
-    keys = sorted(set(read_depth_histogram.keys()).union(
-        base_depth_histogram.keys()))
+    size = max(len(read_depth_histogram), len(base_depth_histogram))
+    read_depth_histogram = add_histogram(
+        numpy.zeros(size, dtype=numpy.int64), read_depth_histogram)
+    base_depth_histogram = add_histogram(
+        numpy.zeros(size, dtype=numpy.int64), base_depth_histogram)
 
     args.stdout.write("depth\tread_depth_positions\tbase_depth_positions\n")
-    for key in keys:
+    for key in numpy.flatnonzero(read_depth_histogram + base_depth_histogram):
         args.stdout.write("{}\t{}\t{}\n".format(
-                key,
-                read_depth_histogram[key],
-                base_depth_histogram[key]))
+            key,
+            read_depth_histogram[key],
+            base_depth_histogram[key]))
 
-    E.info("positions tested: {}".format(sum(read_depth_histogram.values())))
+    E.info("positions tested: {}".format(read_depth_histogram.sum()))
     E.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -28,6 +28,10 @@ below will create the same two output files::
 
    cat in.bam cgat bam2fastq --output-filename-pattern=out.%s.fastq.gz
 
+With ``--threads``, the :term:`bam` formatted file is decompressed and
+the output is compressed with several threads. Output is written in
+the BGZF format, which can be read by any gzip reader.
+
 Type::
 
    python bam2fastq.py --help
@@ -43,12 +47,29 @@ import os
 import sys
 import tempfile
 import shutil
+import subprocess
 import cgatcore.experiment as E
-import cgatcore.iotools as iotools
+import cgat.ThreadedGzip as ThreadedGzip
 
 import pysam
 
 
+def sort_fastq(infilename, outfilename, threads=1):
+    '''sort tab-separated reads in *infilename* by name and write
+    them in fastq format to *outfilename*.'''
+
+    statement = ("gunzip < %s | sort -k1,1 | "
+                 "awk '{printf(\"@%%s\\n%%s\\n+\\n%%s\\n\", $1,$2,$3)}'" %
+                 infilename)
+
+    with ThreadedGzip.open_file(outfilename, "wb", threads=threads) as outf:
+        process = subprocess.Popen(statement, shell=True,
+                                   stdout=subprocess.PIPE)
+        shutil.copyfileobj(process.stdout, outf, ThreadedGzip.BLOCK_SIZE)
+        if process.wait() != 0:
+            raise OSError("error while sorting: %s" % statement)
+
+
 def main(argv=None):
     """script main.
 
@@ -63,7 +84,13 @@ def main(argv=None):
 
     parser.add_argument("--version", action='version', version="1.0")
 
+    parser.add_argument(
+        "--threads", dest="threads", type=int,
+        help="number of threads for reading the BAM file and writing "
+        "compressed files.")
+
     parser.set_defaults(
+        threads=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -86,17 +113,18 @@ def main(argv=None):
         fastqfile2 += ".gz"
 
     if args.stdin != sys.stdin:
-        samfile = pysam.AlignmentFile(args.stdin.name, "rb")
+        samfile = pysam.AlignmentFile(args.stdin.name, "rb",
+                                      threads=args.threads)
     else:
-        samfile = pysam.AlignmentFile("-", "rb")
+        samfile = pysam.AlignmentFile("-", "rb", threads=args.threads)
 
     tmpdir = tempfile.mkdtemp()
 
     outtemp1 = os.path.join(tmpdir, "pair1.gz")
     outtemp2 = os.path.join(tmpdir, "pair2.gz")
 
-    outstream1 = iotools.open_file(outtemp1, "w")
-    outstream2 = iotools.open_file(outtemp2, "w")
+    outstream1 = ThreadedGzip.open_file(outtemp1, "w", threads=args.threads)
+    outstream2 = ThreadedGzip.open_file(outtemp2, "w", threads=args.threads)
 
     E.info('writing fastq files to temporary directory %s' % tmpdir)
 
@@ -133,17 +161,12 @@ def main(argv=None):
         E.warn("no reads were found")
         return
 
-    sort_statement = '''gunzip < %s
-    | sort -k1,1
-    | awk '{printf("@%%s\\n%%s\\n+\\n%%s\\n", $1,$2,$3)}'
-    | gzip > %s'''
-
     if c.output1 == 0 and c.output2 == 0:
         # single end data:
         outstream1.close()
         outstream2.close()
         E.info("sorting fastq files")
-        E.run(sort_statement % (outtemp1, fastqfile1))
+        sort_fastq(outtemp1, fastqfile1, args.threads)
 
     else:
         # paired end data
@@ -163,8 +186,8 @@ def main(argv=None):
         outstream2.close()
 
         E.info("sorting fastq files")
-        E.run(sort_statement % (outtemp1, fastqfile1))
-        E.run(sort_statement % (outtemp2, fastqfile2))
+        sort_fastq(outtemp1, fastqfile1, args.threads)
+        sort_fastq(outtemp2, fastqfile2, args.threads)
 
     shutil.rmtree(tmpdir)
 
@@ -125,6 +125,15 @@ Note that for paired-end data, any ``\1`` or ``/2`` suffixes will be
 removed from the read name in the assumption that these have been removed
 in the bam file as well.
 
+Read names are stored as 64-bit hash values in a compact hash table.
+With the option ``--read-index-file``, the table is saved to disk after
+it has been built. Subsequent runs with the same option will open the
+saved table memory-mapped instead of reading the fastq file or making a
+first pass through the :term:`bam` file. This also permits per-read
+statistics for :term:`bam` files read from stdin. The saved table is
+ignored and built again if the file the read names were taken from
+has changed or a different file is given.
+
 Usage
 -----
 
@@ -408,12 +417,12 @@ def main(argv=None):
     parser.add_argument(
         "-d", "--output-details", dest="output_details", action="store_true",
         help="output per-read details into a separate file. Read names are "
-        "md5/base64 encoded ")
+        "output as hexadecimal hash values ")
 
     parser.add_argument(
         "--output-readmap", dest="output_readmap", action="store_true",
         help="output map between read name and "
-        "md5/base64 encoded short name")
+        "hexadecimal hash value")
 
     parser.add_argument(
         "--add-alignment-details", dest="add_alignment_details", action="store_true",
@@ -426,6 +435,12 @@ def main(argv=None):
         "used to collect sequence identifiers. Thus, for paired end data a "
         "single file is sufficient ")
 
+    parser.add_argument(
+        "--read-index-file", dest="filename_read_index", type=str,
+        help="filename with an index of read names. If the file exists, "
+        "read names will be taken from it. Otherwise the index will be "
+        "built and saved to it ")
+
     parser.add_argument(
         "--basic-counts", dest="detailed_count", action="store_false",
         help="perform basic counting and do not compute per read stats. "
@@ -438,6 +453,7 @@ def main(argv=None):
         input_reads=0,
         force_output=False,
         filename_fastq=None,
+        filename_read_index=None,
         detailed_count=True,
         output_details=False,
         output_readmap=False,
@@ -491,7 +507,8 @@ def main(argv=None):
                         outfile_details=outfile_details,
                         add_alignment_details=args.add_alignment_details,
                         outfile_readmap=outfile_readmap,
-                        detailed_count=args.detailed_count)
+                        detailed_count=args.detailed_count,
+                        filename_read_index=args.filename_read_index)
 
     if max_hi > 0 and max_hi != max(nh_all.keys()):
         E.warn("max_hi(%i) is inconsistent with max_nh (%i) "
@@ -594,7 +611,7 @@ def main(argv=None):
     ###############################
 
     # derive the number of mapped reads in file from alignment counts
-    if args.filename_fastq or not is_stdin:
+    if args.filename_fastq or args.filename_read_index or not is_stdin:
         nreads_total = counter.total_read
         _write(outs,
                "reads_total",
@@ -675,7 +692,7 @@ def main(argv=None):
     # Output pair information
     ###############################
     if flags_counts["read2"] > 0:
-        if args.filename_fastq:
+        if args.filename_fastq or args.filename_read_index:
             pairs_mapped = counter.total_pair_is_mapped
 
             # sanity check
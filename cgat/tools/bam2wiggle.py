@@ -6,17 +6,19 @@
 Purpose
 -------
 
-convert a bam file to a bigwig or bedgraph file.
+convert a bam file to a bigwig, bedgraph or wiggle file.
 
-Depending on options chosen, this script either computes the densities
-itself or makes use of faster solutions if possible. The script
-requires the executables :file:`wigToBigWig` and :file:`bedToBigBed`
-to be in the user's PATH.
+Coverage is computed in-process. For each contig, the script keeps a
+single int32 difference array of the contig's length, records the
+start and end of every read (or read pair) in it and obtains the
+coverage by a cumulative sum. Runs of identical coverage are then
+written directly as bedGraph, wiggle or bigWig (via :mod:`pyBigWig`).
+No temporary files or external tools are required.
 
 If no --shift-size or --extend option are given, the coverage is computed
-directly on reads.  Counting can be performed at a certain resolution.
-
-The counting currently is not aware of spliced reads, i.e., an
+directly on reads. Unmapped, secondary, qc-failed and duplicate reads
+as well as reads that are paired but not in a proper pair are
+ignored. The counting is not aware of spliced reads, i.e., an
 inserted intron will be included in the coverage.
 
 If --shift-size or --extend are given, the coverage is computed by shifting
@@ -24,16 +26,27 @@ read alignment positions upstream for positive strand reads or
 downstream for negative strand reads and extend them by a fixed
 amount.
 
-For RNASEQ data it might be best to run genomeCoverageBed directly on
-the bam file.
+If --merge-pairs is given, the coverage is computed on the fragment
+spanned by a read pair. As in :func:`cgat.BamTools.bamtools.merge_pairs`,
+the fragment is approximated from the mate position and the aligned
+end of the downstream read.
+
+With --num-threads, contigs are processed in parallel by a pool of
+worker processes, each opening the :term:`bam` file itself. Results
+are output in reference order, so the output is identical to a
+serial run.
+
+With --scale-method=reads, coverage values are normalized to
+--scale-base reads. If --merge-pairs is used, each pair counts as two
+reads.
 
 Usage
 -----
 
 Type::
 
-   cgat bam2wiggle \
-          --output-format=bigwig \
+   cgat bam2wiggle \\
+          --output-format=bigwig \\
           --output-filename-pattern=out.bigwig in.bam
 
 to convert the :term:`bam` file file:`in.bam` to :term:`bigwig` format
@@ -44,104 +57,263 @@ Command line options
 
 """
 
-import os
 import sys
-import tempfile
-import shutil
-import subprocess
-import cgatcore.experiment as E
+import multiprocessing
+import numpy
 import pysam
-import cgatcore.iotools as iotools
-from cgat.BamTools.bamtools import merge_pairs
+import pyBigWig
+import cgatcore.experiment as E
+
+# reads ignored when computing coverage directly on reads,
+# corresponds to the default filter of the pileup engine:
+# unmapped, secondary, qc fail and duplicate reads.
+FILTER_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# number of lines formatted at a time by the text writers
+CHUNK_SIZE = 100000
+
+
+def iterate_read_intervals(samfile, contig, lcontig):
+    '''iterate over aligned regions of reads in *contig*.'''
+    for read in samfile.fetch(contig):
+        flag = read.flag
+        if flag & FILTER_FLAGS:
+            continue
+        # ignore orphans, i.e. paired reads not in a proper pair
+        if flag & 1 and not flag & 2:
+            continue
+        start = read.reference_start
+        end = min(lcontig, read.reference_end)
+        if start >= end:
+            continue
+        yield start, end
+
+
+def iterate_shifted_intervals(samfile, contig, lcontig, shift, extend):
+    '''iterate over reads in *contig* shifted by *shift* and
+    extended to *extend* bases.'''
+    shift_extend = shift + extend
+    for read in samfile.fetch(contig):
+        if read.is_unmapped:
+            continue
+        if read.is_reverse:
+            start = max(0, read.reference_end - shift_extend)
+        else:
+            start = max(0, read.reference_start + shift)
 
+        # intervals extending beyond contig are removed
+        if start >= lcontig:
+            continue
 
-class SpanWriter(object):
+        yield start, min(lcontig, start + extend)
 
-    '''output values within spans.
-    values are collected according to a span and an average is
-    output.
+
+def iterate_merged_pairs(samfile, contig, lcontig,
+                         min_insert_size=0, max_insert_size=0):
+    '''iterate over fragments spanned by read pairs in *contig*.
+
+    The filtering follows :func:`cgat.BamTools.bamtools.merge_pairs`.
+    Each pair is reported once, at its downstream read.
+    '''
+    for read in samfile.fetch(contig):
+        flag = read.flag
+        # remove unmapped reads
+        if flag & 4:
+            continue
+
+        pos, mpos = read.reference_start, read.next_reference_start
+        if pos < mpos:
+            # lower coordinate than mate, ignore
+            continue
+        elif pos == mpos and flag & 64:
+            # disambiguate, ignore first in pair
+            continue
+
+        # remove unpaired and pairs across contigs
+        if not flag & 2:
+            continue
+        if read.reference_id != read.next_reference_id:
+            continue
+
+        isize = abs(read.template_length)
+        if (max_insert_size and isize > max_insert_size) or \
+           (min_insert_size and isize < min_insert_size):
+            continue
+
+        start, end = sorted((mpos, read.reference_end))
+        yield start, min(lcontig, end)
+
+
+def compute_coverage(intervals, lcontig):
+    '''compute per-base coverage of a contig from (start, end) tuples.
+
+    Returns an int32 array of length *lcontig* and the number of
+    intervals.
     '''
+    intervals = numpy.fromiter(
+        (x for interval in intervals for x in interval),
+        dtype=numpy.int64).reshape(-1, 2)
+
+    # difference array, converted in-place to coverage
+    coverage = numpy.zeros(lcontig + 1, dtype=numpy.int32)
+    numpy.add.at(coverage, intervals[:, 0], 1)
+    numpy.subtract.at(coverage, intervals[:, 1], 1)
+    numpy.cumsum(coverage, out=coverage)
+    return coverage[:lcontig], len(intervals)
+
+
+def coverage_to_runs(coverage):
+    '''return start, end and value of runs of non-zero coverage.'''
+    if len(coverage) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, coverage[:0]
+    changes = numpy.flatnonzero(coverage[1:] != coverage[:-1]) + 1
+    bounds = numpy.concatenate(([0], changes, [len(coverage)]))
+    starts, ends = bounds[:-1], bounds[1:]
+    values = coverage[starts]
+    keep = values != 0
+    return starts[keep], ends[keep], values[keep]
+
+
+def iterate_run_positions(runs, chunk_size=CHUNK_SIZE):
+    '''iterate over the positions and values of all bases covered by
+    *runs* in chunks of at most *chunk_size* bases.'''
+    starts, ends, values = runs
+    offsets = numpy.concatenate(([0], (ends - starts).cumsum()))
+    total = int(offsets[-1])
+    for chunk_start in range(0, total, chunk_size):
+        index = numpy.arange(chunk_start, min(total, chunk_start + chunk_size))
+        run = numpy.searchsorted(offsets, index, side="right") - 1
+        yield starts[run] + index - offsets[run], values[run]
+
+
+# alignment files opened in this process, see compute_contig_runs
+SAMFILES = {}
+
+
+def compute_contig_runs(args):
+    '''compute coverage runs for a single contig.
+
+    *args* is a tuple of (filename, contig, lcontig, method, params)
+    so that the function can be used with a process pool. Each process
+    keeps its own open :class:`pysam.AlignmentFile`.
+
+    Returns a tuple of (contig, lcontig, runs, number of intervals).
+    '''
+    filename, contig, lcontig, method, params = args
+    if filename not in SAMFILES:
+        SAMFILES[filename] = pysam.AlignmentFile(filename, "rb")
+    samfile = SAMFILES[filename]
+
+    if method == "merge":
+        intervals = iterate_merged_pairs(samfile, contig, lcontig, *params)
+    elif method == "shift":
+        intervals = iterate_shifted_intervals(
+            samfile, contig, lcontig, *params)
+    else:
+        intervals = iterate_read_intervals(samfile, contig, lcontig)
 
-    def __init__(self, span):
-        self.span = span
-        self.laststart = 0
-        self.lastend = None
-        self.val = 0
-        self.lastout = None
+    coverage, ninput = compute_coverage(intervals, lcontig)
+    return contig, lcontig, coverage_to_runs(coverage), ninput
 
-    def __call__(self, outfile, contig, start, end, val):
 
-        # deal with previous window
-        if self.lastend:
-            last_window_start = self.lastend - self.lastend % self.span
-            last_window_end = last_window_start + self.span
-        else:
-            last_window_start = start - start % self.span
-            last_window_end = start + self.span
-
-        # print start, end, val, last_window_start, last_window_end
-
-        if self.lastend and start > last_window_end:
-            # no overlap, output previous span
-            assert self.lastout != last_window_start, \
-                ("start=%i, end=%i, laststart=%i, "
-                 "lastend=%i, last_window_start=%i") % \
-                (start, end, self.laststart,
-                 self.lastend, last_window_start)
-            self.lastout = last_window_start
-            v = self.val / float(self.span)
-            outfile.write("%i\t%f\n" % (last_window_start, v))
-            self.val = 0
-
-            last_window_start = start - start % self.span
-            last_window_end = start + self.span
-
-        if end < last_window_end:
-            # window too small to output, simply add values
-            self.val += val * (end - start)
-            self.lastend = max(end, self.lastend)
+class BedGraphWriter(object):
+    '''write coverage runs as bedGraph (0-based, half-open).'''
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.outfile.write("track type=bedGraph\n")
+
+    def __call__(self, contig, lcontig, runs, scale_factor):
+        starts, ends, values = runs
+        if scale_factor == 1:
+            fmt = "%s\t%i\t%i\t%i\n"
         else:
-            # output first window
-            v = self.val + val * \
-                (self.span - start % self.span) / float(self.span)
-
-            s = last_window_start
-            assert self.lastout != s, \
-                "start=%i, end=%i, laststart=%i, lastend=%i, s=%i" % \
-                (start, end, self.laststart, self.lastend, s)
-            outfile.write("%i\t%f\n" % (s, v))
-            self.lastout = s
-            self.val = 0
-
-            # Output middle windows
-            for x in range(start + self.span - start % self.span,
-                           end - self.span, self.span):
-                assert self.lastout != x
-                outfile.write("%i\t%f\n" % (x, val))
-                self.lastout = x
-
-            if end % self.span:
-                # save rest
-                self.lastend = end
-                self.val = val * end % self.span
-            elif end - self.span != last_window_start:
-                # special case, end ends on window
-                assert self.lastout != end - self.span, \
-                    "start=%i, end=%i, laststart=%i, lastend=%i" % \
-                    (start, end, self.laststart, self.lastend)
-                self.lastout = end - self.span
-                outfile.write("%i\t%f\n" % (end - self.span, val))
-                self.lastend = None
-            else:
-                # special case, end ends on window and only single
-                # window - already output as start
-                self.lastend = None
+            fmt = "%s\t%i\t%i\t%f\n"
+            values = values * scale_factor
+        for x in range(0, len(starts), CHUNK_SIZE):
+            chunk = slice(x, x + CHUNK_SIZE)
+            self.outfile.writelines(
+                [fmt % (contig, s, e, v)
+                 for s, e, v in zip(starts[chunk].tolist(),
+                                    ends[chunk].tolist(),
+                                    values[chunk].tolist())])
+
+    def close(self):
+        pass
+
 
-    def flush(self, outfile):
-        if self.lastend:
-            outfile.write("%i\t%f\n" % (
-                self.lastend - self.lastend % self.span,
-                self.val / (self.lastend % self.span)))
+class WiggleWriter(object):
+    '''write coverage as variableStep wiggle (1-based).
+
+    If *span* is larger than 1, the average coverage in consecutive
+    windows of *span* bases is output.
+    '''
+
+    def __init__(self, outfile, span=1):
+        self.outfile = outfile
+        self.span = span
+
+    def __call__(self, contig, lcontig, runs, scale_factor):
+        self.outfile.write("variableStep chrom=%s span=%i\n" %
+                           (contig, self.span))
+        starts, ends, values = runs
+        if len(starts) == 0:
+            return
+
+        if self.span == 1:
+            if scale_factor == 1:
+                fmt = "%i\t%i\n"
+            else:
+                fmt = "%i\t%f\n"
+            for positions, values in iterate_run_positions(runs):
+                if scale_factor != 1:
+                    values = values * scale_factor
+                self.write_positions(fmt, positions, values)
+        else:
+            coverage = numpy.zeros(lcontig, dtype=numpy.int32)
+            for start, end, value in zip(starts, ends, values):
+                coverage[start:end] = value
+            window_starts = numpy.arange(0, lcontig, self.span)
+            sizes = numpy.diff(numpy.append(window_starts, lcontig))
+            sums = numpy.add.reduceat(coverage, window_starts,
+                                      dtype=numpy.float64)
+            keep = sums != 0
+            positions = window_starts[keep]
+            values = sums[keep] / sizes[keep] * scale_factor
+            for x in range(0, len(positions), CHUNK_SIZE):
+                chunk = slice(x, x + CHUNK_SIZE)
+                self.write_positions("%i\t%f\n",
+                                     positions[chunk], values[chunk])
+
+    def write_positions(self, fmt, positions, values):
+        self.outfile.writelines(
+            [fmt % (p, v)
+             for p, v in zip((positions + 1).tolist(), values.tolist())])
+
+    def close(self):
+        pass
+
+
+class BigWigWriter(object):
+    '''write coverage runs into a bigwig file.'''
+
+    def __init__(self, filename, contig_sizes):
+        self.bigwig = pyBigWig.open(filename, "w")
+        self.bigwig.addHeader(list(contig_sizes))
+
+    def __call__(self, contig, lcontig, runs, scale_factor):
+        starts, ends, values = runs
+        if len(starts) == 0:
+            return
+        self.bigwig.addEntries(
+            [contig] * len(starts),
+            starts.tolist(),
+            ends=ends.tolist(),
+            values=(values * float(scale_factor)).tolist())
+
+    def close(self):
+        self.bigwig.close()
 
 
 def main(argv=None):
@@ -158,8 +330,7 @@ def main(argv=None):
 
     parser.add_argument("-o", "--output-format", dest="output_format",
                         type=str,
-                        choices=("bedgraph", "wiggle", "bigbed",
-                                 "bigwig", "bed"),
+                        choices=("bedgraph", "wiggle", "bigwig"),
                         help="output format [default=%default]")
 
     parser.add_argument("-s", "--shift-size", dest="shift", type=int,
@@ -202,6 +373,12 @@ def main(argv=None):
                         "at least # bases apart. "
                         "0 turns of this filter.")
 
+    parser.add_argument("--num-threads", "--processes", dest="num_threads",
+                        type=int,
+                        help="number of worker processes. Contigs are "
+                        "processed in parallel and output in reference "
+                        "order.")
+
     parser.set_defaults(
         samfile=None,
         output_format="wiggle",
@@ -213,6 +390,7 @@ def main(argv=None):
         max_insert_size=0,
         scale_method='none',
         scale_base=1000000,
+        num_threads=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -225,241 +403,86 @@ def main(argv=None):
     if not args.samfile:
         raise ValueError("please provide a bam file")
 
-    # Read BAM file using Pysam
-    samfile = pysam.AlignmentFile(args.samfile, "rb")
-
-    # Create temporary files / folders
-    tmpdir = tempfile.mkdtemp()
-    E.debug("temporary files are in %s" % tmpdir)
-    tmpfile_wig = os.path.join(tmpdir, "wig")
-    tmpfile_sizes = os.path.join(tmpdir, "sizes")
-
-    # Create dictionary of contig sizes
-    contig_sizes = dict(list(zip(samfile.references, samfile.lengths)))
-    # write contig sizes
-    outfile_size = iotools.open_file(tmpfile_sizes, "w")
-    for contig, size in sorted(contig_sizes.items()):
-        outfile_size.write("%s\t%s\n" % (contig, size))
-    outfile_size.close()
-
-    # Shift and extend only available for bigwig format
-    if args.shift or args.extend:
-        if args.output_format != "bigwig":
-            raise ValueError(
-                "shift and extend only available for bigwig output")
+    # Read contig sizes from the BAM header
+    with pysam.AlignmentFile(args.samfile, "rb") as samfile:
+        contig_sizes = list(zip(samfile.references, samfile.lengths))
 
-    # Output filename required for bigwig / bigbed computation
+    # Set up output
     if args.output_format == "bigwig":
         if not args.output_filename_pattern:
             raise ValueError(
                 "please specify an output file for bigwig computation.")
-
-        # Define executable to use for binary conversion
-        if args.output_format == "bigwig":
-            executable_name = "wigToBigWig"
-        else:
-            raise ValueError("unknown output format `%s`" %
-                             args.output_format)
-
-        # check required executable file is in the path
-        executable = iotools.which(executable_name)
-        if not executable:
-            raise OSError("could not find %s in path." % executable_name)
-
-        # Open outout file
-        outfile = iotools.open_file(tmpfile_wig, "w")
-        E.info("starting output to %s" % tmpfile_wig)
+        writer = BigWigWriter(args.output_filename_pattern, contig_sizes)
+        E.info("starting output to %s" % args.output_filename_pattern)
+    elif args.output_format == "bedgraph":
+        writer = BedGraphWriter(args.stdout)
+        E.info("starting output to stdout")
     else:
-        outfile = iotools.open_file(tmpfile_wig, "w")
+        writer = WiggleWriter(args.stdout, args.span)
         E.info("starting output to stdout")
 
-    # Set up output write functions
-    if args.output_format in ("wiggle", "bigwig"):
-        # wiggle is one-based, so add 1, also step-size is 1, so need
-        # to output all bases
-        if args.span == 1:
-            outf = lambda outfile, contig, start, end, val: \
-                outfile.write(
-                    "".join(["%i\t%i\n" % (x, val)
-                             for x in range(start + 1, end + 1)]))
-        else:
-            outf = SpanWriter(args.span)
-    elif args.output_format == "bedgraph":
-        # bed is 0-based, open-closed
-        outf = lambda outfile, contig, start, end, val: \
-            outfile.write("%s\t%i\t%i\t%i\n" % (contig, start, end, val))
-
-    # initialise counters
-    ninput, nskipped, ncontigs = 0, 0, 0
-
-    # set output file name
-    output_filename_pattern = args.output_filename_pattern
-    if output_filename_pattern:
-        output_filename = os.path.abspath(output_filename_pattern)
-
-    # shift and extend or merge pairs. Output temporay bed file
-    if args.shift > 0 or args.extend > 0 or args.merge_pairs:
-        # Workflow 1: convert to bed intervals and use bedtools
-        # genomecov to build a coverage file.
-        # Convert to bigwig with UCSC tools bedGraph2BigWig
-
-        if args.merge_pairs:
-            # merge pairs using bam2bed
-            E.info("merging pairs to temporary file")
-            counter = merge_pairs(
-                samfile,
-                outfile,
-                min_insert_size=args.min_insert_size,
-                max_insert_size=args.max_insert_size,
-                bed_format=3)
-            E.info("merging results: {}".format(counter))
-            if counter.output == 0:
-                raise ValueError("no pairs output after merging")
-        else:
-            # create bed file with shifted/extended tags
-            shift, extend = args.shift, args.extend
-            shift_extend = shift + extend
-            counter = E.Counter()
-
-            for contig in samfile.references:
-                E.debug("output for %s" % contig)
-                lcontig = contig_sizes[contig]
+    # Select the intervals contributing to coverage
+    if args.merge_pairs:
+        E.info("merging pairs")
+        method = "merge"
+        params = (args.min_insert_size, args.max_insert_size)
+    elif args.shift > 0 or args.extend > 0:
+        method = "shift"
+        params = (args.shift, args.extend)
+    else:
+        method = "reads"
+        params = ()
 
-                for read in samfile.fetch(contig):
-                    pos = read.pos
-                    if read.is_reverse:
-                        start = max(0, read.pos + read.alen - shift_extend)
-                    else:
-                        start = max(0, read.pos + shift)
+    tasks = [(args.samfile, contig, lcontig, method, params)
+             for contig, lcontig in contig_sizes]
 
-                    # intervals extending beyond contig are removed
-                    if start >= lcontig:
-                        continue
+    if args.num_threads > 1:
+        pool = multiprocessing.Pool(args.num_threads)
+        results = pool.imap(compute_contig_runs, tasks)
+    else:
+        pool = None
+        results = map(compute_contig_runs, tasks)
 
-                    end = min(lcontig, start + extend)
-                    outfile.write("%s\t%i\t%i\n" % (contig, start, end))
-                    counter.output += 1
+    # If scaling, the scale factor is only known after all contigs
+    # have been processed, so keep the (compact) coverage runs.
+    deferred = []
+    counter = E.Counter()
 
-        outfile.close()
+    for contig, lcontig, runs, ninput in results:
+        E.debug("output for %s" % contig)
+        counter.contigs += 1
+        counter.input += ninput
 
         if args.scale_method == "reads":
-            scale_factor = float(args.scale_base) / counter.output
-
-            E.info("scaling: method=%s scale_quantity=%i scale_factor=%f" %
-                   (args.scale_method,
-                    counter.output,
-                    scale_factor))
-            scale = "-scale %f" % scale_factor
+            deferred.append((contig, lcontig, runs))
         else:
-            scale = ""
-
-        # Convert bed file to coverage file (bedgraph)
-        tmpfile_bed = os.path.join(tmpdir, "bed")
-        E.info("computing coverage")
-        # calculate coverage - format is bedgraph
-        statement = """bedtools genomecov -bg -i %(tmpfile_wig)s %(scale)s
-        -g %(tmpfile_sizes)s > %(tmpfile_bed)s""" % locals()
-        E.run(statement)
-
-        # Convert bedgraph to bigwig
-        E.info("converting to bigwig")
-        tmpfile_sorted = os.path.join(tmpdir, "sorted")
-        statement = ("sort -k 1,1 -k2,2n %(tmpfile_bed)s > %(tmpfile_sorted)s;"
-                     "bedGraphToBigWig %(tmpfile_sorted)s %(tmpfile_sizes)s "
-                     "%(output_filename_pattern)s" % locals())
-        E.run(statement)
+            writer(contig, lcontig, runs, 1)
 
-    else:
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        # Workflow 2: use pysam column iterator to build a
-        # wig file. Then convert to bigwig of bedgraph file
-        # with UCSC tools.
-        def column_iter(iterator):
-            start = None
-            end = 0
-            n = None
-            for t in iterator:
-                if t.pos - end > 1 or n != t.n:
-                    if start is not None:
-                        yield start, end, n
-                    start = t.pos
-                    end = t.pos
-                    n = t.n
-                end = t.pos
-            yield start, end, n
-
-        if args.scale_method != "none":
-            raise NotImplementedError(
-                "scaling not implemented for pileup method")
-
-        # Bedgraph track definition
-        if args.output_format == "bedgraph":
-            outfile.write("track type=bedGraph\n")
-
-        for contig in samfile.references:
-            # if contig != "chrX": continue
-            E.debug("output for %s" % contig)
-            lcontig = contig_sizes[contig]
-
-            # Write wiggle header
-            if args.output_format in ("wiggle", "bigwig"):
-                outfile.write("variableStep chrom=%s span=%i\n" %
-                              (contig, args.span))
-
-            # Generate pileup per contig using pysam and iterate over columns
-            for start, end, val in column_iter(samfile.pileup(contig)):
-                # patch: there was a problem with bam files and reads
-                # overextending at the end. These are usually Ns, but
-                # need to check as otherwise wigToBigWig fails.
-                if lcontig <= end:
-                    E.warn("read extending beyond contig: %s: %i > %i" %
-                           (contig, end, lcontig))
-                    end = lcontig
-                    if start >= end:
-                        continue
-
-                if val > 0:
-                    outf(outfile, contig, start, end, val)
-            ncontigs += 1
-
-        # Close output file
-        if type(outf) == type(SpanWriter):
-            outf.flush(outfile)
-        else:
-            outfile.flush()
-
-        E.info("finished output")
-
-        # Report counters
-        E.info("ninput=%i, ncontigs=%i, nskipped=%i" %
-               (ninput, ncontigs, nskipped))
-
-        # Convert to binary formats
-        if args.output_format == "bigwig":
-            outfile.close()
-
-            E.info("starting %s conversion" % executable)
-            try:
-                retcode = subprocess.call(
-                    " ".join((executable,
-                              tmpfile_wig,
-                              tmpfile_sizes,
-                              output_filename_pattern)),
-                    shell=True)
-                if retcode != 0:
-                    E.warn("%s terminated with signal: %i" %
-                           (executable, -retcode))
-                    return -retcode
-            except OSError as msg:
-                E.warn("Error while executing bigwig: %s" % msg)
-                return 1
-            E.info("finished bigwig conversion")
-        else:
-            with open(tmpfile_wig) as inf:
-                sys.stdout.write(inf.read())
+    if args.merge_pairs:
+        # count output pair as two so that it squares with reads
+        counter.input *= 2
+        if counter.input == 0:
+            raise ValueError("no pairs output after merging")
+
+    if args.scale_method == "reads":
+        if counter.input == 0:
+            raise ValueError("no reads to scale by")
+        scale_factor = float(args.scale_base) / counter.input
+
+        E.info("scaling: method=%s scale_quantity=%i scale_factor=%f" %
+               (args.scale_method,
+                counter.input,
+                scale_factor))
+        for contig, lcontig, runs in deferred:
+            writer(contig, lcontig, runs, scale_factor)
+
+    writer.close()
 
-    # Cleanup temp files
-    shutil.rmtree(tmpdir)
+    E.info("finished output: %s" % str(counter))
 
     E.stop()
 
@@ -7,7 +7,7 @@ bam_vs_bam.py - compute coverage correlation between bam files
 Purpose
 -------
 
-Compare per base coverage between two :term:`bam` formatted files.
+Compare per base coverage between two or more :term:`bam` formatted files.
 
 Usage
 -----
@@ -33,7 +33,25 @@ This tools allows users to compare the per base coverage between
 two BAM files. The output includes all bases in the supplied reference
 fasta except those with no coverage in the input BAMs.
 
-At present the --interval or -i option has not been implemented.
+Coverage counts all reads overlapping a base. Unmapped, secondary,
+qc-failed and duplicate reads as well as reads that are paired but
+not in a proper pair are ignored. Contigs are processed in chunks of
+``--chunk-size`` bases. For each chunk, coverage of all files is
+filled into a single (files x bases) array and only bases with
+non-zero coverage are output.
+
+The Pearson correlation coefficient between the coverage of each pair
+of files is computed over the output bases, both per contig and
+over all contigs. The results are written to the output file
+``correlation`` (see ``--output-filename-pattern``).
+
+With ``--intervals-bed-file``, coverage is only computed and output
+for bases within the intervals in a :term:`bed` formatted file.
+Overlapping intervals are merged.
+
+With ``--num-threads``, contigs are distributed over a pool of worker
+processes, each of which opens the :term:`bam` files itself. Output
+is written in reference order and is identical to a serial run.
 
 Command line options
 --------------------
@@ -46,8 +64,127 @@ Command line options
 
 import sys
 import re
+import itertools
+import collections
+import multiprocessing
+import numpy
 import pysam
 import cgatcore.experiment as E
+import cgatcore.iotools as iotools
+import cgat.Bed as Bed
+import cgat.Intervals as Intervals
+
+# reads ignored when computing coverage, corresponds to the default
+# filter of the pileup engine: unmapped, secondary, qc fail and
+# duplicate reads.
+FILTER_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# alignment files opened in this process, see compare_contig
+SAMFILES = {}
+
+
+def iterate_regions(regions, chunk_size):
+    """split regions into chunks of at most *chunk_size* bases."""
+    for start, end in regions:
+        for chunk_start in range(start, end, chunk_size):
+            yield chunk_start, min(end, chunk_start + chunk_size)
+
+
+def fill_coverage(samfile, contig, start, end, coverage):
+    """add coverage of reads in *samfile* within *contig*:*start*-*end*
+    to the array *coverage*."""
+    starts, ends = [], []
+    for read in samfile.fetch(contig, start, end):
+        flag = read.flag
+        if flag & FILTER_FLAGS:
+            continue
+        # ignore orphans, i.e. paired reads not in a proper pair
+        if flag & 1 and not flag & 2:
+            continue
+        starts.append(read.reference_start)
+        ends.append(read.reference_end)
+
+    if not starts:
+        return
+
+    # difference array clipped to region, converted to coverage
+    diff = numpy.zeros(end - start + 1, dtype=numpy.int32)
+    numpy.add.at(
+        diff, numpy.clip(numpy.array(starts) - start, 0, end - start), 1)
+    numpy.subtract.at(
+        diff, numpy.clip(numpy.array(ends) - start, 0, end - start), 1)
+    coverage += numpy.cumsum(diff[:-1], dtype=numpy.int32)
+
+
+def compare_contig(args):
+    """compute per base coverage in a contig for several bam files.
+
+    *args* is a tuple of (filenames, contig, regions, chunk_size) so
+    that the function can be used with a process pool. Each process
+    keeps its own open :class:`pysam.AlignmentFile` objects.
+
+    Returns a tuple of the output for the contig as a string and a
+    tuple of summary statistics (number of bases, per file sums, cross
+    product matrix). None is returned if the contig is missing in any
+    of the files.
+    """
+    filenames, contig, regions, chunk_size = args
+    for filename in filenames:
+        if filename not in SAMFILES:
+            SAMFILES[filename] = pysam.AlignmentFile(filename, "rb")
+    samfiles = [SAMFILES[x] for x in filenames]
+
+    for samfile in samfiles:
+        if contig not in samfile.references:
+            return None
+
+    if regions is None:
+        regions = [(0, samfiles[0].get_reference_length(contig))]
+
+    nfiles = len(samfiles)
+    nbases = 0
+    sums = numpy.zeros(nfiles, dtype=numpy.float64)
+    cross = numpy.zeros((nfiles, nfiles), dtype=numpy.float64)
+    output = []
+
+    for start, end in iterate_regions(regions, chunk_size):
+        matrix = numpy.zeros((nfiles, end - start), dtype=numpy.int32)
+        for samfile, coverage in zip(samfiles, matrix):
+            fill_coverage(samfile, contig, start, end, coverage)
+
+        columns = numpy.flatnonzero(matrix.any(axis=0))
+        if len(columns) == 0:
+            continue
+
+        values = matrix[:, columns]
+        del matrix
+        nbases += len(columns)
+        observations = values.astype(numpy.float64)
+        sums += observations.sum(axis=1)
+        cross += numpy.dot(observations, observations.T)
+
+        output.extend(
+            ["%s\t%i\t%s\n" % (contig, pos, "\t".join(map(str, row)))
+             for pos, row in zip((columns + start).tolist(),
+                                 values.T.tolist())])
+
+    return "".join(output), (nbases, sums, cross)
+
+
+def compute_correlations(nbases, sums, cross):
+    """compute pearson correlation coefficients for all pairs of files
+    from summary statistics.
+
+    Yields tuples of (index1, index2, coefficient).
+    """
+    for x, y in itertools.combinations(range(len(sums)), 2):
+        cov = nbases * cross[x, y] - sums[x] * sums[y]
+        var_x = nbases * cross[x, x] - sums[x] * sums[x]
+        var_y = nbases * cross[y, y] - sums[y] * sums[y]
+        if var_x <= 0 or var_y <= 0:
+            yield x, y, float("nan")
+        else:
+            yield x, y, cov / numpy.sqrt(var_x * var_y)
 
 
 def main(argv=None):
@@ -74,68 +211,96 @@ def main(argv=None):
                         help="regular expression to extract identifier from "
                         "filename .")
 
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int,
+                        help="number of bases to process at a time "
+                        "per contig.")
+
+    parser.add_argument("--num-threads", "--processes", dest="num_threads",
+                        type=int,
+                        help="number of worker processes. Contigs are "
+                        "processed in parallel and output in reference "
+                        "order.")
+
     parser.set_defaults(
         filename_intervals=None,
         regex_identifier="(.*)",
+        chunk_size=10000000,
+        num_threads=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
-    (args, unknown) = E.start(parser, argv=argv, unknowns=True)
+    (args, unknown) = E.start(parser, argv=argv, add_output_options=True,
+                              unknowns=True)
 
     if len(unknown) < 1:
         raise ValueError("please supply at least two BAM files.")
 
-    samfiles = []
-    for f in unknown:
-        samfiles.append(pysam.AlignmentFile(f, "rb"))
-
-    if args.filename_intervals:
-        raise NotImplementedError(
-            "It is not yet possible to specify intervals of interest.\
-            Repeat command without intervals option.")
-
     titles = [re.search(args.regex_identifier, x).groups()[0] for x in unknown]
 
     args.stdout.write("contig\tpos\t%s\n" % "\t".join(titles))
 
     ninput, nskipped, noutput = 0, 0, 0
-    contigs = samfiles[0].references
-
-    for contig in contigs:
-
-        missing_contig = False
-
-        positions = {}
+    with pysam.AlignmentFile(unknown[0], "rb") as samfile:
+        contigs = samfile.references
 
-        # lazy way: use dictionary
-        for x, f in enumerate(samfiles):
-            try:
-                i = f.pileup(contig)
-            except ValueError:
-                missing_contig = True
-                break
-
-            for v in i:
-                vp = v.pos
-                if vp in positions:
-                    positions[vp].append(v.n)
-                else:
-                    positions[vp] = [0] * x + [v.n]
-
-            # fill with 0 those not touched in this file
-            for p in list(positions.keys()):
-                if len(positions[p]) <= x:
-                    positions[p].append(0)
-
-        if missing_contig:
+    if args.filename_intervals:
+        intervals = collections.defaultdict(list)
+        with iotools.open_file(args.filename_intervals) as inf:
+            for bed in Bed.iterator(inf):
+                intervals[bed.contig].append((bed.start, bed.end))
+                ninput += 1
+        tasks = [(unknown, contig, Intervals.combine(intervals[contig]),
+                  args.chunk_size)
+                 for contig in contigs if contig in intervals]
+    else:
+        tasks = [(unknown, contig, None, args.chunk_size)
+                 for contig in contigs]
+
+    if args.num_threads > 1:
+        pool = multiprocessing.Pool(args.num_threads)
+        results = pool.imap(compare_contig, tasks)
+    else:
+        pool = None
+        results = map(compare_contig, tasks)
+
+    nfiles = len(unknown)
+    total_nbases = 0
+    total_sums = numpy.zeros(nfiles, dtype=numpy.float64)
+    total_cross = numpy.zeros((nfiles, nfiles), dtype=numpy.float64)
+    correlations = []
+
+    for task, result in zip(tasks, results):
+        if result is None:
             nskipped += 1
             continue
 
         noutput += 1
-        for pos in sorted(positions.keys()):
-            vals = positions[pos]
-            args.stdout.write("%s\t%i\t%s\n" % (contig, pos,
-                                                "\t".join(map(str, vals))))
+        output, (nbases, sums, cross) = result
+        args.stdout.write(output)
+
+        contig = task[1]
+        correlations.extend(
+            [(contig, x, y, nbases, coefficient)
+             for x, y, coefficient in compute_correlations(
+                 nbases, sums, cross)])
+        total_nbases += nbases
+        total_sums += sums
+        total_cross += cross
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    correlations.extend(
+        [("all", x, y, total_nbases, coefficient)
+         for x, y, coefficient in compute_correlations(
+             total_nbases, total_sums, total_cross)])
+
+    with E.open_output_file("correlation") as outf:
+        outf.write("contig\ttrack1\ttrack2\tnbases\tpearson\n")
+        for contig, x, y, nbases, coefficient in correlations:
+            outf.write("%s\t%s\t%s\t%i\t%f\n" % (
+                contig, titles[x], titles[y], nbases, coefficient))
 
     E.info("ninput=%i, noutput=%i, nskipped=%i" % (ninput, noutput, nskipped))
 
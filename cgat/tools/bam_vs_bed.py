@@ -24,12 +24,16 @@ based on a geneset with alternative transcripts. For example::
    chr1     10000     20000     protein_coding            # gene1, transcript2
 
 Any reads overlapping the interval chr1:10000-20000 will be counted
-twice into the protein_coding bin by bedtools. To avoid this, remove any
+twice into the protein_coding bin. To avoid this, remove any
 duplicates from the :term:`bed` file::
 
    zcat input_with_duplicates.bed.gz | cgat bed2bed --merge-by-name | bgzip > input_without_duplicates.bed.gz
 
-This scripts requires bedtools_ to be installed.
+Counting follows ``bedtools intersect -wo -f``, but is done within
+the script. The :term:`bed` file is indexed with a nested containment
+list and alignments are streamed from the :term:`BAM` file. Contigs
+can be processed in parallel with the ``--num-threads`` option. The
+:term:`BAM` file needs to be indexed.
 
 Options
 -------
@@ -43,6 +47,11 @@ Options
     Using this option will only count reads if they overlap with a bed entry
     by a certain minimum fraction of the read.
 
+--split-intervals
+    Only count overlap with the aligned blocks of a read, skipping
+    over introns (``N`` in the CIGAR string). The minimum overlap
+    is relative to the total length of the blocks.
+
 Example
 -------
 
@@ -74,11 +83,107 @@ Command line options
 import sys
 import collections
 import itertools
-import subprocess
+import multiprocessing
 import cgatcore.experiment as E
 import cgatcore.iotools as iotools
 import pysam
 import cgat.Bed as Bed
+import cgat.NCL as NCL
+
+# alignment files opened in this process, see count_contig
+SAMFILES = {}
+
+
+def get_blocks(read, split_intervals=False):
+    """return a list of reference blocks covered by *read*.
+
+    If *split_intervals* is set, the alignment is split at skipped
+    regions (``N``). Deletions are part of a block.
+    """
+    if not split_intervals:
+        return [(read.reference_start, read.reference_end)]
+
+    blocks = []
+    start = pos = read.reference_start
+    for op, length in read.cigartuples:
+        # M, D, =, X
+        if op in (0, 2, 7, 8):
+            pos += length
+        # N
+        elif op == 3:
+            if pos > start:
+                blocks.append((start, pos))
+            pos += length
+            start = pos
+    if pos > start:
+        blocks.append((start, pos))
+    return blocks
+
+
+def build_index(annotations):
+    """build an index from a list of (start, end, name) tuples.
+
+    Returns a tuple of the index and a list of names of the indexed
+    intervals.
+    """
+    index = NCL.NCLSimple()
+    for start, end, name in annotations:
+        index.add(start, end)
+    return index, [x[2] for x in annotations]
+
+
+def count_overlaps(alignments, index, names, min_overlap, counts):
+    """count overlaps between alignments and annotations.
+
+    *alignments* is an iterator over lists of blocks. An alignment is
+    counted for each annotation that it overlaps by at least
+    *min_overlap* of its length. Counts are added to *counts* by
+    annotation name.
+    """
+    for blocks in alignments:
+        length = sum([end - start for start, end in blocks])
+        if length <= 0:
+            continue
+        threshold = min_overlap * length
+
+        if len(blocks) == 1:
+            start, end = blocks[0]
+            for other_start, other_end, idx in index.find(start, end):
+                if min(end, other_end) - max(start, other_start) >= threshold:
+                    counts[names[idx]] += 1
+        else:
+            overlaps = collections.defaultdict(int)
+            for start, end in blocks:
+                for other_start, other_end, idx in index.find(start, end):
+                    overlaps[idx] += min(end, other_end) - \
+                        max(start, other_start)
+            for idx, overlap in overlaps.items():
+                if overlap >= threshold:
+                    counts[names[idx]] += 1
+
+
+def count_contig(args):
+    """count alignments in a contig against annotations.
+
+    *args* is a tuple of (filename, contig, annotations, min_overlap,
+    split_intervals) so that the function can be used with a process
+    pool. *annotations* is a list of (start, end, name) tuples.
+
+    Returns a :class:`collections.Counter` of counts per annotation
+    name.
+    """
+    filename, contig, annotations, min_overlap, split_intervals = args
+    if filename not in SAMFILES:
+        SAMFILES[filename] = pysam.AlignmentFile(filename, "rb")
+    samfile = SAMFILES[filename]
+
+    index, names = build_index(annotations)
+    counts = collections.Counter()
+    count_overlaps((get_blocks(read, split_intervals)
+                    for read in samfile.fetch(contig)
+                    if not read.is_unmapped),
+                   index, names, min_overlap, counts)
+    return counts
 
 
 def main(argv=None):
@@ -110,14 +215,13 @@ def main(argv=None):
     parser.add_argument(
         "-s", "--sort-bed", dest="sort_bed",
         action="store_true",
-        help="sort the bed file by chromosomal location before "
-        "processing. "
+        help="deprecated, the bed file does not need to be sorted. "
         )
 
     parser.add_argument(
         "--assume-sorted", dest="sort_bed",
         action="store_false",
-        help="assume that the bed-file is sorted by chromosomal location. "
+        help="deprecated, the bed file does not need to be sorted. "
         )
 
     parser.add_argument(
@@ -128,12 +232,18 @@ def main(argv=None):
         "counted several times as a result. "
         )
 
+    parser.add_argument("--num-threads", "--processes", dest="num_threads",
+                        type=int,
+                        help="number of worker processes. Contigs are "
+                        "processed in parallel.")
+
     parser.set_defaults(
         min_overlap=0.5,
         filename_bam=None,
         filename_bed=None,
         sort_bed=True,
         split_intervals=False,
+        num_threads=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -155,64 +265,36 @@ def main(argv=None):
     if filename_bam is None:
         raise ValueError("please supply a bam file to compare with.")
 
-    E.info("intersecting the two files")
-
     min_overlap = args.min_overlap
 
     args.stdout.write("category\talignments\n")
 
-    # get number of columns of reference bed file
-    for bed in Bed.iterator(iotools.open_file(filename_bed)):
-        ncolumns_bed = bed.columns
-        break
-    E.info("assuming %s is bed%i format" % (filename_bed, ncolumns_bed))
-
-    if ncolumns_bed < 4:
-        raise ValueError("please supply a name attribute in the bed file")
-
-    # get information about
-    if filename_bam.endswith(".bam"):
-        format = "-abam"
-        samfile = pysam.AlignmentFile(filename_bam, "rb")
-        total = samfile.mapped
-        # latest bedtools uses bed12 format when bam is input
-        ncolumns_bam = 12
-        # count per read
-        sort_key = lambda x: x.name
+    E.info("reading annotations from %s" % filename_bed)
+    annotations = collections.defaultdict(list)
+    ncolumns_bed = None
+    with iotools.open_file(filename_bed) as inf:
+        for bed in Bed.iterator(inf):
+            if ncolumns_bed is None:
+                ncolumns_bed = bed.columns
+                E.info("assuming %s is bed%i format" %
+                       (filename_bed, ncolumns_bed))
+                if ncolumns_bed < 4:
+                    raise ValueError(
+                        "please supply a name attribute in the bed file")
+            # empty intervals can not be overlapped
+            if bed.end > bed.start:
+                annotations[bed.contig].append((bed.start, bed.end, bed.name))
+
+    if ncolumns_bed is None:
+        raise ValueError("no intervals in %s" % filename_bed)
+
+    is_bam = filename_bam.endswith(".bam")
+    if is_bam:
+        with pysam.AlignmentFile(filename_bam, "rb") as samfile:
+            total = samfile.mapped
+            contigs = samfile.references
     else:
-        format = "-a"
         total = iotools.get_num_lines(filename_bam)
-        # get bed format
-        ncolumns_bam = 0
-        for bed in Bed.iterator(iotools.open_file(filename_bam)):
-            ncolumns_bam = bed.columns
-            break
-
-        if ncolumns_bam > 0:
-            E.info("assuming %s is bed%i fomat" % (filename_bam, ncolumns_bam))
-            if ncolumns_bam == 3:
-                # count per interval
-                sort_key = lambda x: (x.contig, x.start, x.end)
-            else:
-                # count per interval category
-                sort_key = lambda x: x.name
-
-    # use fields for bam/bed file (regions to count with)
-    data_fields = [
-        "contig", "start", "end", "name",
-        "score", "strand", "thickstart", "thickend", "rgb",
-        "blockcount", "blockstarts", "blockends"][:ncolumns_bam]
-
-    # add fields for second bed (regions to count in)
-    data_fields.extend([
-        "contig2", "start2", "end2", "name2",
-        "score2", "strand2", "thickstart2", "thickend2", "rgb2",
-        "blockcount2", "blockstarts2", "blockends2"][:ncolumns_bed])
-
-    # add bases overlap
-    data_fields.append("bases_overlap")
-
-    data = collections.namedtuple("data", data_fields)
 
     args.stdout.write("total\t%i\n" % total)
 
@@ -220,44 +302,43 @@ def main(argv=None):
         E.warn("no data in %s" % filename_bam)
         return
 
-    # SNS: sorting optional, off by default
-    if args.sort_bed:
-        bedcmd = "<( gunzip < %s | sort -k1,1 -k2,2n)" % filename_bed
-    else:
-        bedcmd = filename_bed
-
-    if args.split_intervals:
-        split = "-split"
-    else:
-        split = ""
-
-    # IMS: newer versions of intersectBed have a very high memory
-    #      requirement unless passed sorted bed files.
-    statement = """bedtools intersect %(format)s %(filename_bam)s
-    -b %(bedcmd)s
-    %(split)s
-    -sorted -bed -wo -f %(min_overlap)f""" % locals()
-
-    E.info("starting counting process: %s" % statement)
-    proc = E.run(statement,
-                 return_popen=True,
-                 stdout=subprocess.PIPE)
-
     E.info("counting")
-    counts_per_alignment = collections.defaultdict(int)
-    take_columns = len(data._fields)
-
-    def iterate(infile):
-        for line in infile:
-            if not line.strip():
-                continue
-            yield data._make(line[:-1].split()[:take_columns])
-
-    for read, overlaps in itertools.groupby(
-            iterate(iotools.force_str(proc.stdout)), key=sort_key):
-        annotations = [x.name2 for x in overlaps]
-        for anno in annotations:
-            counts_per_alignment[anno] += 1
+    counts_per_alignment = collections.Counter()
+
+    if is_bam:
+        tasks = [(filename_bam, contig, annotations[contig], min_overlap,
+                  args.split_intervals)
+                 for contig in contigs if contig in annotations]
+
+        if args.num_threads > 1:
+            pool = multiprocessing.Pool(args.num_threads)
+            results = pool.imap_unordered(count_contig, tasks)
+        else:
+            pool = None
+            results = map(count_contig, tasks)
+
+        for counts in results:
+            counts_per_alignment.update(counts)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    else:
+        indices = {}
+        with iotools.open_file(filename_bam) as inf:
+            for contig, beds in itertools.groupby(Bed.iterator(inf),
+                                                  key=lambda x: x.contig):
+                if contig not in annotations:
+                    continue
+                if contig not in indices:
+                    indices[contig] = build_index(annotations[contig])
+                if args.split_intervals:
+                    alignments = (bed.toIntervals() for bed in beds)
+                else:
+                    alignments = ([(bed.start, bed.end)] for bed in beds)
+                index, names = indices[contig]
+                count_overlaps(alignments, index, names, min_overlap,
+                               counts_per_alignment)
 
     for key, counts in sorted(counts_per_alignment.items()):
         args.stdout.write("%s\t%i\n" % (key, counts))
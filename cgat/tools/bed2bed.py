@@ -39,6 +39,10 @@ functionality is similar to bedtools merge, but with some additions:
 Intervals that are close but not overlapping can be merged by setting
 --merge-distance to a non-zero value
 
+If merge is the first method and intervals are merged by position
+only, the input is loaded into memory and merged with vectorized
+operations.
+
 bins
 ++++
 
@@ -162,10 +166,12 @@ Command line options
 '''
 
 import sys
+import numpy
 import cgatcore.experiment as E
 import cgat.IndexedFasta as IndexedFasta
 import cgat.Bed as Bed
 import cgat.Intervals as Intervals
+import cgat.IntervalArray as IntervalArray
 from collections import defaultdict as defaultdict
 import pysam
 import csv
@@ -331,6 +337,42 @@ def merge(iterator,
     E.info(str(c))
 
 
+def mergeArray(infile, max_distance=0, min_intervals=1):
+    """merge adjacent bed entries in *infile*.
+
+    This is a vectorized version of :func:`merge` for the case
+    without additional constraints on names, strands or blocks. The
+    file is loaded into an :class:`IntervalArray.IntervalArray` and
+    only the first entry of each merged interval is parsed.
+    """
+
+    intervals = IntervalArray.IntervalArray.fromBed(infile,
+                                                    with_records=True)
+    groups = intervals.getMergeGroups(max_distance)
+
+    c = E.Counter()
+    if len(groups) > 0:
+        firsts = numpy.flatnonzero(
+            numpy.concatenate(([True], groups[1:] != groups[:-1])))
+        counts = numpy.diff(numpy.append(firsts, len(groups)))
+        ends = numpy.maximum.reduceat(intervals.ends, firsts)
+
+        for first, count, end in zip(firsts.tolist(), counts.tolist(),
+                                     ends.tolist()):
+            c.input += 1
+            if count < min_intervals:
+                c.skipped_min_intervals += 1
+                continue
+
+            a = next(Bed.iterator([intervals.records[first] + "\n"]))
+            a.end = end
+            a.score = count
+            yield a
+            c.output += 1
+
+    E.info(str(c))
+
+
 def filterGenome(iterator, contigs):
     """remove bed intervals that are outside of contigs.
 
@@ -614,9 +656,19 @@ def main(argv=sys.argv):
         if not len(chr_map.keys()) > 0:
             raise ValueError("Empty mapping dictionnary")
 
-    processor = Bed.iterator(args.stdin)
-
-    for method in args.methods:
+    methods = args.methods
+    if methods[:1] == ["merge"] and not (args.merge_by_name or
+                                         args.remove_inconsistent_names or
+                                         args.resolve_blocks or
+                                         args.stranded):
+        processor = mergeArray(args.stdin,
+                               args.merge_distance,
+                               min_intervals=args.merge_min_intervals)
+        methods = methods[1:]
+    else:
+        processor = Bed.iterator(args.stdin)
+
+    for method in methods:
         if method == "filter-genome":
             if not contigs:
                 raise ValueError("please supply contig sizes")
@@ -30,7 +30,9 @@ If the ``--exclusive-overlap`` option is set, report exclusive
 overlap. Only intervals will be reported that overlap in a pairwise
 comparison but do not overlap with intervals in any of the other sets.
 
-This script requires bed files indexed by tabix_.
+Intervals are loaded into memory and compared with vectorized
+operations, see :mod:`IntervalArray`. The strand of intervals is
+ignored.
 
 Usage
 -----
@@ -88,40 +90,37 @@ Command line options
 import sys
 import re
 import itertools
-import collections
 
+import numpy
 import cgatcore.experiment as E
 import cgatcore.iotools as iotools
-import pysam
-import cgat.Intervals as Intervals
+import cgat.IntervalArray as IntervalArray
 
 
-def isContainedInAll(contig, start, end, bedfiles):
+def readIntervals(filename):
+    """read intervals from a bed file keeping the lines."""
+    with iotools.open_file(filename, "r") as infile:
+        return IntervalArray.IntervalArray.fromBed(infile, with_records=True)
 
-    for bedfile in bedfiles:
-        try:
-            if len(list(bedfile.fetch(contig, start, end))) == 0:
-                return False
-        except KeyError:
-            return False
-        except ValueError:
-            return False
 
-    return True
+def isContainedInAll(intervals, bedfiles):
+    """return a boolean array marking intervals that overlap an
+    interval in each of *bedfiles*."""
+
+    result = numpy.ones(len(intervals), dtype=bool)
+    for bedfile in bedfiles:
+        result &= intervals.overlaps(bedfile)
+    return result
 
 
-def isContainedInOne(contig, start, end, bedfiles):
+def isContainedInOne(intervals, bedfiles):
+    """return a boolean array marking intervals that overlap an
+    interval in any of *bedfiles*."""
 
+    result = numpy.zeros(len(intervals), dtype=bool)
     for bedfile in bedfiles:
-        try:
-            if len(list(bedfile.fetch(contig, start, end))) > 0:
-                return True
-        except KeyError:
-            pass
-        except ValueError:
-            pass
-
-    return False
+        result |= intervals.overlaps(bedfile)
+    return result
 
 
 def combineMergedIntervals(bedfiles):
@@ -135,27 +134,11 @@ def combineMergedIntervals(bedfiles):
     2. merge overlapping intervals
     3. report all intervals that overlap with an interval in each track.
 
+    Intervals are returned sorted by contig and position.
     '''
 
-    # get all intervals
-    data_per_contig = collections.defaultdict(list)
-
-    for bedfile in bedfiles:
-        for contig in bedfile.contigs:
-            i = []
-            for bed in bedfile.fetch(contig, parser=pysam.asBed()):
-                i.append((bed.start, bed.end))
-            data_per_contig[contig].extend(i)
-
-    # merge intervals
-    for contig in list(data_per_contig.keys()):
-        data_per_contig[contig] = Intervals.combine(data_per_contig[contig])
-
-    # filter intervals - take only those present in all bedfiles
-    for contig, data in sorted(data_per_contig.items()):
-        for start, end in data:
-            if isContainedInAll(contig, start, end, bedfiles):
-                yield contig, start, end
+    merged = IntervalArray.concatenate(bedfiles).merge()
+    return merged[isContainedInAll(merged, bedfiles)].sort()
 
 
 def combineUnmergedIntervals(foreground, background):
@@ -170,11 +153,7 @@ def combineUnmergedIntervals(foreground, background):
 
     '''
 
-    c = 0
-    for bed in foreground.fetch(parser=pysam.asBed()):
-        c += 1
-        if isContainedInAll(bed.contig, bed.start, bed.end, background):
-            yield bed
+    return foreground[isContainedInAll(foreground, background)]
 
 
 def main(argv=None):
@@ -226,7 +205,7 @@ def main(argv=None):
 
     tags, bedfiles = [], []
     for infile in unknown:
-        bedfiles.append(pysam.Tabixfile(infile, "r"))
+        bedfiles.append(readIntervals(infile))
         tags.append(re.search(args.pattern_id, infile).groups()[0])
 
     indices = list(range(len(bedfiles)))
@@ -252,17 +231,15 @@ def main(argv=None):
                 outf = iotools.open_file(
                     E.get_output_file(tag), "w", create_dir=True)
                 c = E.Counter()
-                for contig, start, end in combineMergedIntervals(
-                        [bedfiles[x] for x in combination]):
-                    c.found += 1
-                    if is_exclusive and isContainedInOne(contig,
-                                                         start,
-                                                         end,
-                                                         other_bed):
-                        c.removed += 1
-                        continue
-                    c.output += 1
-                    outf.write("%s\t%i\t%i\n" % (contig, start, end))
+                intervals = combineMergedIntervals(
+                    [bedfiles[x] for x in combination])
+                c.found = len(intervals)
+                if is_exclusive:
+                    intervals = intervals[
+                        ~isContainedInOne(intervals, other_bed)]
+                c.removed = c.found - len(intervals)
+                c.output = len(intervals)
+                intervals.write(outf)
 
                 outf.close()
                 E.info("combination %s finished: %s" % (tag, c))
@@ -297,18 +274,17 @@ def main(argv=None):
                     outf = iotools.open_file(
                         E.get_output_file(tag), "w", create_dir=True)
                     c = E.Counter()
-                    for bed in combineUnmergedIntervals(
-                            bedfiles[foreground],
-                            combination_bed):
-                        c.found += 1
-                        if is_exclusive and isContainedInOne(bed.contig,
-                                                             bed.start,
-                                                             bed.end,
-                                                             other_bed):
-                            c.removed += 1
-                            continue
-                        c.output += 1
-                        outf.write("%s\n" % str(bed))
+                    intervals = combineUnmergedIntervals(
+                        bedfiles[foreground],
+                        combination_bed)
+                    c.found = len(intervals)
+                    if is_exclusive:
+                        intervals = intervals[
+                            ~isContainedInOne(intervals, other_bed)]
+                    c.removed = c.found - len(intervals)
+                    c.output = len(intervals)
+                    for record in intervals.records:
+                        outf.write("%s\n" % record)
 
                     outf.close()
                     E.info("combination %s finished: %s" % (tag, c))
@@ -36,13 +36,23 @@ Then output.tsv will look like::
     chr1	17	22	2
     chr1	37	44	1
 
+Intervals that overlap or are adjacent are merged into a union
+interval. The files are loaded into interval arrays and the union
+intervals and counts are computed in a single sweep over the sorted
+interval coordinates of all samples, see :mod:`IntervalArray`.
+Input files do not need to be sorted.
+
 Options
 -------
 
-The only option other than the standard cgat options is -i, --bed-file this
-allows the input files to be provided as a comma seperated list to the option
-rather than a space delimited set of positional arguements. It is present
-purely for galaxy compatibility.
+The --bed-file option allows the input files to be provided as
+options rather than a space delimited set of positional arguments. It
+is present purely for galaxy compatibility.
+
+If --add-sample-columns is set, a column for each sample is added
+that is 1 if the sample has an interval within the union interval
+and 0 otherwise. Column names are derived from file names with the
+pattern given by --pattern-identifier.
 
 Usage
 -----
@@ -53,19 +63,52 @@ Command line options
 --------------------
 
 '''
-import tempfile
+import re
 import sys
 
-try:
-    import pybedtools
-except ImportError:
-    pass
-
+import numpy
 import cgatcore.experiment as E
-import cgat.Bed as Bed
-import collections
 import cgatcore.iotools as iotools
-import cgat.IndexedGenome as IndexedGenome
+import cgat.IntervalArray as IntervalArray
+
+
+def count_samples(samples, with_presence=False):
+    """merge intervals across samples and count samples per
+    merged interval.
+
+    Arguments
+    ---------
+    samples : list
+       List of :class:`IntervalArray.IntervalArray`, one per sample.
+
+    Returns
+    -------
+    merged : IntervalArray.IntervalArray
+       Merged intervals sorted by contig and position.
+    counts : numpy.ndarray
+       Number of samples with intervals in each merged interval.
+    presence : list
+       For each merged interval, an array of the samples with
+       intervals in the merged interval. None unless *with_presence*
+       is set.
+    """
+    nsamples = len(samples)
+    combined = IntervalArray.concatenate(samples)
+    sample_ids = numpy.repeat(numpy.arange(nsamples),
+                              [len(x) for x in samples])
+
+    merged, groups = combined.merge(with_groups=True)
+    # count each sample only once per merged interval
+    keys = numpy.unique(groups * nsamples + sample_ids)
+    counts = numpy.bincount(keys // nsamples, minlength=len(merged))
+    order = merged.argsort()
+
+    presence = None
+    if with_presence:
+        presence = numpy.split(keys % nsamples, numpy.cumsum(counts)[:-1])
+        presence = [presence[x] for x in order]
+
+    return merged[order], counts[order], presence
 
 
 def main(argv=None):
@@ -88,7 +131,19 @@ def main(argv=None):
         help="supply list of bed files",
         action="append")
 
-    parser.set_defaults(infiles=[])
+    parser.add_argument(
+        "--add-sample-columns", dest="add_sample_columns",
+        action="store_true",
+        help="add a column for each sample indicating presence (1) or "
+        "absence (0) of the sample in each merged interval")
+
+    parser.add_argument(
+        "-p", "--pattern-identifier", dest="pattern_id", type=str,
+        help="pattern to convert a filename to a sample column name")
+
+    parser.set_defaults(infiles=[],
+                        add_sample_columns=False,
+                        pattern_id="([^/]+)\\.bed")
 
     # add common options (-h/--help, ...) and parse command line
     (args, unknown) = E.start(parser,
@@ -99,55 +154,41 @@ def main(argv=None):
     if len(args.infiles) == 0:
         raise ValueError('please provide at least 1 bed file')
 
-    E.info("concatenating bed files")
-    # concatenate the list of files
-    tmp = tempfile.NamedTemporaryFile(delete=False, mode="w")
-    tmp_merge = tempfile.NamedTemporaryFile(delete=False, mode="w")
-    infs = args.infiles
-    for inf in infs:
-        for bed in Bed.iterator(iotools.open_file(inf)):
-            tmp.write("%s\n" % bed)
-    tmp.close()
-
-    E.info("merging bed entries")
-    # merge the bed entries in the file
-    name = tmp.name
-    tmp_bed = pybedtools.BedTool(name)
-    tmp_bed.sort().merge().saveas(tmp_merge.name)
-    tmp_merge.close()
-
-    E.info("indexing bed entries")
-    # index the bed entries
-    merged = IndexedGenome.Simple()
-    for bed in Bed.iterator(iotools.open_file(tmp_merge.name)):
-        merged.add(bed.contig, bed.start, bed.end)
-
-    counts = collections.defaultdict(int)
     # list of samples
     samples = args.infiles
 
-    E.info("counting no. samples overlapping each interval")
+    E.info("loading %i bed files" % len(samples))
+    arrays = []
     for sample in samples:
-        found = set()
-        for bed in Bed.iterator(iotools.open_file(sample)):
-            if merged.contains(bed.contig, bed.start, bed.end):
-                key = [bed.contig] + \
-                    [x for x in merged.get(bed.contig, bed.start, bed.end)]
-                key = (key[0], key[1][0], key[1][1])
-                if key in found:
-                    continue
-                found.add(key)
-
-                # tuple of interval description as key - (contig, start, end)
-                counts[key] += 1
-
-    # open outfile
-    args.stdout.write("contig\tstart\tend\tcount\n")
+        with iotools.open_file(sample) as infile:
+            arrays.append(IntervalArray.IntervalArray.fromBed(infile))
+
+    E.info("counting no. samples overlapping each interval")
+    merged, counts, presence = count_samples(
+        arrays, with_presence=args.add_sample_columns)
+
+    pattern_id = re.compile(args.pattern_id)
+
+    def getTitle(x):
+        try:
+            return pattern_id.search(x).groups()[0]
+        except AttributeError:
+            return x
+
+    header = ["contig", "start", "end", "count"]
+    if args.add_sample_columns:
+        header.extend([getTitle(x) for x in samples])
+    args.stdout.write("\t".join(header) + "\n")
 
     E.info("outputting result")
-    for interval, count in sorted(counts.items()):
-        args.stdout.write(
-            "\t".join(map(str, interval)) + "\t" + str(count) + "\n")
+    absent = numpy.zeros(len(samples), dtype=numpy.int64)
+    for x, (contig, start, end) in enumerate(merged):
+        fields = [contig, str(start), str(end), str(counts[x])]
+        if presence is not None:
+            row = absent.copy()
+            row[presence[x]] = 1
+            fields.extend(map(str, row.tolist()))
+        args.stdout.write("\t".join(fields) + "\n")
 
     # write footer and output benchmark information.
     E.stop()
@@ -61,6 +61,7 @@ import re
 import cgatcore.experiment as E
 import cgatcore.iotools as iotools
 import cgat.Bed as Bed
+import cgat.IntervalArray as IntervalArray
 import numpy
 
 
@@ -88,6 +89,24 @@ class Counter:
     def buildIndex(self, filename):
         return Bed.readAndIndex(iotools.open_file(filename, "r"))
 
+    @E.cached_method
+    def buildArray(self, filename):
+        with iotools.open_file(filename, "r") as infile:
+            return IntervalArray.IntervalArray.fromBed(infile)
+
+    def _countArrays(self, intervals, other):
+        '''count intervals against other.'''
+
+        # zero-length intervals are not indexed
+        other = other[other.ends > other.starts]
+        overlapping = intervals.overlaps(other) & \
+            (intervals.ends > intervals.starts)
+
+        return (len(intervals),
+                int(overlapping.sum()),
+                intervals.getLength(),
+                int(intervals.coverage(other).sum()))
+
     def _count(self, filename, idx):
         '''count filename against idx.'''
 
@@ -132,18 +151,19 @@ class Counter:
 
         E.info("counting started for %s versus %s" % (filename1, filename2))
 
-        idx2 = self.buildIndex(filename2)
+        intervals1 = self.buildArray(filename1)
+        intervals2 = self.buildArray(filename2)
 
         (self.mExons1, self.mExonsOverlapping1,
-         self.mBases1, self.mBasesOverlapping1) = self._count(filename1, idx2)
+         self.mBases1, self.mBasesOverlapping1) = self._countArrays(
+             intervals1, intervals2)
 
         self.mExonsUnique1 = self.mExons1 - self.mExonsOverlapping1
         self.mBasesUnique1 = self.mBases1 - self.mBasesOverlapping1
 
-        idx1 = self.buildIndex(filename1)
-
         (self.mExons2, self.mExonsOverlapping2,
-         self.mBases2, self.mBasesOverlapping2) = self._count(filename2, idx1)
+         self.mBases2, self.mBasesOverlapping2) = self._countArrays(
+             intervals2, intervals1)
 
         self.mExonsUnique2 = self.mExons2 - self.mExonsOverlapping2
         self.mBasesUnique2 = self.mBases2 - self.mBasesOverlapping2
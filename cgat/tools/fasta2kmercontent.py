@@ -22,6 +22,7 @@ The user specifies the kmer length that is to be searched. Note that the longer
 the kmer, the longer the script will take to run.
 
 Note the order of output will not necessarily be the same order as the input.
+See ``--output-layout`` for output formats that list contigs in input order.
 
 Usage
 -----
@@ -77,6 +78,33 @@ Two options control the behaviour of fasta2kmercontent.py; ``--kmer-size`` and
 ``--output-proportion``::
   The output values are proportions rather than absolute counts
 
+``--canonical``::
+  Collapse each kmer with its reverse complement. Counts are reported
+  for the lexicographically smaller of the two.
+
+``--sparse``::
+  Only output kmers that occur in at least one sequence. This permits
+  kmer lengths of up to 31.
+
+``--num-threads``::
+  Count kmers in several worker processes. Sequences are sent to the
+  workers in chunks.
+
+``--output-layout``::
+  ``kmer`` (default) outputs a table with a row for each kmer and a
+  column for each contig as shown above. The table can only be written
+  once all contigs have been counted. ``contig`` outputs a row for each
+  contig and a column for each kmer. ``long`` outputs a row for each
+  kmer that has been observed in a contig, with the columns ``contig``,
+  ``kmer`` and ``count``. With ``contig`` and ``long``, each contig is
+  written as soon as it has been counted, so memory usage does not grow
+  with the number of contigs. ``contig`` can not be combined with
+  ``--sparse``.
+
+Kmers are counted in a single pass over each sequence. Occurrences
+may overlap, counting is case-insensitive and kmers containing
+characters other than A, C, G and T are skipped.
+
 
 Type::
 
@@ -91,11 +119,121 @@ Command line options
 '''
 
 import sys
-import re
-import cgat.FastaIterator as FastaIterator
 import itertools
+import multiprocessing
+import numpy
+import cgat.FastaIterator as FastaIterator
 import cgatcore.experiment as E
 
+# 2-bit encoding of nucleotides, other characters are encoded as 4
+ENCODING = numpy.full(256, 4, dtype=numpy.uint8)
+for code, nucleotides in enumerate(("Aa", "Cc", "Gg", "Tt")):
+    for nucleotide in nucleotides:
+        ENCODING[ord(nucleotide)] = code
+
+MAX_KMER_DENSE = 8
+MAX_KMER_SPARSE = 31
+
+
+def encode_kmers(sequence, kmer, canonical=False):
+    """return 2-bit encoded kmers in *sequence*.
+
+    Kmers are encoded as integers with the first base in the
+    most significant position. Kmers with characters other
+    than A, C, G and T are removed.
+
+    If *canonical* is set, each kmer is replaced by the smaller
+    of itself and its reverse complement.
+    """
+    codes = ENCODING[numpy.frombuffer(sequence.encode("ascii"),
+                                      dtype=numpy.uint8)]
+    nkmers = len(codes) - kmer + 1
+    if nkmers <= 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    invalid = codes > 3
+    ninvalid = numpy.concatenate(([0], numpy.cumsum(invalid)))
+    valid = ninvalid[kmer:] == ninvalid[:-kmer]
+
+    codes = numpy.where(invalid, 0, codes).astype(numpy.int64)
+    encoded = numpy.zeros(nkmers, dtype=numpy.int64)
+    for x in range(kmer):
+        encoded = (encoded << 2) | codes[x:x + nkmers]
+
+    encoded = encoded[valid]
+    if canonical:
+        encoded = numpy.minimum(encoded,
+                                reverse_complement_kmers(encoded, kmer))
+
+    return encoded
+
+
+def reverse_complement_kmers(encoded, kmer):
+    """return the encodings of the reverse complements of kmers."""
+    reverse = numpy.zeros_like(encoded)
+    for x in range(kmer):
+        reverse = (reverse << 2) | (3 - ((encoded >> (2 * x)) & 3))
+    return reverse
+
+
+def decode_kmer(code, kmer):
+    """return kmer sequence from its 2-bit encoding."""
+    return "".join("ACGT"[(code >> (2 * x)) & 3]
+                   for x in range(kmer - 1, -1, -1))
+
+
+def count_kmers(sequence, kmer, canonical=False, sparse=False):
+    """count kmers in *sequence*.
+
+    Returns an array of counts indexed by the kmer encoding or,
+    if *sparse* is set, a tuple of arrays with the encodings of
+    the observed kmers and their counts.
+    """
+    encoded = encode_kmers(sequence, kmer, canonical)
+    if sparse:
+        return numpy.unique(encoded, return_counts=True)
+    else:
+        return numpy.bincount(encoded, minlength=4 ** kmer)
+
+
+def get_dense_kmers(kmer, canonical=False):
+    """return encodings of kmers reported in dense output."""
+    rows = numpy.arange(4 ** kmer)
+    if canonical:
+        # only keep canonical kmers
+        rows = rows[rows <= reverse_complement_kmers(rows, kmer)]
+    return rows
+
+
+def format_counts(counts, proportion=False):
+    """return *counts* as a list of strings.
+
+    If *proportion* is set, counts are divided by their total.
+    """
+    if proportion:
+        total = counts.sum()
+        if not total:
+            return ["0.0"] * len(counts)
+        return [str(float(count) / total) for count in counts.tolist()]
+    return [str(count) for count in counts.tolist()]
+
+
+def count_chunk(args):
+    """count kmers in a chunk of (title, sequence) tuples."""
+    chunk, kmer, canonical, sparse = args
+    return [(title, count_kmers(sequence, kmer, canonical, sparse))
+            for title, sequence in chunk]
+
+
+def iterate_chunks(iterator, kmer, canonical, sparse, chunk_size=1000):
+    """group fasta records into chunks of sequences for counting."""
+    while True:
+        chunk = [(x.title, x.sequence)
+                 for x in itertools.islice(iterator, chunk_size)]
+        if not chunk:
+            break
+        yield chunk, kmer, canonical, sparse
+
 
 def main(argv=None):
     """script main.
@@ -118,23 +256,48 @@ def main(argv=None):
         "-p", "--output-proportion", dest="proportion", action="store_true",
         help="output proportions - overides the default output")
 
+    parser.add_argument(
+        "--canonical", dest="canonical", action="store_true",
+        help="collapse kmers with their reverse complement")
+
+    parser.add_argument(
+        "--sparse", dest="sparse", action="store_true",
+        help="only output kmers that have been observed. Permits kmer "
+        "lengths up to %i" % MAX_KMER_SPARSE)
+
+    parser.add_argument(
+        "--num-threads", dest="num_threads", type=int,
+        help="number of worker processes to count kmers with")
+
+    parser.add_argument(
+        "--output-layout", dest="output_layout", type=str,
+        choices=("kmer", "contig", "long"),
+        help="output a row per kmer, a row per contig or a row per "
+        "observed kmer and contig. With contig and long, contigs are "
+        "written as they are counted")
+
+    parser.set_defaults(
+        canonical=False,
+        sparse=False,
+        num_threads=1,
+        output_layout="kmer")
+
     # add common options (-h/--help, ...) and parse command line
     (args) = E.start(parser, argv=argv)
 
-    # do not allow greater than octonucleotide
-    assert args.kmer <= 8, "cannot handle kmer of length %i" % args.kmer
+    if args.sparse:
+        max_kmer = MAX_KMER_SPARSE
+    else:
+        # do not allow greater than octonucleotide
+        max_kmer = MAX_KMER_DENSE
 
-    # how we deal with the nucleotides depends on the kmer length
-    nucleotides = []
-    for nucleotide in ["A", "C", "T", "G"]:
-        nucleotides = nucleotides + \
-            [x for x in itertools.repeat(nucleotide, args.kmer)]
+    if args.kmer > max_kmer:
+        raise ValueError("cannot handle kmer of length %i" % args.kmer)
 
-    E.info("retrieving %imer sequences" % args.kmer)
-    # get all kmer sequences to query
-    kmers = set()
-    for kmer in itertools.permutations(nucleotides, args.kmer):
-        kmers.add(kmer)
+    if args.output_layout == "contig" and args.sparse:
+        raise ValueError(
+            "--output-layout=contig requires dense counts, "
+            "use --output-layout=long with --sparse")
 
     E.info("matching %imers in file" % args.kmer)
     # count the number of kmers in each sequence
@@ -142,22 +305,81 @@ def main(argv=None):
     result = {}
 
     # NB assume that non fasta files are caught by FastaIterator
+    chunks = iterate_chunks(FastaIterator.iterate(args.stdin),
+                            args.kmer, args.canonical, args.sparse)
+
+    if args.num_threads > 1:
+        pool = multiprocessing.Pool(args.num_threads)
+        counted = pool.imap(count_chunk, chunks)
+    else:
+        pool = None
+        counted = map(count_chunk, chunks)
+
     total_entries = 0
-    for fasta in FastaIterator.iterate(args.stdin):
-        total_entries += 1
-        result[fasta.title] = {}
-        for kmer in kmers:
-            counts = [m.start()
-                      for m in re.finditer("".join(kmer), fasta.sequence)]
-            result[fasta.title][kmer] = len(counts)
+    if args.output_layout == "kmer":
+        for chunk in counted:
+            for title, counts in chunk:
+                total_entries += 1
+                result[title] = counts
+    else:
+        if not args.sparse:
+            kmers = get_dense_kmers(args.kmer, args.canonical)
+        if args.output_layout == "contig":
+            args.stdout.write("\t".join(
+                ["contig"] + [decode_kmer(x, args.kmer)
+                              for x in kmers.tolist()]) + "\n")
+        else:
+            args.stdout.write("contig\tkmer\t%s\n" % (
+                "proportion" if args.proportion else "count"))
+
+        for chunk in counted:
+            for title, counts in chunk:
+                total_entries += 1
+                if args.sparse:
+                    codes, counts = counts
+                else:
+                    counts = counts[kmers]
+                if args.output_layout == "contig":
+                    args.stdout.write("\t".join(
+                        [title] + format_counts(counts, args.proportion)) +
+                        "\n")
+                    continue
+                if not args.sparse:
+                    codes = kmers[counts > 0]
+                    counts = counts[counts > 0]
+                for code, value in zip(
+                        codes.tolist(),
+                        format_counts(counts, args.proportion)):
+                    args.stdout.write("%s\t%s\t%s\n" % (
+                        title, decode_kmer(code, args.kmer), value))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if args.output_layout != "kmer":
+        E.info("written kmer counts for %i contigs" % total_entries)
+        E.stop()
+        return
 
     E.info("writing results")
     # write out the results
     headers = sorted(result.keys())
-    rows = set()
-    for kmer_counts in list(result.values()):
-        for kmer, count in kmer_counts.items():
-            rows.add("".join(kmer))
+
+    if args.sparse:
+        rows = numpy.unique(numpy.concatenate(
+            [numpy.zeros(0, dtype=numpy.int64)] +
+            [result[header][0] for header in headers]))
+        matrix = numpy.zeros((len(rows), len(headers)), dtype=numpy.int64)
+        for column, header in enumerate(headers):
+            codes, counts = result[header]
+            matrix[numpy.searchsorted(rows, codes), column] = counts
+    else:
+        matrix = numpy.array(
+            [result[header] for header in headers],
+            dtype=numpy.int64).reshape(len(headers), -1).T
+        rows = get_dense_kmers(args.kmer, args.canonical)
+        matrix = matrix[rows]
 
     # write header row
     args.stdout.write("kmer\t" + "\t".join(headers) + "\n")
@@ -165,17 +387,18 @@ def main(argv=None):
     # output proportions if required - normalises by
     # sequence length
     E.info("computing total counts")
-    totals = {}
-    for header in headers:
-        totals[header] = sum([result[header][tuple(row)] for row in rows])
+    totals = matrix.sum(axis=0)
 
-    for row in sorted(rows):
+    for row, counts in zip(rows, matrix):
         if args.proportion:
             args.stdout.write("\t".join(
-                [row] + [str(float(result[header][tuple(row)]) / totals[header]) for header in headers]) + "\n")
+                [decode_kmer(row, args.kmer)] +
+                [str(float(count) / total) if total else "0.0"
+                 for count, total in zip(counts, totals)]) + "\n")
         else:
-            args.stdout.write(
-                "\t".join([row] + [str(result[header][tuple(row)]) for header in headers]) + "\n")
+            args.stdout.write("\t".join(
+                [decode_kmer(row, args.kmer)] +
+                [str(count) for count in counts]) + "\n")
 
     E.info("written kmer counts for %i contigs" % total_entries)
     # write footer and output benchmark information.
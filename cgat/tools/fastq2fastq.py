@@ -87,8 +87,16 @@ The following methods are implemented (``--method``).
 
 ``sample``
 
-    Sub-sample a fastq file. The size of the sample is set by
-    --sample-size
+    Sub-sample a fastq file. By default (``--sample-method=bernoulli``),
+    each read is sampled with the probability set by ``--sample-size``.
+    ``--sample-method=reservoir`` samples exactly ``--sample-reads``
+    reads with reservoir sampling. ``--sample-method=skip`` samples
+    like ``bernoulli`` but draws the number of reads between sampled
+    reads and skips over them without parsing. The proportion is
+    either ``--sample-size`` or ``--sample-reads`` divided by the
+    number of reads in the input given by ``--num-records``. Reads
+    that are not sampled are not parsed by the ``reservoir`` and
+    ``skip`` methods. All methods output reads in the input order.
 
 ``unique``
 
@@ -108,13 +116,25 @@ The following methods are implemented (``--method``).
 
 ``sort``
 
-    Sort the fastq file by read name.
+    Sort the fastq file by read name (``--sort-key=name``), by
+    sequence (``--sort-key=sequence``) or by the minimizer of the
+    sequence (``--sort-key=minimizer``). Sorting by sequence places
+    similar reads next to each other and improves compression. Names
+    are compared without a trailing ``/1`` or ``/2``. With
+    ``--pair-fastq-file``, both files are sorted together and must
+    contain the same reads in the same order. Records are sorted in
+    memory up to ``--sort-memory`` megabytes, larger inputs are
+    sorted in runs written to ``--tmpdir`` and then merged.
 
 ``renumber-reads``
 
     Rename the reads based on pattern given in ``--pattern-identifier``
     e.g. ``--pattern-identifier="read_%010i"``
 
+Compressed input and output files (``.gz``) are read and written
+with ``--threads`` threads. Output is written in the BGZF format,
+which can be read by any gzip reader.
+
 Type::
 
    python fastq2fastq.py --help
@@ -126,16 +146,14 @@ Command line options
 --------------------
 
 '''
-import collections
 import sys
-import os
 import re
 import random
-import pysam
 import numpy
 import cgatcore.experiment as E
 import cgatcore.iotools as iotools
 import cgat.Fastq as Fastq
+import cgat.ThreadedGzip as ThreadedGzip
 import cgat.Genomics as Genomics
 
 
@@ -146,12 +164,13 @@ def process_cgat(options):
     assert options.input_fastq_file == "-"
 
     if options.method == "change-format":
-        for record in Fastq.iterate_convert(options.stdin,
-                                            format=options.target_format,
-                                            guess=options.guess_format):
-            c.input += 1
-            options.stdout.write("%s\n" % record)
-            c.output += 1
+        for batch in Fastq.iterate_batches_convert(
+                options.stdin,
+                format=options.target_format,
+                guess=options.guess_format):
+            c.input += len(batch)
+            Fastq.write_batch(options.stdout, batch)
+            c.output += len(batch)
 
     elif options.method == "grep":
         for record in Fastq.iterate(options.stdin):
@@ -175,23 +194,67 @@ def process_cgat(options):
                     "please specify output filename pattern for "
                     "second pair (--output-filename-pattern)")
 
+        if options.sample_method == "bernoulli" and options.pair:
             outfile1 = options.stdout
-            outfile2 = iotools.open_file(options.output_filename_pattern, "w")
+            outfile2 = ThreadedGzip.open_file(
+                options.output_filename_pattern, "w",
+                threads=options.threads)
 
             for record1, record2 in zip(
                     Fastq.iterate(options.stdin),
-                    Fastq.iterate(iotools.open_file(options.pair))):
+                    Fastq.iterate(ThreadedGzip.open_file(
+                        options.pair, threads=options.threads))):
                 c.input += 1
                 if random.random() <= sample_threshold:
                     c.output += 1
                     outfile1.write("%s\n" % record1)
                     outfile2.write("%s\n" % record2)
+            outfile2.close()
+
+        elif options.sample_method == "bernoulli":
+            for batch in Fastq.iterate_batches(options.stdin):
+                c.input += len(batch)
+                batch = batch.select(numpy.array(
+                    [random.random() <= sample_threshold
+                     for x in range(len(batch))], dtype=bool))
+                c.output += len(batch)
+                Fastq.write_batch(options.stdout, batch)
+
         else:
-            for record in Fastq.iterate(options.stdin):
-                c.input += 1
-                if random.random() <= sample_threshold:
-                    c.output += 1
-                    options.stdout.write("%s\n" % record)
+            infiles = [options.stdin]
+            outfiles = [options.stdout]
+            if options.pair:
+                infiles.append(ThreadedGzip.open_file(
+                    options.pair, threads=options.threads))
+                outfiles.append(ThreadedGzip.open_file(
+                    options.output_filename_pattern, "w",
+                    threads=options.threads))
+
+            if options.sample_method == "reservoir":
+                if options.sample_reads is None:
+                    raise ValueError(
+                        "please specify the number of reads to sample "
+                        "(--sample-reads)")
+                sample = Fastq.sample_reservoir(
+                    infiles, options.sample_reads, counter=c)
+            else:
+                if options.sample_reads is not None:
+                    if not options.num_records:
+                        raise ValueError(
+                            "please specify the number of reads in the "
+                            "input (--num-records)")
+                    sample_threshold = min(
+                        1.0, options.sample_reads / options.num_records)
+                sample = Fastq.iterate_sample_skip(
+                    infiles, sample_threshold, counter=c)
+
+            for records in sample:
+                c.output += 1
+                for outfile, record in zip(outfiles, records):
+                    outfile.write(record)
+
+            for outfile in outfiles[1:]:
+                outfile.close()
 
     elif options.method == "apply":
         ids = set(iotools.read_list(iotools.open_file(options.apply)))
@@ -204,19 +267,19 @@ def process_cgat(options):
 
     elif options.method == "trim3":
         trim3 = options.nbases
-        for record in Fastq.iterate(options.stdin):
-            c.input += 1
-            record.trim(trim3)
-            options.stdout.write("%s\n" % record)
-            c.output += 1
+        for batch in Fastq.iterate_batches(options.stdin):
+            c.input += len(batch)
+            batch.trim(trim3)
+            Fastq.write_batch(options.stdout, batch)
+            c.output += len(batch)
 
     elif options.method == "trim5":
         trim5 = options.nbases
-        for record in Fastq.iterate(options.stdin):
-            c.input += 1
-            record.trim5(trim5)
-            options.stdout.write("%s\n" % record)
-            c.output += 1
+        for batch in Fastq.iterate_batches(options.stdin):
+            c.input += len(batch)
+            batch.trim5(trim5)
+            Fastq.write_batch(options.stdout, batch)
+            c.output += len(batch)
 
     elif options.method == "unique":
         keys = set()
@@ -229,51 +292,47 @@ def process_cgat(options):
             options.stdout.write("%s\n" % record)
             c.output += 1
 
-    # Need to change this to incorporate both pairs
     elif options.method == "sort":
-        if not options.pair:
-            # This is quicker for a single fastq file
-            statement = "paste - - - - | sort -k1,1 -t ' ' | tr '\t' '\n'"
-            os.system(statement)
-        else:
+        infiles = [options.stdin]
+        outfiles = [options.stdout]
+        if options.pair:
             if not options.output_filename_pattern:
                 raise ValueError(
                     "please specify output filename for second pair "
                     "(--output-filename-pattern)")
-            E.warn(
-                "consider sorting individual fastq files - "
-                "this is memory intensive")
-            entries1 = {}
-            entries2 = {}
-
-            for record1, record2 in zip(
-                    Fastq.iterate(options.stdin),
-                    Fastq.iterate(iotools.open_file(options.pair))):
-                entries1[
-                    record1.identifier[:-2]] = (record1.seq, record1.quals)
-                entries2[
-                    record2.identifier[:-2]] = (record2.seq, record2.quals)
+            infiles.append(ThreadedGzip.open_file(
+                options.pair, threads=options.threads))
+            outfiles.append(ThreadedGzip.open_file(
+                options.output_filename_pattern, "w",
+                threads=options.threads))
+
+        for records in Fastq.iterate_sorted(
+                infiles,
+                key=options.sort_key,
+                memory=options.sort_memory * 1024 * 1024,
+                tmpdir=options.tmpdir):
+            c.input += 1
+            if options.pair:
+                # paired output writes the "+" line without the read name
+                for outfile, record in zip(outfiles, records):
+                    lines = record.split(b"\n")
+                    lines[2] = b"+"
+                    outfile.write(b"\n".join(lines).decode("ascii"))
+            else:
+                options.stdout.write(records[0].decode("ascii"))
+            c.output += 1
 
-            outfile1 = options.stdout
-            outfile2 = iotools.open_file(options.output_filename_pattern, "w")
-            assert len(set(entries1.keys()).intersection(
-                set(entries2.keys()))) == len(entries1),\
-                "paired files do not contain the same reads "\
-                "need to reconcile files"
-
-            for entry in sorted(entries1):
-                outfile1.write("@%s/1\n%s\n+\n%s\n" %
-                               (entry, entries1[entry][0], entries1[entry][1]))
-                outfile2.write("@%s/2\n%s\n+\n%s\n" %
-                               (entry, entries2[entry][0], entries2[entry][1]))
+        for outfile in outfiles[1:]:
+            outfile.close()
 
     elif options.method == "renumber-reads":
         id_count = 1
-        for record in Fastq.iterate(options.stdin):
-            record.identifier = options.renumber_pattern % id_count
-            id_count += 1
-            options.stdout.write("@%s\n%s\n+\n%s\n" %
-                                 (record.identifier, record.seq, record.quals))
+        for batch in Fastq.iterate_batches(options.stdin):
+            batch.setIdentifiers(
+                [options.renumber_pattern % x for x in
+                 range(id_count, id_count + len(batch))])
+            id_count += len(batch)
+            Fastq.write_batch(options.stdout, batch)
     return c
 
 
@@ -297,7 +356,8 @@ def process_daisy(options):
         outf_removed_tsv = None
 
     if options.output_removed_fastq:
-        outf_removed_fastq = iotools.open_file(options.output_removed_fastq, "w")
+        outf_removed_fastq = ThreadedGzip.open_file(
+            options.output_removed_fastq, "w", threads=options.threads)
     else:
         outf_removed_fastq = None
 
@@ -309,56 +369,71 @@ def process_daisy(options):
     quality_offset = options.quality_offset
     counter = E.Counter()
 
-    with pysam.FastxFile(options.input_fastq_file) as inf:
-        for read in inf:
-            counter.input += 1
-            remove = False
-            if filter_n:
-                chars = collections.Counter(read.sequence)
-                if "N" in chars and \
-                   100.0 * chars["N"] / len(read.sequence) > options.max_percent_N:
-                    remove = True
-                    counter.filter_n += 1
-
-            if filter_identifier:
-                if read.name not in filter_identifier:
-                    counter.filter_identifier += 1
-                    remove = True
-
-            if filter_ont:
-                quals = read.get_quality_array()
-                n = len(quals)
-                if n < options.min_sequence_length or \
-                        float(sum(quals)) / n < options.min_average_quality:
-                    counter.remove_ont += 1
-                    remove = True
-
-            if remove:
-                counter.removed += 1
-                if outf_removed_tsv:
-                    outf_removed_tsv.write(read.name + "\n")
-                if outf_removed_fastq:
-                    outf_removed_fastq.write(str(read) + "\n")
-                continue
-
+    if options.input_fastq_file == "-":
+        inf = options.stdin
+    else:
+        inf = ThreadedGzip.open_file(options.input_fastq_file,
+                                     threads=options.threads)
+
+    for batch in Fastq.iterate_batches(inf):
+        counter.input += len(batch)
+        remove = numpy.zeros(len(batch), dtype=bool)
+        lengths = batch.getLengths()
+        names = [x.split()[0] if x else x
+                 for x in batch.getIdentifiers()]
+
+        if filter_n:
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                failed = 100.0 * batch.countBases("N") / lengths > \
+                    options.max_percent_N
+            counter.filter_n += int(failed.sum())
+            remove |= failed
+
+        if filter_identifier:
+            failed = numpy.array([x not in filter_identifier for x in names],
+                                 dtype=bool)
+            counter.filter_identifier += int(failed.sum())
+            remove |= failed
+
+        if filter_ont:
+            batch.format = "sanger"
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                failed = (lengths < options.min_sequence_length) | \
+                    (batch.sumQualities(batch.toPhred()) / lengths <
+                     options.min_average_quality)
+            counter.remove_ont += int(failed.sum())
+            remove |= failed
+
+        if remove.any():
+            removed = batch.select(remove)
+            counter.removed += len(removed)
+            if outf_removed_tsv:
+                outf_removed_tsv.write("".join(
+                    ["%s\n" % names[x] for x in numpy.flatnonzero(remove)]))
+            if outf_removed_fastq:
+                Fastq.write_batch(outf_removed_fastq, removed)
+            keep = ~remove
+            batch = batch.select(keep)
+            names = [names[x] for x in numpy.flatnonzero(keep)]
+
+        if quality_offset:
+            # Note: not outputting description
             if prefix:
-                read.name = prefix + read.name[2:]
-
-            if quality_offset:
-                quals = numpy.array(read.get_quality_array())
-                quals += quality_offset
-                quals[quals < 0] = 0
-                quals += 33
-                # pysam fastq is read-only, so fudge it:
-                # Note: not outputting description
-                read = "@{}\n{}\n+\n{}".format(
-                    read.name,
-                    read.sequence,
-                    "".join([chr(x) for x in quals]))
-
-            counter.output += 1
-
-            options.stdout.write(str(read) + "\n")
+                names = [prefix + x[2:] for x in names]
+            batch.setIdentifiers(names)
+            batch.format = "sanger"
+            quals = batch.toPhred() + quality_offset
+            quals[quals < 0] = 0
+            batch.fromPhred(quals, "sanger")
+        elif prefix:
+            batch.setIdentifiers(
+                [prefix + x[2:] for x in batch.getIdentifiers()])
+
+        counter.output += len(batch)
+        Fastq.write_batch(options.stdout, batch)
+
+    if inf != options.stdin:
+        inf.close()
 
     if outf_removed_tsv:
         outf_removed_tsv.close()
@@ -454,6 +529,25 @@ def main(argv=sys.argv):
         "Provide a proportion of reads to sample, e.g. 0.1 for 10%, "
         "0.5 for 50%, etc.")
 
+    parser.add_argument(
+        "--sample-method", dest="sample_method", type=str,
+        choices=("bernoulli", "reservoir", "skip"),
+        help="sampling method for method sample. bernoulli=sample each "
+        "read with probability --sample-size, reservoir=sample exactly "
+        "--sample-reads reads, skip=as bernoulli, but skip over reads "
+        "without parsing them.")
+
+    parser.add_argument(
+        "--sample-reads", dest="sample_reads", type=int,
+        help="number of reads to sample for --sample-method=reservoir. "
+        "For --sample-method=skip, the proportion of reads to sample "
+        "is computed from this number and --num-records.")
+
+    parser.add_argument(
+        "--num-records", dest="num_records", type=int,
+        help="number of reads in the input, for example from a previous "
+        "count. Used by --sample-method=skip.")
+
     parser.add_argument(
         "--pair-fastq-file", dest="pair", type=str,
         help="if data is paired, filename with second pair. "
@@ -480,12 +574,35 @@ def main(argv=sys.argv):
         "--grep-pattern", dest="grep_pattern", type=str,
         help="subset to reads matching pattern")
 
+    parser.add_argument(
+        "--sort-key", dest="sort_key", type=str,
+        choices=("name", "sequence", "minimizer"),
+        help="sort key for method sort. Sorting by sequence or "
+        "minimizer groups similar reads and improves compression.")
+
+    parser.add_argument(
+        "--sort-memory", dest="sort_memory", type=int,
+        help="memory budget in megabytes for method sort. Larger "
+        "inputs are sorted in runs on disk.")
+
+    parser.add_argument(
+        "--tmpdir", dest="tmpdir", type=str,
+        help="directory for temporary files.")
+
+    parser.add_argument(
+        "--threads", dest="threads", type=int,
+        help="number of threads for reading and writing gzip "
+        "compressed files.")
+
     parser.set_defaults(
         input_fastq_file="-",
         methods=[],
         change_format=None,
         guess_format=None,
         sample_size=0.1,
+        sample_method="bernoulli",
+        sample_reads=None,
+        num_records=None,
         nbases=0,
         pair=None,
         apply=None,
@@ -501,6 +618,10 @@ def main(argv=sys.argv):
         min_average_quality=0,
         min_sequence_length=0,
         quality_offset=0,
+        sort_key="name",
+        sort_memory=1024,
+        tmpdir=None,
+        threads=1,
     )
 
     (args, unknown) = E.start(parser,
@@ -511,6 +632,9 @@ def main(argv=sys.argv):
     if len(unknown) == 1:
         args.input_fastq_file = unknown[0]
 
+    args.stdin = ThreadedGzip.reopen(args.stdin, "r", args.threads)
+    args.stdout = ThreadedGzip.reopen(args.stdout, "w", args.threads)
+
     if len(args.methods) == 0:
         raise ValueError("no method specified, please use --method")
 
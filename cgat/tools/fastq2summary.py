@@ -103,12 +103,12 @@ def main(argv=None):
                               unknowns=True)
 
     if args.change_format:
-        iterator = Fastq.iterate_convert(args.stdin,
-                                         format=args.change_format,
-                                         guess=args.guess_format)
+        iterator = Fastq.iterate_batches_convert(args.stdin,
+                                                 format=args.change_format,
+                                                 guess=args.guess_format)
     else:
-        iterator = Fastq.iterate_guess(args.stdin,
-                                       guess=args.guess_format)
+        iterator = Fastq.iterate_batches_guess(args.stdin,
+                                               guess=args.guess_format)
 
     min_quality = args.min_quality
     number_of_reads = 0
@@ -117,14 +117,18 @@ def main(argv=None):
     read_qualities = []
     bases_below_min = 0
 
-    for record in iterator:
-        number_of_reads += 1
-        quals = record.toPhred()
-        length_read = len(quals)
-        number_of_bases += length_read
-        bases_below_min += len([x for x in quals if x < min_quality])
-        read_lengths.append(length_read)
-        read_qualities.append(np.mean(quals))
+    for batch in iterator:
+        number_of_reads += len(batch)
+        quals = batch.toPhred()
+        lengths = batch.qual_ends - batch.qual_starts
+        number_of_bases += lengths.sum()
+        bases_below_min += batch.sumQualities(quals < min_quality).sum()
+        read_lengths.append(lengths)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            read_qualities.append(batch.sumQualities(quals) / lengths)
+
+    read_lengths = np.concatenate(read_lengths)
+    read_qualities = np.concatenate(read_qualities)
 
     mean_length = round(np.mean(read_lengths), 2)
     median_length = round(np.median(read_lengths), 2)
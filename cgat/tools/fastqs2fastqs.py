@@ -25,7 +25,22 @@ reads might be missing from one file but not the other. The reconcile
 method will output two files containing only reads that are common to
 both files.
 
-The two files must be sorted by read identifier.
+If the reads are in the same order in both files, or both files are
+sorted by read identifier, the files are reconciled in a single pass
+walking both files in lockstep and memory usage is constant. Unpaired
+reads from both files are then written to the unpaired file in the
+order they are encountered.
+
+Otherwise, the files are read twice. The identifiers of the first
+file are collected as 128-bit digests, which requires 16 bytes of
+memory per read, and the digests of the second file are kept for
+reads with a digest found in the first file. Reads are matched by
+their digests only. With 128-bit digests, the probability of two
+different identifiers sharing a digest is negligible.
+
+The order is detected from the first ``--probe-size`` reads of each
+file. If the order of the files changes after these reads, the
+files are reconciled again using digests.
 
 Example input, read2 and read3 are only present in either of the
 files:
@@ -58,6 +73,16 @@ Example output, only the reads common to both files are output::
    +              +
    !!!            !!!
 
+filter-by-sequence
+++++++++++++++++++
+
+Split read pairs by whether either read matches any of the sequences
+in ``--input-filename-fasta``, for example to screen for vector or
+adapter contamination. A read matches if it shares more than
+``--filtering-min-kmer-matches`` k-mers of size
+``--filtering-kmer-size`` with a query sequence on the same diagonal.
+Read pairs are scored in batches using ``--threads`` threads.
+
 Usage
 -----
 
@@ -73,6 +98,10 @@ identifier and output 2 new fastq files named
 ``myReads_reconciled.1.fastq.gz`` and
 ``myReads_reconciled.2.fastq.gz``.
 
+Compressed input and output files (``.gz``) are read and written
+with ``--threads`` threads. Output is written in the BGZF format,
+which can be read by any gzip reader.
+
 Type::
 
    python fastqs2fastqs.py --help
@@ -86,11 +115,14 @@ Command line options
 
 import sys
 import re
+import hashlib
+import itertools
+import numpy
 import pysam
 
-import cgatcore.iotools as iotools
 import cgatcore.experiment as E
 import cgat.FastqTools as fastqtools
+import cgat.ThreadedGzip as ThreadedGzip
 
 
 class PatternGetter:
@@ -106,6 +138,196 @@ def plain_getter(id):
     return id
 
 
+def iterate_records(infile, id_getter=plain_getter, chop=False):
+    '''iterate over fastq records in *infile*.
+
+    Yields tuples of (id, lines). If *chop* is set, the last character
+    of the id is removed.
+    '''
+    aread = infile.readline
+    while True:
+        lines = [aread().rstrip("\r\n") for i in range(4)]
+        if not lines[0]:
+            break
+        r = id_getter(lines[0].split()[0])
+        if chop:
+            r = r[:-1]
+        yield r, lines
+
+
+def write_record(outfile, lines):
+    outfile.write("\n".join(lines) + "\n")
+
+
+def merge_records(records1, records2):
+    '''walk two streams of fastq records in lockstep.
+
+    Yields tuples of (record1, record2). Records with the same id are
+    returned together, for records present in only one stream the
+    other element is None. This requires the records to be in the
+    same order in both streams or, if reads are missing from either,
+    both streams to be sorted by id.
+
+    Raises a ValueError if the streams are in neither order.
+    '''
+    rec1, rec2 = next(records1, None), next(records2, None)
+    last1, last2 = None, None
+    is_sorted, mismatch = True, False
+
+    while rec1 is not None or rec2 is not None:
+        if rec1 is not None and rec2 is not None and rec1[0] == rec2[0]:
+            yield rec1, rec2
+            advance1 = advance2 = True
+        else:
+            mismatch = True
+            advance1 = rec2 is None or (
+                rec1 is not None and rec1[0] < rec2[0])
+            advance2 = not advance1
+            if advance1:
+                yield rec1, None
+            else:
+                yield None, rec2
+
+        if advance1:
+            last1, rec1 = rec1[0], next(records1, None)
+            is_sorted &= rec1 is None or last1 <= rec1[0]
+        if advance2:
+            last2, rec2 = rec2[0], next(records2, None)
+            is_sorted &= rec2 is None or last2 <= rec2[0]
+
+        # decisions on mismatches are only valid for sorted streams
+        if mismatch and not is_sorted:
+            raise ValueError("records are not sorted")
+
+
+def is_mergeable(records1, records2):
+    '''return True if the lists *records1* and *records2* can be
+    walked with :func:`merge_records`.'''
+    try:
+        for pair in merge_records(iter(records1), iter(records2)):
+            pass
+    except ValueError:
+        return False
+    return True
+
+
+def reconcile_sorted(records1, records2, outf1, outf2, outf_unpaired=None):
+    '''reconcile two streams of fastq records with a merge-join.
+
+    Records with the same id are written to *outf1* and *outf2*,
+    others to *outf_unpaired*. See :func:`merge_records` for the
+    order required.
+
+    Returns a counter or None if the streams are in neither
+    order. In that case, output has been written partially.
+    '''
+    counter = E.Counter()
+    try:
+        for rec1, rec2 in merge_records(records1, records2):
+            if rec1 is not None:
+                counter.input1 += 1
+            if rec2 is not None:
+                counter.input2 += 1
+            if rec1 is not None and rec2 is not None:
+                write_record(outf1, rec1[1])
+                write_record(outf2, rec2[1])
+                counter.output += 1
+            elif outf_unpaired is not None:
+                write_record(outf_unpaired, (rec1 or rec2)[1])
+    except ValueError:
+        return None
+
+    return counter
+
+
+# 128-bit digests of read identifiers as fixed-width byte strings
+DIGEST_SIZE = 16
+DIGEST_DTYPE = "S%i" % DIGEST_SIZE
+
+
+def iterate_hashed(records, chunk_size=100000):
+    '''iterate over chunks of fastq records.
+
+    Yields tuples of an array with 128-bit digests of the ids and a
+    list of records.
+    '''
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        yield numpy.frombuffer(
+            b"".join(hashlib.blake2b(x[0].encode(),
+                                     digest_size=DIGEST_SIZE).digest()
+                     for x in chunk),
+            dtype=DIGEST_DTYPE), chunk
+
+
+def find_ids(hashes, shared_hashes):
+    '''return indices into the sorted *shared_hashes* for *hashes*.
+
+    The index of unmatched digests is -1.
+    '''
+    index = numpy.searchsorted(shared_hashes, hashes)
+    index[index == len(shared_hashes)] = 0
+    if len(shared_hashes):
+        take = shared_hashes[index] == hashes
+    else:
+        take = numpy.zeros(len(hashes), dtype=bool)
+    index[~take] = -1
+    return index
+
+
+def reconcile_hashed(records1, records2, iterate1, iterate2,
+                     outf1, outf2, outf_unpaired=None):
+    '''reconcile two unsorted streams of fastq records.
+
+    Each stream is read twice. *records1* and *records2* are iterators
+    over the records for the first pass, *iterate1* and *iterate2* are
+    functions returning a new iterator for the second pass.
+
+    The first pass collects 128-bit digests of the ids in the first
+    stream and the digests in the second stream that are also in the
+    first. When writing, records are matched by digest.
+
+    Returns a counter.
+    '''
+    counter = E.Counter()
+
+    hashes1 = numpy.unique(numpy.concatenate(
+        [numpy.zeros(0, dtype=DIGEST_DTYPE)] +
+        [hashes for hashes, chunk in iterate_hashed(records1)]))
+
+    shared_hashes = [numpy.zeros(0, dtype=DIGEST_DTYPE)]
+    for hashes, chunk in iterate_hashed(records2):
+        shared_hashes.append(hashes[numpy.isin(hashes, hashes1)])
+    del hashes1
+
+    shared_hashes = numpy.sort(numpy.concatenate(shared_hashes))
+    found = numpy.zeros(len(shared_hashes), dtype=bool)
+
+    for hashes, chunk in iterate_hashed(iterate1()):
+        counter.input1 += len(chunk)
+        index = find_ids(hashes, shared_hashes)
+        found[index[index >= 0]] = True
+        for x, (id, lines) in zip(index, chunk):
+            if x >= 0:
+                write_record(outf1, lines)
+            elif outf_unpaired is not None:
+                write_record(outf_unpaired, lines)
+
+    for hashes, chunk in iterate_hashed(iterate2()):
+        counter.input2 += len(chunk)
+        index = find_ids(hashes, shared_hashes)
+        for x, (id, lines) in zip(index, chunk):
+            if x >= 0 and found[x]:
+                write_record(outf2, lines)
+                counter.output += 1
+            elif outf_unpaired is not None:
+                write_record(outf_unpaired, lines)
+
+    return counter
+
+
 def main(argv=None):
     """script main.
 
@@ -146,10 +368,15 @@ def main(argv=None):
         "--id-pattern-2", dest="id_pattern_2",
         help="As above but for read 2")
 
+    parser.add_argument(
+        "--probe-size", dest="probe_size", type=int,
+        help="number of reads at the start of each file used to "
+        "decide if the files can be reconciled in a single pass.")
+
     parser.add_argument(
         "--input-filename-fasta",
         dest="input_filename_fasta", type=str,
-        help="input filename of FASTA formatted sequence "
+        help="input filename of FASTA formatted sequences "
         "for method 'filter-by-sequence'.")
 
     parser.add_argument(
@@ -162,13 +389,20 @@ def main(argv=None):
         dest="filtering_min_kmer_matches", type=int,
         help="minimum number of matches 'filter-by-sequence'.")
 
+    parser.add_argument(
+        "--threads", dest="threads", type=int,
+        help="number of threads for reading and writing gzip "
+        "compressed files and for method 'filter-by-sequence'.")
+
     parser.set_defaults(
         method="reconcile",
         chop=False,
         unpaired=False,
+        probe_size=10000,
         input_filename_fasta=None,
         filtering_kmer_size=10,
-        filtering_min_kmer_matches=20
+        filtering_min_kmer_matches=20,
+        threads=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -196,98 +430,88 @@ def main(argv=None):
 
     if args.method == "reconcile":
 
-        # IMS: switching to no store second set of read names and only use
-        # lazily. Since generators don't have a size must keep track
-        id_lengths = {fn1: 0, fn2: 0}
-
-        def getIds(infile, id_getter=plain_getter):
-            '''return ids in infile.'''
-            aread = infile.readline
-            while True:
-                l = [aread().rstrip("\r\n") for i in range(4)]
-                if not l[0]:
-                    break
-                r = id_getter(l[0].split()[0])
-                # decide if to chop read number off
-                id_lengths[infile.name] += 1
-                if args.chop:
-                    yield r[:-1]
-                else:
-                    yield r
-
-        def write(outfile, infile, take, unpaired_file=None,
-                  id_getter=plain_getter):
-            '''filter fastq files with ids in take.'''
-            aread = infile.readline
-            while True:
-                l = [aread().rstrip("\r\n") for i in range(4)]
-                if not l[0]:
-                    break
-                r = id_getter(l[0].split()[0])
-                if args.chop:
-                    r = r[:-1]
-                if r not in take:
-                    if unpaired_file is None:
-                        continue
-                    else:
-                        unpaired_file.write("\n".join(l) + "\n")
-                else:
-                    outfile.write("\n".join(l) + "\n")
-
-        E.info("reading first in pair")
-        inf1 = iotools.open_file(fn1)
-        ids1 = set(getIds(inf1, id1_getter))
-
-        E.info("reading second in pair")
-        inf2 = iotools.open_file(fn2)
-        # IMS: No longer keep as a set, but lazily evaluate into intersection
-        # leads to large memory saving for large inf2, particularly if
-        # inf1 is small.
-        ids2 = getIds(inf2, id2_getter)
-        take = ids1.intersection(ids2)
-
-        E.info("first pair: %i reads, second pair: %i reads, "
-               "shared: %i reads" %
-               (id_lengths[fn1],
-                id_lengths[fn2],
-                len(take)))
-
-        if args.unpaired:
-            unpaired_filename = E.open_output_file(
-                "unpaired.fastq.gz", "w")
+        def open_outputs():
+            outfiles = [
+                ThreadedGzip.open_output_file(
+                    "1", "w", threads=args.threads),
+                ThreadedGzip.open_output_file(
+                    "2", "w", threads=args.threads)]
+            if args.unpaired:
+                outfiles.append(ThreadedGzip.open_output_file(
+                    "unpaired.fastq.gz", "w", threads=args.threads))
+            else:
+                outfiles.append(None)
+            return outfiles
+
+        def iterate_records1():
+            with ThreadedGzip.open_file(fn1, threads=args.threads) as inf:
+                yield from iterate_records(inf, id1_getter, args.chop)
+
+        def iterate_records2():
+            with ThreadedGzip.open_file(fn2, threads=args.threads) as inf:
+                yield from iterate_records(inf, id2_getter, args.chop)
+
+        outfiles = open_outputs()
+
+        records1, records2 = iterate_records1(), iterate_records2()
+        # decide on the method from the first records. These are
+        # kept and passed on so that no input is read again.
+        probe1 = list(itertools.islice(records1, args.probe_size))
+        probe2 = list(itertools.islice(records2, args.probe_size))
+        records1 = itertools.chain(probe1, records1)
+        records2 = itertools.chain(probe2, records2)
+
+        if is_mergeable(probe1, probe2):
+            E.info("reconciling sorted reads")
+            counter = reconcile_sorted(records1, records2, *outfiles)
+            if counter is None:
+                # the order was violated after the first records,
+                # restart from the beginning.
+                E.warn("reads are not sorted, restarting with hashed "
+                       "identifiers")
+                for outfile in outfiles:
+                    if outfile is not None:
+                        outfile.close()
+                # output files have been created by the first attempt
+                args.output_force = True
+                outfiles = open_outputs()
+                records1, records2 = iterate_records1(), iterate_records2()
         else:
-            unpaired_filename = None
-
-        with E.open_output_file("1", "w") as outf:
-            inf = iotools.open_file(fn1)
-            E.info("writing first in pair")
-            write(outf, inf, take, unpaired_filename, id1_getter)
+            counter = None
 
-        with E.open_output_file("2", "w") as outf:
-            inf = iotools.open_file(fn2)
-            E.info("writing second in pair")
-            write(outf, inf, take, unpaired_filename, id2_getter)
+        if counter is None:
+            E.info("reconciling by hashed identifiers")
+            counter = reconcile_hashed(records1, records2,
+                                       iterate_records1, iterate_records2,
+                                       *outfiles)
 
-        counter.output = len(take)
+        for outfile in outfiles:
+            if outfile is not None:
+                outfile.close()
 
-        if args.unpaired:
-            unpaired_filename.close()
+        E.info("first pair: %i reads, second pair: %i reads, "
+               "shared: %i reads" %
+               (counter.input1,
+                counter.input2,
+                counter.output))
 
     elif args.method == "filter-by-sequence":
 
         with pysam.FastxFile(args.input_filename_fasta) as inf:
-            for record in inf:
-                query_sequence = record.sequence
-                break
+            query_sequences = [record.sequence for record in inf]
 
         with pysam.FastxFile(fn1, persist=False) as inf1, \
                 pysam.FastxFile(fn2, persist=False) as inf2, \
-                E.open_output_file("matched.fastq.1.gz", "w") as outf_matched1, \
-                E.open_output_file("matched.fastq.2.gz", "w") as outf_matched2, \
-                E.open_output_file("unmatched.fastq.1.gz", "w") as outf_unmatched1, \
-                E.open_output_file("unmatched.fastq.2.gz", "w") as outf_unmatched2:
+                ThreadedGzip.open_output_file(
+                    "matched.fastq.1.gz", "w", threads=args.threads) as outf_matched1, \
+                ThreadedGzip.open_output_file(
+                    "matched.fastq.2.gz", "w", threads=args.threads) as outf_matched2, \
+                ThreadedGzip.open_output_file(
+                    "unmatched.fastq.1.gz", "w", threads=args.threads) as outf_unmatched1, \
+                ThreadedGzip.open_output_file(
+                    "unmatched.fastq.2.gz", "w", threads=args.threads) as outf_unmatched2:
             counter = fastqtools.filter_by_sequence(
-                query_sequence,
+                query_sequences,
                 inf1,
                 inf2,
                 outf_matched1,
@@ -295,7 +519,8 @@ def main(argv=None):
                 outf_unmatched1,
                 outf_unmatched2,
                 kmer_size=args.filtering_kmer_size,
-                min_kmer_matches=args.filtering_min_kmer_matches)
+                min_kmer_matches=args.filtering_min_kmer_matches,
+                num_threads=args.threads)
         args.stdout.write(
             "\t".join(("input", "matched", "unmatched", "percent_matched")) + "\n")
 
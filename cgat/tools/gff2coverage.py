@@ -107,13 +107,18 @@ import sys
 import math
 import collections
 
+import numpy
 import cgatcore.experiment as E
 import cgat.IndexedFasta as IndexedFasta
 import cgat.GTF as GTF
 
 
 def printValues(contig, max_size, window_size, values, options):
-    """output values."""
+    """output values.
+
+    *values* is an array with a row for each bin and a column
+    for each feature.
+    """
 
     outfile = E.open_output_file(contig, "w")
 
@@ -123,26 +128,52 @@ def printValues(contig, max_size, window_size, values, options):
         outfile.write("\tabs_%s\trel_%s" % (feature, feature))
     outfile.write("\n")
 
-    max_vv = []
+    positions = numpy.arange(len(values), dtype=numpy.int64) * window_size
+    max_vv = values.max(axis=0).astype(numpy.float64)
+    relative = numpy.zeros(values.shape, dtype=numpy.float64)
+    numpy.divide(values, max_vv, out=relative, where=max_vv > 0)
 
-    for f in range(len(options.features)):
-        max_vv.append(float(max([x[f] for x in values])))
+    columns = [positions, positions / float(max_size)]
+    for x in range(len(options.features)):
+        columns.extend((values[:, x], relative[:, x]))
 
-    bin = 0
-    for vv in values:
-        outfile.write("%i\t" % bin)
-        outfile.write(options.value_format % (float(bin) / max_size))
-
-        for x in range(len(options.features)):
-            outfile.write("\t%i\t%s" % (
-                vv[x],
-                options.value_format % (vv[x] / max_vv[x])))
-        outfile.write("\n")
-        bin += window_size
+    numpy.savetxt(outfile,
+                  numpy.column_stack(columns),
+                  fmt=["%i", options.value_format] *
+                  (len(options.features) + 1),
+                  delimiter="\t")
 
     outfile.close()
 
 
+def checkOverlap(chunk, starts, ends):
+    """raise ValueError if features in *chunk* overlap.
+
+    Features on different strands may overlap.
+    """
+    strands = numpy.unique([x.strand for x in chunk], return_inverse=True)[1]
+    index = numpy.flatnonzero(ends > starts)
+    if len(index) < 2:
+        return
+
+    # place strands one after another on a single coordinate line
+    offset = int(ends.max()) + 1
+    coordinates = strands[index] * offset
+    order = numpy.lexsort((starts[index], coordinates))
+    index = index[order]
+    max_ends = numpy.maximum.accumulate(coordinates[order] + ends[index])
+    overlapping = numpy.flatnonzero(
+        coordinates[order][1:] + starts[index][1:] < max_ends[:-1])
+    if len(overlapping):
+        x = overlapping[0]
+        other = numpy.argmax(coordinates[order][:x + 1] +
+                             ends[index][:x + 1])
+        raise ValueError(" Histogram could not be created"
+                         " since the file contains overlapping "
+                         "features! \n%s\n%s  "
+                         % (chunk[index[other]], chunk[index[x + 1]]))
+
+
 def processChunk(contig, chunk, options, fasta=None):
     """
     This function requires segments to be non-overlapping.
@@ -151,22 +182,14 @@ def processChunk(contig, chunk, options, fasta=None):
     if len(chunk) == 0:
         return
 
+    starts = numpy.array([x.start for x in chunk], dtype=numpy.int64)
+    ends = numpy.array([x.end for x in chunk], dtype=numpy.int64)
+
     # check whether there are overlapping features or not
-    checked = []
-    for feature in chunk:
-        checked.append(feature)
-        others = [x for x in chunk if x not in checked]
-        for otherFeature in others:
-            if GTF.Overlap(feature, otherFeature):
-                raise ValueError(" Histogram could not be created"
-                                 " since the file contains overlapping "
-                                 "features! \n%s\n%s  "
-                                 % (feature, otherFeature))
-    # clear auxiliary list
-    del checked[:]
+    checkOverlap(chunk, starts, ends)
 
     # compute max_coordinate for the histogram
-    max_coordinate = max([x.end for x in chunk])
+    max_coordinate = int(ends.max())
     # compute window size
     if options.window_size:
         window_size = options.window_size
@@ -186,38 +209,31 @@ def processChunk(contig, chunk, options, fasta=None):
         raise ValueError("please specify a window size of provide "
                          "genomic sequence with number of bins.")
 
-    values = [[] for x in range(num_bins)]
-
-    # do several parses for each feature, slow, but easier to code
-    # alternatively: sort by feature and location.
-    for feature in options.features:
-        total = 0
-        bin = 0
-        end = window_size
-        for entry in chunk:
-            if entry.feature != feature:
-                continue
-
-            while end < entry.start:
-                values[bin].append(total)
-                bin += 1
-                end += window_size
-
-            while entry.end > end:
-                seg_start = max(entry.start, end - window_size)
-                seg_end = min(entry.end, end)
-                total += seg_end - seg_start
-                values[bin].append(total)
-                end += window_size
-                bin += 1
-            else:
-                seg_start = max(entry.start, end - window_size)
-                seg_end = min(entry.end, end)
-                total += seg_end - seg_start
-
-        while bin < num_bins:
-            values[bin].append(total)
-            bin += 1
+    # The value of a bin is the number of bases covered by a feature
+    # before the end of the bin. All features are processed at once
+    # by placing features one after another on a single coordinate
+    # line.
+    map_feature2code = dict((y, x) for x, y in enumerate(options.features))
+    codes = numpy.array([map_feature2code.get(x.feature, -1) for x in chunk],
+                        dtype=numpy.int64)
+    take = codes >= 0
+    offset = max(max_coordinate, num_bins * window_size) + 1
+    feature_starts = numpy.sort(codes[take] * offset + starts[take])
+    feature_ends = numpy.sort(codes[take] * offset + ends[take])
+    sum_starts = numpy.concatenate(([0], numpy.cumsum(feature_starts)))
+    sum_ends = numpy.concatenate(([0], numpy.cumsum(feature_ends)))
+
+    def covered_before(positions):
+        nstarts = numpy.searchsorted(feature_starts, positions)
+        nends = numpy.searchsorted(feature_ends, positions)
+        return (nstarts * positions - sum_starts[nstarts]) - \
+            (nends * positions - sum_ends[nends])
+
+    feature_offsets = numpy.arange(len(options.features),
+                                   dtype=numpy.int64) * offset
+    bin_ends = numpy.arange(1, num_bins + 1, dtype=numpy.int64) * window_size
+    values = covered_before(bin_ends[:, None] + feature_offsets) - \
+        covered_before(feature_offsets)
 
     printValues(contig, max_coordinate, window_size, values, options)
 
@@ -232,7 +232,8 @@ def main(argv=None):
     (args) = E.start(parser)
 
     if args.genome_file:
-        fasta = IndexedFasta.IndexedFasta(args.genome_file)
+        fasta = IndexedFasta.IndexedFasta(args.genome_file,
+                                          memory_map=True)
         contigs = fasta.getContigSizes()
 
     if args.is_gtf:
@@ -353,8 +354,8 @@ def main(argv=None):
                          for x in intervals[::-1]]
             out.reverse()
 
-        s = [fasta.getSequence(contig, strand, start, end)
-             for start, end in intervals]
+        s = fasta.getSequences([(contig, strand, start, end)
+                                for start, end in intervals])
         # IMS: allow for masking of sequences
         s = Masker.maskSequences(s, args.masker)
         l = sum([len(x) for x in s])
@@ -518,7 +518,8 @@ def main(argv=None):
     if not args.genome_file:
         raise ValueError("an indexed genome is required.")
 
-    fasta = IndexedFasta.IndexedFasta(args.genome_file)
+    fasta = IndexedFasta.IndexedFasta(args.genome_file,
+                                      memory_map=True)
 
     iterator = GTF.transcript_iterator(GTF.iterator(args.stdin))
 
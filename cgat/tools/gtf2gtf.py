@@ -46,11 +46,15 @@ Sorting gene sets
    +-----------------+---------------------------------------+
    | gene+position   | gene_id, contig, start                |
    +-----------------+---------------------------------------+
-   | gene+exon       | gene_id, exon_id                      |
+   | gene+exon       | gene_id, exon_number                  |
    +-----------------+---------------------------------------+
 
-   N.B. position+gene sorts by gene_id, start, then subsequently sorts
-   flattened gene lists by contig, start
+   N.B. position+gene sorts genes by the contig and start of their
+   first feature and features within a gene by start.
+
+   Entries are sorted in memory up to ``--sort-memory`` megabytes,
+   larger inputs are sorted in runs written to ``--tmpdir`` and then
+   merged.
 
 
 Manipulating gene-models
@@ -387,6 +391,17 @@ def main(argv=None):
                                  "gene+exon"),
                         help="sort input data.")
 
+    parser.add_argument("--sort-memory",
+                        dest="sort_memory",
+                        type=int,
+                        help="memory budget in megabytes for method sort. "
+                        "Larger inputs are sorted in runs on disk.")
+
+    parser.add_argument("--tmpdir",
+                        dest="tmpdir",
+                        type=str,
+                        help="directory for temporary files.")
+
     parser.add_argument("--mark-utr",
                         dest="mark_utr",
                         action="store_true",
@@ -519,6 +534,8 @@ def main(argv=None):
 
     parser.set_defaults(
         sort_order="gene",
+        sort_memory=1024,
+        tmpdir=None,
         filter_method="gene",
         pattern="%i",
         merge_exons_distance=0,
@@ -674,8 +691,11 @@ def main(argv=None):
 
     elif "sort" == args.method:
 
-        for gff in GTF.iterator_sorted(GTF.iterator(args.stdin),
-                                       sort_order=args.sort_order):
+        for gff in GTF.iterator_sorted(
+                GTF.iterator(args.stdin),
+                sort_order=args.sort_order,
+                memory=args.sort_memory * 1024 * 1024,
+                tmpdir=args.tmpdir):
             ninput += 1
             args.stdout.write("%s\n" % str(gff))
             noutput += 1
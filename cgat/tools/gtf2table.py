@@ -444,6 +444,18 @@ convention. A summary is `here
 For unstranded protocols, all reads and pairs are considered to matching
 in the sense direction.
 
+Parallel processing
+-------------------
+
+With ``--num-threads``, gene or transcript models are sent in blocks
+of ``--chunk-size`` models to a pool of worker processes. Each worker
+sets up its own counters, opening the genome, :term:`bam` and
+:term:`bigwig` files and reading any secondary annotation itself.
+Rows are output in input order and the per-counter statistics are
+aggregated across workers, so the output is identical to a serial
+run. Counters that write additional output files, such as
+``read-extension``, are always run in a single process.
+
 Usage
 -----
 
@@ -459,6 +471,11 @@ Command line options
 '''
 
 import sys
+import io
+import argparse
+import itertools
+import multiprocessing
+import pickle
 import pysam
 
 import cgatcore.experiment as E
@@ -469,190 +486,17 @@ import cgat.GeneModelAnalysis as GeneModelAnalysis
 import pyBigWig
 
 
-def main(argv=None):
-
-    parser = E.ArgumentParser(description=__doc__)
-
-    parser.add_argument("-g", "--genome-file", dest="genome_file", type=str,
-                        help="filename with genome.")
-
-    parser.add_argument("-q", "--quality-file",
-                        dest="quality_file",
-                        type=str,
-                        help="filename with genomic base quality "
-                        "information.")
-
-    parser.add_argument("-b", "--bam-file", dest="bam_files",
-                        type=str, metavar="bam",
-                        help="filename with read mapping information. "
-                        "Multiple files can be submitted in a "
-                        "comma-separated list.")
-
-    parser.add_argument("-i", "--bigwig-file", dest="bigwig_file",
-                        type=str, metavar="bigwig",
-                        help="filename with bigwig information ")
-
-    parser.add_argument("-f", "--gff-file", dest="filename_gff",
-                        type=str, action="append", metavar='bed',
-                        help="filename with extra gff files. The order "
-                        "is important.")
-
-    parser.add_argument("--filename-format", dest="filename_format",
-                        type=str,
-                        choices=("bed", "gff", "gtf"),
-                        help="format of secondary stream.")
-
-    parser.add_argument("--restrict-source", dest="gff_sources", type=str,
-                        action="append",
-                        help="restrict input to this 'source' in extra "
-                        "gff file (for counter: overlap).")
-
-    parser.add_argument("--restrict-feature", dest="gff_features", type=str,
-                        action="append",
-                        help="restrict input to this 'feature' in extra gff "
-                        "file (for counter: overlap).")
-
-    parser.add_argument("-r", "--reporter", dest="reporter", type=str,
-                        choices=("genes", "transcripts"),
-                        help="report results for 'genes' or 'transcripts' ")
-
-    parser.add_argument("-s", "--section", dest="sections",
-                        type=str,
-                        action="append",
-                        choices=("exons", "introns"),
-                        help="select range on which counters will operate ")
-
-    parser.add_argument("-c", "--counter", dest="counters",
-                        type=str,
-                        action="append",
-                        choices=("bigwig-counts",
-                                 "binding-pattern",
-                                 "classifier",
-                                 "classifier-rnaseq",
-                                 "classifier-rnaseq-splicing",
-                                 "classifier-polii",
-                                 "composition-na",
-                                 "composition-cpg",
-                                 "coverage",
-                                 "distance",
-                                 "distance-genes",
-                                 "distance-tss",
-                                 "length",
-                                 'neighbours',
-                                 "overlap",
-                                 "overlap-stranded",
-                                 "overlap-transcripts",
-                                 "overrun",
-                                 "position",
-                                 "proximity",
-                                 "proximity-exclusive",
-                                 "proximity-lengthmatched",
-                                 "quality",
-                                 "read-coverage",
-                                 "read-extension",
-                                 "read-overlap",
-                                 "read-counts",
-                                 "read-fullcounts",
-                                 "readpair-counts",
-                                 "readpair-fullcounts",
-                                 "splice",
-                                 "splice-comparison",
-                                 "territories"),
-                        help="select counters to apply to input ")
-
-    parser.add_argument("--add-gtf-source", dest="add_gtf_source",
-                        action="store_true",
-                        help="add gtf field of source to output ")
-
-    parser.add_argument("--proximal-distance", dest="proximal_distance",
-                        type=int,
-                        help="distance to be considered proximal to "
-                        "an interval.")
-
-    parser.add_argument("--multi-mapping-method",
-                        dest="multi_mapping",
-                        type=str,
-                        choices=('all', 'ignore', 'weight'),
-                        help="how to treat multi-mapping reads in "
-                        "bam-files. Requires "
-                        "the NH flag to be set by the mapper ")
-
-    parser.add_argument("--use-barcodes",
-                        dest="use_barcodes",
-                        action="store_true",
-                        help="Use barcodes to count unique umi's. "
-                        "UMI's are specified in the read identifier "
-                        "as the last field, where fields are separated "
-                        "by underscores, e.g. "
-                        "@READ:ILLUMINA:STUFF_NAMINGSTUFF_UMI. "
-                        "When true, unique counts are returned. "
-                        "Currently only compatible with count-reads")
+def build_counters(args):
+    """set up counters as specified by the command line options.
 
-    parser.add_argument("--sample-probability",
-                        dest="sample_probability",
-                        type=float,
-                        help="Specify the probability of whether any"
-                        "given read or read pair in a file bam is counted"
-                        "Currently only compatible with count-reads")
-
-    parser.add_argument("--column-prefix", dest="prefixes",
-                        type=str,
-                        action="append",
-                        help="add prefix to column headers - prefixes "
-                        "are used in the same order as the counters ")
-
-    parser.add_argument("--library-type",
-                        dest="library_type",
-                        type=str,
-                        choices=("unstranded",
-                                 "firststrand",
-                                 "secondstrand",
-                                 "fr-unstranded",
-                                 "fr-firststrand",
-                                 "fr-secondstrand"),
-                        help="library type of reads in bam file. ")
-
-    parser.add_argument("--min-mapping-quality",
-                        dest="minimum_mapping_quality",
-                        type=float,
-                        help="minimum mapping quality. Reads with a quality "
-                        "score of less will be ignored. ")
-
-    parser.set_defaults(
-        genome_file=None,
-        reporter="genes",
-        with_values=True,
-        sections=[],
-        counters=[],
-        filename_gff=[],
-        filename_format=None,
-        gff_features=[],
-        gff_sources=[],
-        add_gtf_source=False,
-        proximal_distance=10000,
-        bam_files=None,
-        multi_mapping='all',
-        library_type='fr-unstranded',
-        prefixes=[],
-        minimum_mapping_quality=0,
-        use_barcodes=False,
-        sample_probability=1.0
-    )
-
-    if not argv:
-        argv = sys.argv
-
-    (args) = E.start(parser, add_output_options=True, argv=argv)
-
-    if args.prefixes:
-        if len(args.prefixes) != len(args.counters):
-            raise ValueError(
-                "if any prefix is given, the number of prefixes "
-                "must be the same as the number of counters")
+    Opens the genome, quality, :term:`bam` and :term:`bigwig` files
+    required by the counters.
+    """
 
     # get files
     if args.genome_file:
-        fasta = IndexedFasta.IndexedFasta(args.genome_file)
+        fasta = IndexedFasta.IndexedFasta(args.genome_file,
+                                          memory_map=True)
     else:
         fasta = None
 
@@ -685,8 +529,6 @@ def main(argv=None):
     if not args.gff_features:
         args.gff_features.append(None)
 
-    cc = E.Counter()
-
     for n, c in enumerate(args.counters):
         if args.prefixes:
             prefix = args.prefixes[n]
@@ -890,41 +732,345 @@ def main(argv=None):
                 options=args,
                 prefix=prefix))
 
+    return counters
+
+
+def annotate(gffs, counters, args):
+    """apply counters to a gene or transcript model.
+
+    Returns the output row or None if all counters skipped the model.
+    """
+    for counter in counters:
+        counter.update(gffs)
+
+    if all(counter.skip for counter in counters):
+        return None
+
+    if args.reporter == "genes":
+        row = [gffs[0].gene_id]
+    else:
+        row = [gffs[0].transcript_id]
+    if args.add_gtf_source:
+        row.append(gffs[0].source)
+
+    return "\t".join(row + [str(counter) for counter in counters]) + "\n"
+
+
+# counters that write to files of their own and can not be run
+# in worker processes
+FILE_COUNTERS = ("read-extension",)
+
+# options and counters in a worker process, see init_worker
+WORKER_ARGS = None
+WORKER_COUNTERS = None
+
+
+def get_worker_args(args):
+    """return a copy of the options in *args* for a worker process.
+
+    Options that can not be pickled, such as the open input and
+    output streams, are removed.
+    """
+    worker_args = argparse.Namespace()
+    for key, value in vars(args).items():
+        try:
+            pickle.dumps(value)
+        except (TypeError, AttributeError, pickle.PicklingError):
+            continue
+        setattr(worker_args, key, value)
+    return worker_args
+
+
+def init_worker(args):
+    """set up counters in a worker process.
+
+    *args* are the options returned by :func:`get_worker_args`.
+    """
+    global WORKER_ARGS, WORKER_COUNTERS
+    WORKER_ARGS = args
+    WORKER_COUNTERS = build_counters(args)
+
+
+def annotate_chunk(chunk):
+    """annotate a chunk of gene or transcript models in a worker process.
+
+    Models are passed as :term:`gtf` formatted text as parsed entries
+    can not be pickled.
+
+    Returns a tuple of output rows, number of skipped models and
+    the statistics of each counter for this chunk.
+    """
+    counters = WORKER_COUNTERS
+    for counter in counters:
+        counter.counter = E.Counter()
+
+    rows, nskipped = [], 0
+    for text in chunk:
+        gffs = list(GTF.iterator(io.StringIO(text)))
+        row = annotate(gffs, counters, WORKER_ARGS)
+        if row is None:
+            nskipped += 1
+        else:
+            rows.append(row)
+
+    return (rows, nskipped,
+            [dict(counter.counter.items()) for counter in counters])
+
+
+def main(argv=None):
+
+    parser = E.ArgumentParser(description=__doc__)
+
+    parser.add_argument("-g", "--genome-file", dest="genome_file", type=str,
+                        help="filename with genome.")
+
+    parser.add_argument("-q", "--quality-file",
+                        dest="quality_file",
+                        type=str,
+                        help="filename with genomic base quality "
+                        "information.")
+
+    parser.add_argument("-b", "--bam-file", dest="bam_files",
+                        type=str, metavar="bam",
+                        help="filename with read mapping information. "
+                        "Multiple files can be submitted in a "
+                        "comma-separated list.")
+
+    parser.add_argument("-i", "--bigwig-file", dest="bigwig_file",
+                        type=str, metavar="bigwig",
+                        help="filename with bigwig information ")
+
+    parser.add_argument("-f", "--gff-file", dest="filename_gff",
+                        type=str, action="append", metavar='bed',
+                        help="filename with extra gff files. The order "
+                        "is important.")
+
+    parser.add_argument("--filename-format", dest="filename_format",
+                        type=str,
+                        choices=("bed", "gff", "gtf"),
+                        help="format of secondary stream.")
+
+    parser.add_argument("--restrict-source", dest="gff_sources", type=str,
+                        action="append",
+                        help="restrict input to this 'source' in extra "
+                        "gff file (for counter: overlap).")
+
+    parser.add_argument("--restrict-feature", dest="gff_features", type=str,
+                        action="append",
+                        help="restrict input to this 'feature' in extra gff "
+                        "file (for counter: overlap).")
+
+    parser.add_argument("-r", "--reporter", dest="reporter", type=str,
+                        choices=("genes", "transcripts"),
+                        help="report results for 'genes' or 'transcripts' ")
+
+    parser.add_argument("-s", "--section", dest="sections",
+                        type=str,
+                        action="append",
+                        choices=("exons", "introns"),
+                        help="select range on which counters will operate ")
+
+    parser.add_argument("-c", "--counter", dest="counters",
+                        type=str,
+                        action="append",
+                        choices=("bigwig-counts",
+                                 "binding-pattern",
+                                 "classifier",
+                                 "classifier-rnaseq",
+                                 "classifier-rnaseq-splicing",
+                                 "classifier-polii",
+                                 "composition-na",
+                                 "composition-cpg",
+                                 "coverage",
+                                 "distance",
+                                 "distance-genes",
+                                 "distance-tss",
+                                 "length",
+                                 'neighbours',
+                                 "overlap",
+                                 "overlap-stranded",
+                                 "overlap-transcripts",
+                                 "overrun",
+                                 "position",
+                                 "proximity",
+                                 "proximity-exclusive",
+                                 "proximity-lengthmatched",
+                                 "quality",
+                                 "read-coverage",
+                                 "read-extension",
+                                 "read-overlap",
+                                 "read-counts",
+                                 "read-fullcounts",
+                                 "readpair-counts",
+                                 "readpair-fullcounts",
+                                 "splice",
+                                 "splice-comparison",
+                                 "territories"),
+                        help="select counters to apply to input ")
+
+    parser.add_argument("--add-gtf-source", dest="add_gtf_source",
+                        action="store_true",
+                        help="add gtf field of source to output ")
+
+    parser.add_argument("--proximal-distance", dest="proximal_distance",
+                        type=int,
+                        help="distance to be considered proximal to "
+                        "an interval.")
+
+    parser.add_argument("--multi-mapping-method",
+                        dest="multi_mapping",
+                        type=str,
+                        choices=('all', 'ignore', 'weight'),
+                        help="how to treat multi-mapping reads in "
+                        "bam-files. Requires "
+                        "the NH flag to be set by the mapper ")
+
+    parser.add_argument("--use-barcodes",
+                        dest="use_barcodes",
+                        action="store_true",
+                        help="Use barcodes to count unique umi's. "
+                        "UMI's are specified in the read identifier "
+                        "as the last field, where fields are separated "
+                        "by underscores, e.g. "
+                        "@READ:ILLUMINA:STUFF_NAMINGSTUFF_UMI. "
+                        "When true, unique counts are returned. "
+                        "Currently only compatible with count-reads")
+
+    parser.add_argument("--sample-probability",
+                        dest="sample_probability",
+                        type=float,
+                        help="Specify the probability of whether any"
+                        "given read or read pair in a file bam is counted"
+                        "Currently only compatible with count-reads")
+
+    parser.add_argument("--column-prefix", dest="prefixes",
+                        type=str,
+                        action="append",
+                        help="add prefix to column headers - prefixes "
+                        "are used in the same order as the counters ")
+
+    parser.add_argument("--library-type",
+                        dest="library_type",
+                        type=str,
+                        choices=("unstranded",
+                                 "firststrand",
+                                 "secondstrand",
+                                 "fr-unstranded",
+                                 "fr-firststrand",
+                                 "fr-secondstrand"),
+                        help="library type of reads in bam file. ")
+
+    parser.add_argument("--min-mapping-quality",
+                        dest="minimum_mapping_quality",
+                        type=float,
+                        help="minimum mapping quality. Reads with a quality "
+                        "score of less will be ignored. ")
+
+    parser.add_argument("--num-threads", "--processes", dest="num_threads",
+                        type=int,
+                        help="number of worker processes. Gene or "
+                        "transcript models are processed in chunks and "
+                        "output in input order.")
+
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int,
+                        help="number of gene or transcript models sent "
+                        "to a worker process at a time.")
+
+    parser.set_defaults(
+        genome_file=None,
+        reporter="genes",
+        with_values=True,
+        sections=[],
+        counters=[],
+        filename_gff=[],
+        filename_format=None,
+        gff_features=[],
+        gff_sources=[],
+        add_gtf_source=False,
+        proximal_distance=10000,
+        bam_files=None,
+        multi_mapping='all',
+        library_type='fr-unstranded',
+        prefixes=[],
+        minimum_mapping_quality=0,
+        use_barcodes=False,
+        sample_probability=1.0,
+        num_threads=1,
+        chunk_size=100,
+    )
+
+    if not argv:
+        argv = sys.argv
+
+    (args) = E.start(parser, add_output_options=True, argv=argv)
+
+    if args.prefixes:
+        if len(args.prefixes) != len(args.counters):
+            raise ValueError(
+                "if any prefix is given, the number of prefixes "
+                "must be the same as the number of counters")
+
+    if args.num_threads > 1:
+        file_counters = [x for x in args.counters if x in FILE_COUNTERS]
+        if file_counters:
+            E.warn("counters %s write additional files and are run in a "
+                   "single process" % ",".join(file_counters))
+            args.num_threads = 1
+
     if args.reporter == "genes":
         iterator = GTF.flat_gene_iterator
         header = ["gene_id"]
-        fheader = lambda x: [x[0].gene_id]
     elif args.reporter == "transcripts":
         iterator = GTF.transcript_iterator
         header = ["transcript_id"]
-        fheader = lambda x: [x[0].transcript_id]
 
     if args.add_gtf_source:
         header.append("source")
-        ffields = lambda x: [x[0].source]
-    else:
-        ffields = lambda x: []
+
+    counters = build_counters(args)
+    cc = E.Counter()
 
     args.stdout.write("\t".join(
         header + [x.getHeader() for x in counters]) + "\n")
 
-    for gffs in iterator(GTF.iterator(args.stdin)):
-        cc.input += 1
-
-        for counter in counters:
-            counter.update(gffs)
-
-        skip = len([x for x in counters if x.skip]) == len(counters)
-        if skip:
-            cc.skipped += 1
-            continue
-
-        args.stdout.write("\t".join(
-            fheader(gffs) +
-            ffields(gffs) +
-            [str(counter) for counter in counters]) + "\n")
-
-        cc.output += 1
+    models = iterator(GTF.iterator(args.stdin))
+
+    if args.num_threads > 1:
+        def iterate_chunks():
+            while True:
+                chunk = ["".join(str(x) + "\n" for x in gffs)
+                         for gffs in itertools.islice(
+                             models, args.chunk_size)]
+                if not chunk:
+                    break
+                yield chunk
+
+        pool = multiprocessing.Pool(args.num_threads,
+                                    initializer=init_worker,
+                                    initargs=(get_worker_args(args),))
+
+        for rows, nskipped, counts in pool.imap(annotate_chunk,
+                                                iterate_chunks()):
+            cc.input += len(rows) + nskipped
+            if nskipped:
+                cc.skipped += nskipped
+            if rows:
+                cc.output += len(rows)
+            args.stdout.write("".join(rows))
+            for counter, c in zip(counters, counts):
+                counter.counter += c
+
+        pool.close()
+        pool.join()
+    else:
+        for gffs in models:
+            cc.input += 1
+            row = annotate(gffs, counters, args)
+            if row is None:
+                cc.skipped += 1
+                continue
+            args.stdout.write(row)
+            cc.output += 1
 
     E.info("%s" % str(cc))
     for counter in counters:
@@ -74,6 +74,16 @@ Type::
 To extract the bases on the STRAND strand, between START to END from
 entry CONTIG, from DATABASE.
 
+For assemblies with many contigs, a binary index can be added to
+a database. It is memory mapped and opening it does not depend on
+the number of contigs::
+
+   cgat index_genome DATABASE --binary-index
+
+The binary index is ignored if the database or its text index have
+changed since it was built. Run the command again to rebuild it.
+
+
 Command line options
 --------------------
 
@@ -119,6 +129,11 @@ def main(argv=None):
         "means that chrMT will refer to chrM and either "
         "can be used to retrieve a sequence ")
 
+    parser.add_argument(
+        "--memory-map", dest="memory_map", action="store_true",
+        help="access uncompressed databases through a memory map "
+        "when extracting, benchmarking or verifying.")
+
     group = parser.add_argument_group("Bencharking options")
 
     group.add_argument("-b", "--benchmark", dest="benchmark",
@@ -198,6 +213,14 @@ def main(argv=None):
         help="compress index. The default is to use a plain-text, "
         "human-readable index.")
 
+    group.add_argument(
+        "--binary-index", dest="binary_index",
+        action="store_true",
+        help="write a memory mappable binary index in addition to the "
+        "plain-text index. The binary index is used in preference "
+        "when opening the database. If no input files are given, "
+        "the binary index is built for an existing database.")
+
     parser.add_argument_group(group)
 
     parser.set_defaults(
@@ -216,6 +239,8 @@ def main(argv=None):
         allow_duplicates=False,
         regex_identifier=None,
         compress_index=False,
+        binary_index=False,
+        memory_map=False,
         file_format="auto",
         force=False,
         translator=None)
@@ -248,7 +273,8 @@ def main(argv=None):
             raise ValueError("unknown translator %s" % args.translator)
 
     if args.extract:
-        fasta = IndexedFasta.IndexedFasta(unknown[0])
+        fasta = IndexedFasta.IndexedFasta(unknown[0],
+                                          memory_map=args.memory_map)
         fasta.setTranslator(args.translator)
         converter = IndexedFasta.getConverter(args.input_format)
 
@@ -266,7 +292,8 @@ def main(argv=None):
             stmt="IndexedFasta.benchmarkRandomFragment(fasta=fasta, size=%i)" %
             (args.benchmark_fragment_size),
             setup="from cgat import IndexedFasta\n"
-            "fasta=IndexedFasta.IndexedFasta('%s')" % (unknown[0]))
+            "fasta=IndexedFasta.IndexedFasta('%s', memory_map=%s)" %
+            (unknown[0], args.memory_map))
 
         t = timer.timeit(number=args.benchmark_num_iterations)
         args.stdout.write("iter\tsize\ttime\n")
@@ -275,8 +302,10 @@ def main(argv=None):
             args.benchmark_fragment_size, t))
 
     elif args.verify:
-        fasta1 = IndexedFasta.IndexedFasta(unknown[0])
-        fasta2 = IndexedFasta.IndexedFasta(args.verify)
+        fasta1 = IndexedFasta.IndexedFasta(unknown[0],
+                                           memory_map=args.memory_map)
+        fasta2 = IndexedFasta.IndexedFasta(args.verify,
+                                           memory_map=args.memory_map)
         nerrors1 = IndexedFasta.verify(fasta1, fasta2,
                                        args.verify_num_iterations,
                                        args.verify_fragment_size,
@@ -290,6 +319,9 @@ def main(argv=None):
     elif args.compress_index:
         fasta = IndexedFasta.IndexedFasta(unknown[0])
         fasta.compressIndex()
+    elif args.binary_index and len(unknown) == 1:
+        fasta = IndexedFasta.IndexedFasta(unknown[0])
+        fasta.writeBinaryIndex()
     else:
         if args.loglevel >= 1:
             args.stdlog.write("# creating database %s\n" % unknown[0])
@@ -320,6 +352,7 @@ def main(argv=None):
             clean_sequence=args.clean_sequence,
             allow_duplicates=args.allow_duplicates,
             translator=args.translator,
+            binary_index=args.binary_index,
             force=args.force)
 
     E.stop()
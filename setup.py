@@ -257,6 +257,13 @@ extensions = [
         language="c",
         extra_link_args=extra_link_args_pysam,
     ),
+    Extension(
+        "cgat.GTFTools",
+        ["cgat/GTFTools/gtftools.pyx"],
+        library_dirs=[],
+        libraries=[],
+        language="c",
+    ),
 ]
 
 for e in extensions:
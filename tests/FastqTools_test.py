@@ -0,0 +1,58 @@
+"""unit testing module for the FastqTools extension."""
+
+import concurrent.futures
+import random
+import unittest
+
+import cgat.FastqTools as fastqtools
+from cgat.Genomics import reverse_complement
+
+
+def random_sequence(length):
+    return "".join(random.choice("ACGT") for x in range(length))
+
+
+class KmerMatcherCheck(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.query = random_sequence(100)
+        self.matcher = fastqtools.KmerMatcher(self.query, 5)
+
+    def testNoMatch(self):
+        self.assertEqual(
+            self.matcher.score(["", "A", "ACGT"]).tolist(), [0, 0, 0])
+
+    def testMatch(self):
+        # all but the last k-mer are counted
+        read = self.query[20:40]
+        self.assertEqual(self.matcher.score([read]).tolist(), [15])
+        self.assertEqual(
+            self.matcher.score([reverse_complement(read)]).tolist(), [15])
+
+    def testDiagonal(self):
+        # k-mers of the two halves are on different diagonals
+        read = self.query[20:40] + "A" + self.query[60:80]
+        self.assertEqual(self.matcher.score([read]).tolist(), [16])
+
+    def testIgnoreN(self):
+        matcher = fastqtools.KmerMatcher("N" * 20, 5)
+        self.assertEqual(matcher.score(["N" * 20]).tolist(), [0])
+
+    def testMultipleQueries(self):
+        other = random_sequence(100)
+        matcher = fastqtools.KmerMatcher([self.query, other], 5)
+        self.assertEqual(
+            matcher.score([self.query[:30], other[:50]]).tolist(), [25, 45])
+
+    def testThreads(self):
+        reads = [random_sequence(random.randint(0, 50)) for x in range(100)]
+        reads.extend(self.query[x:x + 40] for x in range(60))
+        with concurrent.futures.ThreadPoolExecutor(3) as executor:
+            self.assertEqual(
+                self.matcher.score(reads, executor, chunk_size=7).tolist(),
+                self.matcher.score(reads).tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,261 @@
+"""unit testing module for the Fastq.py module."""
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import cgatcore.experiment as E
+import cgat.Fastq as Fastq
+
+RECORDS = ("@read1 first\nACGTNACGTN\n+\nIIIII#####\n"
+           "@read2 second\nNNNNACGT\n+\n!!!!IIII\n"
+           "@read3\nACGTACGTACGT\n+\n5555555555II\n")
+
+
+def iterate_records(text, **kwargs):
+    return [record
+            for batch in Fastq.iterate_batches(io.StringIO(text), **kwargs)
+            for record in batch]
+
+
+def write_batches(batches):
+    outfile = io.StringIO()
+    for batch in batches:
+        Fastq.write_batch(outfile, batch)
+    return outfile.getvalue()
+
+
+class BatchIteratorCheck(unittest.TestCase):
+
+    def testEmpty(self):
+        self.assertEqual(iterate_records(""), [])
+
+    def testRecords(self):
+        records = list(Fastq.iterate(io.StringIO(RECORDS)))
+        for block_size in (1, 13, 1000):
+            batches = iterate_records(RECORDS, block_size=block_size)
+            self.assertEqual(
+                [(x.identifier, x.seq, x.quals) for x in batches],
+                [(x.identifier, x.seq, x.quals) for x in records])
+
+    def testMissingNewline(self):
+        self.assertEqual(len(iterate_records(RECORDS[:-1])), 3)
+
+    def testIncomplete(self):
+        self.assertRaises(ValueError, iterate_records,
+                          RECORDS + "@read4\nACGT\n")
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, iterate_records,
+                          RECORDS.replace("+", "-"))
+
+    def testWrite(self):
+        for block_size in (1, 1000):
+            self.assertEqual(
+                write_batches(Fastq.iterate_batches(
+                    io.StringIO(RECORDS), block_size=block_size)),
+                RECORDS)
+
+
+class RecordBatchCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.batch = next(Fastq.iterate_batches(io.StringIO(RECORDS)))
+
+    def testLength(self):
+        self.assertEqual(len(self.batch), 3)
+        self.assertEqual(self.batch.getLengths().tolist(), [10, 8, 12])
+
+    def testCountBases(self):
+        self.assertEqual(self.batch.countBases("N").tolist(), [2, 4, 0])
+
+    def testSelect(self):
+        batch = self.batch.select(self.batch.countBases("N") == 0)
+        self.assertEqual(batch.getIdentifiers(), ["read3"])
+
+    def testTrim(self):
+        self.batch.trim(3, 2)
+        self.assertEqual(self.batch.getSequences(),
+                         ["GTNAC", "NNA", "GTACGTA"])
+        self.batch.trim5(6)
+        self.assertEqual(self.batch.getSequences(), ["", "", "A"])
+
+    def testSetIdentifiers(self):
+        self.batch.setIdentifiers(["a", "bb", "ccc"])
+        self.assertEqual(write_batches([self.batch]).split("\n")[::4],
+                         ["@a", "@bb", "@ccc", ""])
+
+    def testGuessFormat(self):
+        self.assertEqual(sorted(self.batch.guessFormat()),
+                         ["illumina-1.8", "sanger"])
+
+    def testPhred(self):
+        self.batch.format = "sanger"
+        scores = self.batch.sumQualities(self.batch.toPhred())
+        self.assertEqual(scores.tolist(), [210, 160, 280])
+        self.assertEqual(
+            self.batch.sumQualities(self.batch.toPhred() < 10).tolist(),
+            [5, 4, 0])
+
+    def testConvert(self):
+        for format in ("phred64", "integer", "illumina-1.8"):
+            batch = next(Fastq.iterate_batches(io.StringIO(RECORDS)))
+            batch.format = "sanger"
+            batch.convert(format)
+            for record, converted in zip(
+                    Fastq.iterate(io.StringIO(RECORDS)), batch):
+                record.format = "sanger"
+                record.fromPhred(record.toPhred(), format)
+                self.assertEqual(record.quals, converted.quals)
+
+    def testConvertOutOfRange(self):
+        self.batch.format = "sanger"
+        self.assertRaises(ValueError, self.batch.convert, "solexa")
+
+
+class BatchConvertCheck(unittest.TestCase):
+
+    def testConvert(self):
+        expected = "".join(
+            ["%s\n" % x for x in Fastq.iterate_convert(
+                io.StringIO(RECORDS), format="phred64", guess="sanger")])
+        self.assertEqual(
+            write_batches(Fastq.iterate_batches_convert(
+                io.StringIO(RECORDS), format="phred64", guess="sanger")),
+            expected)
+
+    def testGuess(self):
+        batches = list(Fastq.iterate_batches_guess(
+            io.StringIO(RECORDS), guess="sanger"))
+        self.assertEqual(batches[0].format, "sanger")
+
+    def testAmbiguous(self):
+        self.assertRaises(ValueError, list, Fastq.iterate_batches_guess(
+            io.StringIO(RECORDS)))
+
+
+class SortCheck(unittest.TestCase):
+
+    records = ["@read%i/%%i\n%s\n+\n%s\n" % (x, "ACGT"[x % 4] * 4, "IIII")
+               for x in (5, 3, 12, 1, 7, 3)]
+
+    def sort(self, **kwargs):
+        infiles = [io.StringIO("".join([x % 1 for x in self.records])),
+                   io.StringIO("".join([x % 2 for x in self.records]))]
+        return [(x.decode(), y.decode())
+                for x, y in Fastq.iterate_sorted(infiles, **kwargs)]
+
+    def testSortByName(self):
+        expected = [(self.records[x] % 1, self.records[x] % 2)
+                    for x in (3, 2, 1, 5, 0, 4)]
+        self.assertEqual(self.sort(), expected)
+        self.assertEqual(self.sort(memory=1), expected)
+
+    def testSortBySequence(self):
+        self.assertEqual(
+            [x[0].split("\n")[1] for x in self.sort(key="sequence")],
+            ["AAAA", "CCCC", "CCCC", "TTTT", "TTTT", "TTTT"])
+        self.assertEqual(self.sort(key="minimizer", memory=1),
+                         self.sort(key="minimizer"))
+
+    def testMismatch(self):
+        infiles = [io.StringIO(self.records[0] % 1),
+                   io.StringIO(self.records[1] % 2)]
+        self.assertRaises(ValueError, list, Fastq.iterate_sorted(infiles))
+
+
+class SampleCheck(unittest.TestCase):
+
+    records = ["@read%i/%%i\nACGT\n+read%i\nIIII\n" % (x, x)
+               for x in range(1000)]
+
+    def infiles(self):
+        return [io.StringIO("".join([x % 1 for x in self.records])),
+                io.StringIO("".join([x % 2 for x in self.records]))]
+
+    def check(self, sample):
+        for record1, record2 in sample:
+            self.assertEqual(record1.replace("/1", "/2"), record2)
+            self.assertEqual(record1.split("\n")[2], "+")
+        numbers = [int(x[0][5:x[0].index("/")]) for x in sample]
+        self.assertEqual(numbers, sorted(set(numbers)))
+
+    def testReservoir(self):
+        counter = E.Counter()
+        sample = Fastq.sample_reservoir(self.infiles(), 100, counter=counter,
+                                        rng=random.Random(1))
+        self.assertEqual(len(sample), 100)
+        self.assertEqual(counter.input, 1000)
+        self.check(sample)
+
+    def testReservoirSmall(self):
+        self.assertEqual(len(Fastq.sample_reservoir(self.infiles(), 2000)),
+                         1000)
+        self.assertEqual(Fastq.sample_reservoir(self.infiles(), 0), [])
+
+    def testSkip(self):
+        counter = E.Counter()
+        sample = list(Fastq.iterate_sample_skip(
+            self.infiles(), 0.2, counter=counter, rng=random.Random(1)))
+        self.assertGreater(len(sample), 100)
+        self.assertLess(len(sample), 300)
+        self.assertEqual(counter.input, 1000)
+        self.check(sample)
+        self.assertEqual(
+            len(list(Fastq.iterate_sample_skip(self.infiles(), 1.0))), 1000)
+
+    def testMismatch(self):
+        infiles = [io.StringIO(self.records[0] % 1), io.StringIO("")]
+        self.assertRaises(ValueError, Fastq.sample_reservoir, infiles, 10)
+
+
+class IndexCheck(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.records = []
+        for x in range(2000):
+            length = random.randint(1, 200)
+            self.records.append((
+                "read%i" % x,
+                "".join(random.choice("ACGT") for y in range(length)),
+                "".join(random.choice("#5I") for y in range(length))))
+        self.infile = io.StringIO("".join(
+            ["@%s comment\n%s\n+\n%s\n" % x for x in self.records]))
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test.fqi")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testFetch(self):
+        for block_size in (10, 1000, Fastq.INDEX_BLOCK_SIZE):
+            self.infile.seek(0)
+            index = Fastq.FastqIndex.build(self.infile, self.filename,
+                                           block_size=block_size)
+            self.assertEqual(len(index), len(self.records))
+            records = random.sample(self.records, 500)
+            self.assertEqual(index.fetch([x[0] for x in records]),
+                             [(x[1], x[2]) for x in records])
+            index.close()
+
+    def testReopen(self):
+        Fastq.FastqIndex.build(self.infile, self.filename).close()
+        index = Fastq.FastqIndex(self.filename, cache_size=1)
+        self.assertEqual(index.fetch(["read5", "read1999", "read5"]),
+                         [self.records[5][1:], self.records[1999][1:],
+                          self.records[5][1:]])
+        self.assertRaises(KeyError, index.fetch, ["read2000"])
+        index.close()
+
+    def testDuplicates(self):
+        infile = io.StringIO("@a\nA\n+\nI\n@a\nC\n+\nI\n")
+        self.assertRaises(ValueError, Fastq.FastqIndex.build,
+                          infile, self.filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+"""unit testing module for the GTFTools extension."""
+
+import copy
+import io
+import pickle
+import unittest
+
+import pysam
+
+import cgat.GTFTools as gtftools
+
+GTF = ("#comment\n"
+       "\n"
+       "chr1\tensembl\texon\t11\t20\t.\t+\t.\t"
+       'gene_id "G1"; transcript_id "T1"; exon_number 1; '
+       'transcript_name "TXNRD2;-001"; tag "basic"; tag "CCDS";\n'
+       "chr2\t.\tCDS\t101\t200\t3.5\t-\t0\t"
+       'transcript_id "T2"; gene_id "G2"; score 1.5\n')
+
+
+def read(data=GTF):
+    return list(gtftools.iterator(io.StringIO(data)))
+
+
+class RecordCheck(unittest.TestCase):
+
+    def testFields(self):
+        a, b = read()
+        self.assertEqual((a.contig, a.source, a.feature, a.start, a.end),
+                         ("chr1", "ensembl", "exon", 10, 20))
+        self.assertEqual((a.score, a.strand, a.frame), (None, "+", None))
+        self.assertEqual((b.source, b.score, b.strand, b.frame),
+                         (None, 3.5, "-", 0))
+
+    def testIdentifiers(self):
+        a, b = read()
+        self.assertEqual((a.gene_id, a.transcript_id), ("G1", "T1"))
+        self.assertEqual((b.gene_id, b.transcript_id), ("G2", "T2"))
+        record = gtftools.parse(
+            "chr1\t.\texon\t1\t2\t.\t+\t.\tref_gene_id \"X\"; gene_id 5;")
+        self.assertEqual(record.gene_id, 5)
+        self.assertRaises(KeyError, getattr, record, "transcript_id")
+
+    def testAttributes(self):
+        a, b = read()
+        self.assertEqual(list(a.keys()),
+                         ["gene_id", "transcript_id", "exon_number",
+                          "transcript_name", "tag"])
+        self.assertEqual(a.exon_number, 1)
+        self.assertEqual(a["transcript_name"], "TXNRD2;-001")
+        self.assertEqual(a.tag, "CCDS")
+        self.assertEqual(b.score, 3.5)
+        self.assertEqual(b["score"], 3.5)
+        self.assertEqual(b.asDict()["score"], 1)
+        self.assertRaises(KeyError, getattr, a, "gene_name")
+        self.assertRaises(KeyError, a.__getitem__, "gene_name")
+
+    def testStr(self):
+        lines = [x for x in GTF.splitlines() if x and not x.startswith("#")]
+        self.assertEqual([str(x) for x in read()], lines)
+
+    def testModify(self):
+        a = read()[0]
+        a.start, a.score, a.strand = 0, 2, None
+        a.gene_id = "G3"
+        a.setAttribute("gene_name", "name")
+        a.level = 2
+        self.assertEqual(a.gene_id, "G3")
+        self.assertEqual(
+            str(a),
+            "chr1\tensembl\texon\t1\t20\t2\t.\t.\t"
+            'gene_id "G3"; transcript_id "T1"; exon_number 1; '
+            'transcript_name "TXNRD2;-001"; tag "CCDS"; '
+            'gene_name "name"; level 2;')
+
+        a.attributes = 'gene_id "G4"; transcript_id "T4";'
+        self.assertEqual((a.gene_id, a.transcript_id), ("G4", "T4"))
+        self.assertRaises(KeyError, getattr, a, "level")
+
+    def testInvert(self):
+        a, b = read()
+        a.invert(100)
+        b.invert(1000)
+        self.assertEqual((a.start, a.end), (10, 20))
+        self.assertEqual((b.start, b.end), (800, 900))
+
+    def testCopy(self):
+        a = read()[0]
+        b = copy.copy(a)
+        b.start = 0
+        b.setAttribute("level", 1)
+        self.assertEqual(a.start, 10)
+        self.assertRaises(KeyError, getattr, a, "level")
+        self.assertEqual(str(pickle.loads(pickle.dumps(a))), str(a))
+
+    def testErrors(self):
+        self.assertRaises(ValueError, read, "chr1\t.\texon\t1\t2\n")
+        self.assertRaises(ValueError, read, "track name=test\n")
+
+
+class PysamCheck(unittest.TestCase):
+    '''check that records behave like :class:`pysam.GTFProxy`.'''
+
+    def testEqual(self):
+        records = read()
+        proxies = list(pysam.tabix_iterator(io.StringIO(GTF),
+                                            pysam.asGTF()))
+        for record, proxy in zip(records, proxies):
+            for field in ("contig", "source", "feature", "start", "end",
+                          "score", "strand", "frame", "gene_id",
+                          "transcript_id", "attributes"):
+                self.assertEqual(getattr(record, field),
+                                 getattr(proxy, field))
+            self.assertEqual(str(record), str(proxy))
+            self.assertEqual(record.asDict(), proxy.asDict())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,7 @@
 import unittest
 import os
+import shutil
+import tempfile
 import cgatcore.iotools as iotools
 import cgat.GTF as GTF
 
@@ -17,5 +19,45 @@ class TestIteration(unittest.TestCase):
                          100)
 
 
+class SortCheck(unittest.TestCase):
+
+    filename = os.path.join(os.path.dirname(__file__), "data", "hg19.small.gtf.gz")
+
+    sort_orders = ("gene", "gene+transcript", "contig+gene", "transcript",
+                   "position", "position+gene", "gene+exon")
+
+    def sort(self, sort_order, **kwargs):
+        with iotools.open_file(self.filename) as inf:
+            return [str(x) for x in GTF.iterator_sorted(
+                GTF.iterator(inf), sort_order=sort_order, **kwargs)]
+
+    def test_sort_key_order(self):
+        values = [("chr1", 10), ("chr1", 9), ("chr10", -1), ("chr", 5),
+                  ("chr2", 2 ** 40), ("chr1", 0)]
+        self.assertEqual(
+            sorted(values, key=lambda x: GTF.encode_sort_key(*x)),
+            sorted(values))
+
+    def test_position_sort_is_sorted(self):
+        with iotools.open_file(self.filename) as inf:
+            records = list(GTF.iterator(inf))
+        records.sort(key=lambda x: (x.contig, x.start))
+        self.assertEqual(self.sort("position"), [str(x) for x in records])
+
+    def test_external_sort_is_identical(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for sort_order in self.sort_orders:
+                self.assertEqual(
+                    self.sort(sort_order, memory=10000, tmpdir=tmpdir),
+                    self.sort(sort_order))
+                self.assertEqual(os.listdir(tmpdir), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_unknown_sort_order_raises(self):
+        self.assertRaises(ValueError, self.sort, "unknown")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,381 @@
+"""unit testing module for the IndexedFasta.py module."""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import pysam
+import cgat.IndexedFasta as IndexedFasta
+
+SEQUENCES = (("chr1", "ACGTACGTAC" * 10),
+             ("chr2", "GGGGCCCCAA" * 5),
+             ("chrM", "TTTTAAAA"))
+
+
+class BinaryIndexCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "input.fa")
+        with open(self.filename, "w") as outf:
+            for name, sequence in SEQUENCES:
+                outf.write(">%s\n%s\n" % (name, sequence))
+        self.db = os.path.join(self.tmpdir, "db")
+        IndexedFasta.createDatabase(
+            self.db,
+            IndexedFasta.MultipleFastaIterator(self.filename),
+            synonyms={"chr1": ["1"]},
+            binary_index=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testLookup(self):
+        fasta = IndexedFasta.IndexedFasta(self.db, memory_map=True)
+        fasta._loadIndex()
+        self.assertIsInstance(fasta.mIndex, IndexedFasta.BinaryIndex)
+        for name, sequence in SEQUENCES:
+            self.assertEqual(fasta.getSequence(name), sequence)
+            self.assertEqual(fasta.getLength(name), len(sequence))
+        self.assertEqual(fasta.getSequence("1", "+", 5, 15),
+                         SEQUENCES[0][1][5:15])
+        self.assertEqual(sorted(fasta.getContigs()),
+                         sorted(x[0] for x in SEQUENCES))
+        self.assertFalse("chrX" in fasta.mIndex)
+
+    def testManyContigs(self):
+        names = ["scaffold%i" % x for x in range(500, 0, -1)]
+        filename = os.path.join(self.tmpdir, "many.fa")
+        with open(filename, "w") as outf:
+            for name in names:
+                outf.write(">%s\n%s\n" % (name, "ACGT" * (len(name) % 5 + 1)))
+        db = os.path.join(self.tmpdir, "many")
+        IndexedFasta.createDatabase(
+            db, IndexedFasta.MultipleFastaIterator(filename),
+            synonyms={"scaffold1": ["s1", "first"]},
+            binary_index=True)
+        fasta = IndexedFasta.IndexedFasta(db, memory_map=True)
+        fasta._loadIndex()
+        self.assertIsInstance(fasta.mIndex, IndexedFasta.BinaryIndex)
+        for name in names:
+            self.assertEqual(fasta.getSequence(name),
+                             "ACGT" * (len(name) % 5 + 1))
+        for name in ("scaffold0", "scaffold5000", "a", "zzz", ""):
+            self.assertFalse(name in fasta.mIndex)
+        self.assertEqual(fasta.getToken("first"), "scaffold1")
+        self.assertEqual(fasta.getToken("s1"), "scaffold1")
+
+    def testStaleIndex(self):
+        # rewrite the text index without chrM
+        filename_index = self.db + ".idx"
+        with open(filename_index) as inf:
+            lines = [x for x in inf if not x.startswith("chrM")]
+        with open(filename_index, "w") as outf:
+            outf.write("".join(lines))
+
+        fasta = IndexedFasta.IndexedFasta(self.db, memory_map=True)
+        fasta._loadIndex()
+        self.assertNotIsInstance(fasta.mIndex, IndexedFasta.BinaryIndex)
+        self.assertEqual(sorted(fasta.getContigs()), ["chr1", "chr2"])
+        self.assertEqual(fasta.getSequence("1"), SEQUENCES[0][1])
+
+    def testOutdatedVersion(self):
+        filename_binary = self.db + ".idx.bin"
+        with open(filename_binary, "r+b") as outf:
+            outf.seek(len(IndexedFasta.BINARY_INDEX_MAGIC))
+            outf.write(b"\1\0\0\0")
+
+        fasta = IndexedFasta.IndexedFasta(self.db, memory_map=True)
+        fasta._loadIndex()
+        self.assertNotIsInstance(fasta.mIndex, IndexedFasta.BinaryIndex)
+        self.assertEqual(fasta.getSequence("chrM"), SEQUENCES[2][1])
+
+
+class SequenceViewCheck(unittest.TestCase):
+
+    sequences = (("chr1", "".join("ACGTN"[(x * 7 + x // 13) % 5]
+                                  for x in range(500))),
+                 ("chr2", "acgtACGTNn" * 20),
+                 ("chrM", "GATTACA"))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "input.fa")
+        with open(self.filename, "w") as outf:
+            for name, sequence in self.sequences:
+                outf.write(">%s\n%s\n" % (name, sequence))
+        self.db = os.path.join(self.tmpdir, "db")
+        IndexedFasta.createDatabase(
+            self.db, IndexedFasta.MultipleFastaIterator(self.filename))
+        self.fasta = IndexedFasta.IndexedFasta(self.db, memory_map=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def getView(self, *args, **kwargs):
+        return self.fasta.getSequenceView(*args, **kwargs).tobytes().decode(
+            "ascii")
+
+    def testSameAsGetSequence(self):
+        for name, sequence in self.sequences:
+            for start in range(0, len(sequence), 23):
+                for end in (start + 1, start + 17, len(sequence)):
+                    end = min(end, len(sequence))
+                    for strand in ("+", "-"):
+                        self.assertEqual(
+                            self.getView(name, strand, start, end),
+                            self.fasta.getSequence(name, strand, start, end))
+
+    def testEdges(self):
+        for name, sequence in self.sequences:
+            lcontig = len(sequence)
+            for strand in ("+", "-"):
+                for start, end in ((0, 0), (0, lcontig), (0, 1),
+                                   (lcontig - 1, lcontig)):
+                    self.assertEqual(
+                        self.getView(name, strand, start, end),
+                        self.fasta.getSequence(name, strand, start, end))
+                self.assertRaises(ValueError, self.fasta.getSequenceView,
+                                  name, strand, 0, lcontig + 1)
+                self.assertRaises(ValueError, self.fasta.getSequence,
+                                  name, strand, 0, lcontig + 1)
+            self.assertEqual(self.getView(name), sequence)
+
+    def testBuffer(self):
+        buffer = numpy.zeros(1000, dtype=numpy.uint8)
+        for name, sequence in self.sequences:
+            for strand in ("+", "-"):
+                for start, end in ((0, 5), (3, 100), (0, len(sequence))):
+                    end = min(end, len(sequence))
+                    view = self.fasta.getSequenceView(
+                        name, strand, start, end, out=buffer)
+                    self.assertEqual(
+                        view.tobytes().decode("ascii"),
+                        self.fasta.getSequence(name, strand, start, end))
+                    # the result is a slice of the buffer
+                    self.assertEqual(view.__array_interface__["data"][0],
+                                     buffer.__array_interface__["data"][0])
+        self.assertRaises(ValueError, self.fasta.getSequenceView,
+                          "chr1", "+", 0, 100, out=buffer[:10])
+
+    def testInternalBuffer(self):
+        first = self.fasta.getSequenceView("chr1", "-", 0, 50)
+        expected = self.fasta.getSequence("chr1", "-", 0, 50)
+        self.assertEqual(first.tobytes().decode("ascii"), expected)
+        # forward views point into the mapped file and leave the
+        # buffer untouched
+        self.fasta.getSequenceView("chr2", "+", 0, 50)
+        self.assertEqual(first.tobytes().decode("ascii"), expected)
+        self.assertFalse(
+            self.fasta.getSequenceView("chr2", "+", 0, 50).flags.writeable)
+
+
+class GroupFragmentsCheck(unittest.TestCase):
+
+    def testGroups(self):
+        fragments = [(0, 0, 10, "a"), (0, 5, 8, "b"), (0, 12, 20, "c"),
+                     (0, 40, 50, "d"), (1, 50, 60, "e")]
+        self.assertEqual(
+            list(IndexedFasta.groupFragments(fragments, 2)),
+            [(0, 0, 20, fragments[:3]),
+             (0, 40, 50, fragments[3:4]),
+             (1, 50, 60, fragments[4:])])
+        self.assertEqual(
+            [x[:3] for x in IndexedFasta.groupFragments(fragments, 1)],
+            [(0, 0, 10), (0, 12, 20), (0, 40, 50), (1, 50, 60)])
+        self.assertEqual(
+            [x[:3] for x in IndexedFasta.groupFragments(fragments, 100)],
+            [(0, 0, 50), (1, 50, 60)])
+        self.assertEqual(list(IndexedFasta.groupFragments([], 10)), [])
+
+    def testContained(self):
+        # a chunk extends to the largest end of its members
+        fragments = [(0, 0, 100, "a"), (0, 10, 20, "b"), (0, 90, 95, "c"),
+                     (0, 101, 110, "d")]
+        self.assertEqual(
+            [x[:3] for x in IndexedFasta.groupFragments(fragments, 0)],
+            [(0, 0, 100), (0, 101, 110)])
+        self.assertEqual(
+            [x[:3] for x in IndexedFasta.groupFragments(fragments, 1)],
+            [(0, 0, 110)])
+
+
+class GetSequencesCheck(unittest.TestCase):
+
+    sequences = (("chr1", "".join("ACGTNacgtn"[(x * 7 + x // 13) % 10]
+                                  for x in range(1000))),
+                 ("chr2", "GGGGCCCCAA" * 30),
+                 ("chrM", "GATTACA"))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "input.fa")
+        with open(self.filename, "w") as outf:
+            for name, sequence in self.sequences:
+                outf.write(">%s\n%s\n" % (name, sequence))
+        for compression in ("uncompressed", "dictzip", "gzip"):
+            IndexedFasta.createDatabase(
+                os.path.join(self.tmpdir, compression),
+                IndexedFasta.MultipleFastaIterator(self.filename),
+                compression=(None if compression == "uncompressed"
+                             else compression),
+                random_access_points=100)
+        pysam.faidx(self.filename)
+
+        random.seed(1)
+        self.regions = []
+        for x in range(200):
+            name, sequence = random.choice(self.sequences)
+            start = random.randint(0, len(sequence) - 1)
+            end = random.randint(start, min(len(sequence), start + 100))
+            self.regions.append((name, random.choice("+-"), start, end))
+        # duplicate and overlapping regions on both strands
+        self.regions.extend([("chr1", "+", 10, 50), ("chr1", "+", 10, 50),
+                             ("chr1", "-", 10, 50), ("chr1", "+", 20, 30),
+                             ("chr1", "-", 0, 1000), ("chrM", "-", 0, 7)])
+        random.shuffle(self.regions)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def open(self):
+        databases = [IndexedFasta.IndexedFasta(
+            os.path.join(self.tmpdir, x))
+            for x in ("uncompressed", "dictzip", "gzip")]
+        databases.append(IndexedFasta.IndexedFasta(
+            os.path.join(self.tmpdir, "uncompressed"), memory_map=True))
+        databases.append(IndexedFasta.IndexedFasta(
+            os.path.join(self.tmpdir, "input")))
+        self.assertEqual([x.mMethod for x in databases],
+                         ["uncompressed", "dictzip", "gzip",
+                          "uncompressed", "faidx"])
+        self.assertIsInstance(databases[-1], IndexedFasta.PysamIndexedFasta)
+        return databases
+
+    def testSameAsGetSequence(self):
+        for fasta in self.open():
+            expected = [fasta.getSequence(*x) for x in self.regions]
+            for max_gap in (0, 50, 10000):
+                self.assertEqual(
+                    fasta.getSequences(self.regions, max_gap=max_gap),
+                    expected)
+
+    def testOrder(self):
+        regions = [("chr2", "+", 0, 10), ("chr1", "+", 0, 10),
+                   ("chr1", "-", 0, 10), ("chr1", "+", 0, 10)]
+        for fasta in self.open():
+            self.assertEqual(
+                fasta.getSequences(regions),
+                [self.sequences[1][1][:10],
+                 self.sequences[0][1][:10],
+                 fasta.getSequence("chr1", "-", 0, 10),
+                 self.sequences[0][1][:10]])
+            self.assertEqual(fasta.getSequences([]), [])
+
+
+class BlockCacheCheck(unittest.TestCase):
+
+    def testEviction(self):
+        cache = IndexedFasta.BlockCache(max_bytes=10)
+        cache.add("a", b"AAAA")
+        cache.add("b", b"CCCC")
+        # make "b" the least recently used block
+        self.assertEqual(cache.get("a"), b"AAAA")
+        cache.add("c", b"GGGG")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 8)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"AAAA")
+        self.assertEqual(cache.get("c"), b"GGGG")
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def testReplace(self):
+        cache = IndexedFasta.BlockCache(max_bytes=10)
+        cache.add("a", b"AAAA")
+        cache.add("a", b"AAAAAA")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, 6)
+
+    def testLargeBlock(self):
+        # a single block larger than the cache is kept
+        cache = IndexedFasta.BlockCache(max_bytes=10)
+        cache.add("a", b"AAAA")
+        cache.add("b", b"C" * 20)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("b"), b"C" * 20)
+        cache.clear()
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+
+
+class CompressedCheck(unittest.TestCase):
+
+    compressions = ("dictzip", "gzip")
+
+    sequences = (("chr1", "".join("ACGT"[(x * 7 + x // 13) % 4]
+                                  for x in range(1000))),
+                 ("chr2", "GGGGCCCCAA" * 25))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "input.fa")
+        with open(self.filename, "w") as outf:
+            for name, sequence in self.sequences:
+                outf.write(">%s\n%s\n" % (name, sequence))
+        for compression in self.compressions:
+            IndexedFasta.createDatabase(
+                os.path.join(self.tmpdir, compression),
+                IndexedFasta.MultipleFastaIterator(self.filename),
+                compression=compression,
+                random_access_points=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def open(self, compression, **kwargs):
+        fasta = IndexedFasta.IndexedFasta(
+            os.path.join(self.tmpdir, compression), **kwargs)
+        self.assertEqual(fasta.mMethod, compression)
+        return fasta
+
+    def testCacheHits(self):
+        for compression in self.compressions:
+            fasta = self.open(compression)
+            sequence = self.sequences[0][1]
+            # dictzip streams forward reads and only caches blocks
+            # once it seeks backwards
+            for start in (150, 130):
+                self.assertEqual(
+                    fasta.getSequence("chr1", "+", start, start + 50),
+                    sequence[start:start + 50])
+            misses, hits = fasta.mCache.misses, fasta.mCache.hits
+            self.assertEqual(fasta.getSequence("chr1", "+", 110, 160),
+                             sequence[110:160])
+            self.assertEqual(fasta.mCache.misses, misses)
+            self.assertGreater(fasta.mCache.hits, hits)
+
+    def testSameAsUncached(self):
+        for compression in self.compressions:
+            cached = self.open(compression)
+            uncached = self.open(compression, cache_size=0)
+            self.assertIsNone(uncached.mCache)
+            for name, sequence in self.sequences:
+                for start in range(0, len(sequence) - 150, 37):
+                    for strand in ("+", "-"):
+                        self.assertEqual(
+                            cached.getSequence(
+                                name, strand, start, start + 150),
+                            uncached.getSequence(
+                                name, strand, start, start + 150))
+                    self.assertEqual(
+                        cached.getSequence(name, "+", start, start + 150),
+                        sequence[start:start + 150])
+                self.assertEqual(cached.getSequence(name), sequence)
+                self.assertEqual(uncached.getSequence(name), sequence)
+            self.assertGreater(cached.mCache.hits, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+"""unit testing module for the IntervalArray.py module."""
+
+import io
+import random
+import unittest
+
+import numpy
+
+import cgat.IntervalArray as IntervalArray
+
+BED = ("track name=test\n"
+       "chr2\t10\t20\tb1\t0\t+\n"
+       "chr1\t5\t15\ta1\t0\t-\n"
+       "chr1\t12\t30\ta2\t0\t+\n"
+       "chr1\t40\t50\ta3\t0\t+\n")
+
+
+def random_intervals(n, contigs=("chr1", "chr2"), size=1000):
+    intervals = []
+    for x in range(n):
+        start = random.randint(0, size)
+        intervals.append((random.choice(contigs), start,
+                          start + random.randint(1, 50)))
+    return intervals
+
+
+def to_bases(intervals):
+    return set((contig, x) for contig, start, end in intervals
+               for x in range(start, end))
+
+
+class LoaderCheck(unittest.TestCase):
+
+    def testBed(self):
+        a = IntervalArray.IntervalArray.fromBed(io.StringIO(BED),
+                                                with_records=True)
+        self.assertEqual(len(a), 4)
+        self.assertEqual(list(a)[:2], [("chr2", 10, 20), ("chr1", 5, 15)])
+        self.assertEqual(a.strands.tolist(), [1, 2, 1, 1])
+        self.assertEqual(a.records[1], "chr1\t5\t15\ta1\t0\t-")
+
+    def testEmpty(self):
+        a = IntervalArray.IntervalArray.fromBed(io.StringIO("#comment\n"))
+        self.assertEqual(len(a), 0)
+        self.assertEqual(len(a.merge()), 0)
+
+    def testSort(self):
+        a = IntervalArray.IntervalArray.fromBed(io.StringIO(BED))
+        self.assertTrue(a.isSorted())
+        self.assertFalse(a[[1, 0, 2, 3]].isSorted())
+        self.assertFalse(a[[1, 2, 0, 3]].isSorted())
+        self.assertEqual(list(a.sort()), [("chr1", 5, 15), ("chr1", 12, 30),
+                                          ("chr1", 40, 50), ("chr2", 10, 20)])
+        self.assertTrue(a.sort().isSorted())
+
+
+class OperationsCheck(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.a = random_intervals(200)
+        self.b = random_intervals(100, contigs=("chr1", "chr3"))
+        self.array_a = IntervalArray.IntervalArray.fromTuples(self.a)
+        self.array_b = IntervalArray.IntervalArray.fromTuples(self.b)
+
+    def testMerge(self):
+        merged = list(self.array_a.merge())
+        self.assertEqual(to_bases(merged), to_bases(self.a))
+        # merged intervals are separated by gaps
+        for x, y in zip(merged[:-1], merged[1:]):
+            if x[0] == y[0]:
+                self.assertLess(x[2], y[1])
+
+    def testMergeWithGroups(self):
+        merged, groups = self.array_a.merge(with_groups=True)
+        merged = list(merged)
+        for interval, group in zip(self.a, groups):
+            self.assertEqual(interval[0], merged[group][0])
+            self.assertGreaterEqual(interval[1], merged[group][1])
+            self.assertLessEqual(interval[2], merged[group][2])
+
+    def testMergeDistance(self):
+        a = IntervalArray.IntervalArray.fromTuples(
+            [("chr1", 0, 10), ("chr1", 15, 20), ("chr1", 30, 40)])
+        self.assertEqual(list(a.merge(distance=5)),
+                         [("chr1", 0, 20), ("chr1", 30, 40)])
+        self.assertEqual(a.getMergeGroups(distance=10).tolist(), [0, 0, 0])
+        self.assertEqual(a.getMergeGroups(distance=5).tolist(), [0, 0, 1])
+
+    def testMergeGroupsUnsorted(self):
+        a = IntervalArray.IntervalArray.fromTuples(
+            [("chr1", 10, 20), ("chr2", 0, 10), ("chr1", 0, 5)])
+        self.assertEqual(a.getMergeGroups().tolist(), [0, 1, 2])
+        self.assertRaises(ValueError, a[[0, 2]].getMergeGroups)
+
+    def testTooManyContigs(self):
+        n = IntervalArray.MAX_KEYS
+        a = IntervalArray.IntervalArray(
+            ["chr%i" % x for x in range(n + 1)],
+            numpy.arange(n + 1), numpy.zeros(n + 1), numpy.ones(n + 1),
+            strands=numpy.full(n + 1, 2))
+        self.assertRaises(ValueError, a.getCoordinates)
+        self.assertRaises(ValueError, a.getMergeGroups)
+        starts, ends = a[:n].getCoordinates()
+        self.assertTrue(numpy.all(starts[1:] > ends[:-1]))
+        self.assertEqual(a[:n].getMergeGroups().tolist(), list(range(n)))
+        self.assertRaises(ValueError, a[:n // 3 + 1].getCoordinates,
+                          stranded=True)
+
+    def testMergeStranded(self):
+        a = IntervalArray.IntervalArray.fromTuples(
+            [("chr1", 0, 10, "+"), ("chr1", 5, 20, "-"),
+             ("chr1", 8, 12, "+")])
+        self.assertEqual(list(a.merge(stranded=True)),
+                         [("chr1", 0, 12), ("chr1", 5, 20)])
+
+    def testConcatenate(self):
+        combined = IntervalArray.concatenate([self.array_a, self.array_b])
+        self.assertEqual(list(combined), self.a + self.b)
+        self.assertEqual(list(combined.merge().sort()),
+                         list(self.array_a.union(self.array_b).sort()))
+
+    def testIntersect(self):
+        self.assertEqual(to_bases(self.array_a.intersect(self.array_b)),
+                         to_bases(self.a) & to_bases(self.b))
+
+    def testSubtract(self):
+        self.assertEqual(to_bases(self.array_a.subtract(self.array_b)),
+                         to_bases(self.a) - to_bases(self.b))
+
+    def testComplement(self):
+        sizes = {"chr1": 1100, "chr2": 1100}
+        complement = list(self.array_a.complement(sizes))
+        self.assertEqual(
+            to_bases(complement),
+            to_bases([(x, 0, y) for x, y in sizes.items()]) -
+            to_bases(self.a))
+        self.assertEqual(complement, sorted(complement))
+
+    def testCountOverlaps(self):
+        expected = [sum(1 for y in self.b
+                        if x[0] == y[0] and x[1] < y[2] and y[1] < x[2])
+                    for x in self.a]
+        self.assertEqual(
+            self.array_a.countOverlaps(self.array_b).tolist(), expected)
+
+    def testCoverage(self):
+        covered = to_bases(self.b)
+        expected = [len(to_bases([x]) & covered) for x in self.a]
+        self.assertEqual(self.array_a.coverage(self.array_b).tolist(),
+                         expected)
+
+    def testClosest(self):
+        def distance(x, y):
+            return max(0, y[1] - x[2], x[1] - y[2])
+
+        index, distances = self.array_a.closest(self.array_b)
+        for x, idx, d in zip(self.a, index, distances):
+            candidates = [distance(x, y) for y in self.b if x[0] == y[0]]
+            if candidates:
+                self.assertEqual(d, min(candidates))
+                self.assertEqual(distance(x, self.b[idx]), d)
+            else:
+                self.assertEqual(idx, -1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""unit testing module for the ThreadedGzip.py module."""
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import cgat.ThreadedGzip as ThreadedGzip
+
+
+class ThreadedGzipCheck(unittest.TestCase):
+
+    data = "".join(["line %i\tACGT\n" % x for x in range(100000)])
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testWrite(self):
+        for threads in (1, 2, 4):
+            with ThreadedGzip.open_file(self.filename, "w",
+                                        threads=threads) as outf:
+                outf.write(self.data)
+            with gzip.open(self.filename, "rt") as inf:
+                self.assertEqual(inf.read(), self.data)
+
+    def testWriteEmpty(self):
+        with ThreadedGzip.open_file(self.filename, "w", threads=2):
+            pass
+        with gzip.open(self.filename, "rt") as inf:
+            self.assertEqual(inf.read(), "")
+
+    def testReadBGZF(self):
+        with ThreadedGzip.open_file(self.filename, "w", threads=2) as outf:
+            outf.write(self.data)
+        for threads in (1, 2, 4):
+            with ThreadedGzip.open_file(self.filename, "r",
+                                        threads=threads) as inf:
+                self.assertEqual(inf.read(), self.data)
+
+    def testReadGzip(self):
+        with gzip.open(self.filename, "wt") as outf:
+            outf.write(self.data[:1000])
+        with gzip.open(self.filename, "at") as outf:
+            outf.write(self.data[1000:])
+        with ThreadedGzip.open_file(self.filename, "r", threads=2) as inf:
+            self.assertEqual(inf.readlines(), self.data.splitlines(True))
+
+    def testReadTruncated(self):
+        with open(self.filename, "wb") as outf:
+            outf.write(gzip.compress(self.data.encode("ascii"))[:-100])
+        with ThreadedGzip.open_file(self.filename, "r", threads=2) as inf:
+            self.assertRaises(EOFError, inf.read)
+
+    def testCloseEarly(self):
+        with ThreadedGzip.open_file(self.filename, "w", threads=2) as outf:
+            outf.write(self.data)
+        with ThreadedGzip.open_file(self.filename, "r", threads=2) as inf:
+            self.assertEqual(inf.readline(), "line 0\tACGT\n")
+
+
+if __name__ == "__main__":
+    unittest.main()